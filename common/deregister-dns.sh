@@ -0,0 +1,24 @@
+#!/bin/bash
+
+# Remove the DNS records of this instance. Only needed with the APPEND update policy,
+# as otherwise the service name record is replaced by the next instance registering.
+
+if [[ "x$DNS_UPDATE_POLICY" != "xAPPEND" ]] || [[ "x$DNS_SERVICE_IP" == "x" ]] ; then
+    exit 0
+fi
+
+if [[ "x$SERVICE_IP" == "x" ]] ; then
+    IP=$(ip addr show eth0 | grep -F inet | grep -vF inet6 | awk '{print $2}' | rev | cut -c 4- | rev | tr -d \\n)
+else
+    IP=$SERVICE_IP
+fi
+
+cat > /mydnsdata_deregister << __EOT__
+server $DNS_SERVICE_IP
+zone local.zone
+update delete `hostname`.local.zone. A $IP
+update delete `echo $SERVICE`.local.zone. A $IP
+send
+__EOT__
+
+/usr/bin/nsupdate -t 5 -k /etc/rndc.key -v /mydnsdata_deregister
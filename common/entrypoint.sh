@@ -25,61 +25,81 @@ fi
 
 echo "[INFO] Handling persistency"
 
+# Seed a persistent dir with the content of the image dir. Copy-on-write (reflinks) is used where
+# supported, otherwise the top-level entries are copied in parallel, reporting progress.
+function seed_persistent_dir {
+    SOURCE_DIR="$1"
+    PERSISTENT_DIR="$2"
+    START_TIME=$(date +%s.%N)
+    SOURCE_BYTES=$(du -sb "$SOURCE_DIR" | cut -f1)
+    mkdir -p "$PERSISTENT_DIR"
+    if cp -a --reflink=always "$SOURCE_DIR/." "$PERSISTENT_DIR/" 2> /dev/null; then
+        SEED_METHOD="copy-on-write"
+    else
+        SEED_METHOD="parallel copy"
+        find "$SOURCE_DIR" -mindepth 1 -maxdepth 1 -print0 | xargs -0 -r -P $(nproc) -I{} cp -a {} "$PERSISTENT_DIR/" &
+        COPY_PID=$!
+        ELAPSED=0
+        while kill -0 $COPY_PID 2> /dev/null; do
+            sleep 1
+            ELAPSED=$((ELAPSED+1))
+            if [ $((ELAPSED % 5)) -eq 0 ] && kill -0 $COPY_PID 2> /dev/null; then
+                echo "[INFO] Seeding $PERSISTENT_DIR: $(du -sb "$PERSISTENT_DIR" | cut -f1)/$SOURCE_BYTES bytes copied"
+            fi
+        done
+        wait $COPY_PID
+    fi
+    END_TIME=$(date +%s.%N)
+    echo "[INFO] Seeded $PERSISTENT_DIR with $SOURCE_BYTES bytes in $(awk "BEGIN {printf \"%.2f\", $END_TIME - $START_TIME}")s ($SEED_METHOD)"
+}
+
+# List the mount points below a dir (i.e. the volumes set in the conf), from the mount table
+function get_mounts_below {
+    awk -v dir="$1/" 'index($5, dir) == 1 {print $5}' /proc/self/mountinfo
+}
+
+# Make a dir persistent: seed its persistent copy if not yet initialized, then replace it with a link to the
+# persistent copy. The image copy is removed and not moved away (i.e. in a trash dir) as on layered filesystems
+# moving a dir coming from the image copies it up in the container's writable layer, while removing it does not.
+# Dirs with mount points below are refused, as removing them would remove the content of the mounts as well.
+function make_persistent {
+    SOURCE_DIR="$1"
+    PERSISTENT_DIR="$2"
+    MOUNTS_BELOW=$(get_mounts_below "$SOURCE_DIR")
+    if [ -n "$MOUNTS_BELOW" ]; then
+        echo "[ERROR] Exit code \"1\" for making $SOURCE_DIR persistent, as there are mount points below it: $(echo $MOUNTS_BELOW)"
+        exit 1
+    fi
+    if [ ! -f "$PERSISTENT_DIR/.persistent_initialized" ]; then
+        seed_persistent_dir "$SOURCE_DIR" "$PERSISTENT_DIR"
+        touch "$PERSISTENT_DIR/.persistent_initialized"
+    fi
+    rm -rf --one-file-system -- "$SOURCE_DIR"
+    ln -s "$PERSISTENT_DIR" "$SOURCE_DIR"
+}
+
 # If persistent data:
 if [ "x$PERSISTENT_DATA" == "xTrue" ]; then
     echo "[INFO] Persistent data set"
-    if [ ! -f /persistent/data/.persistent_initialized ]; then
-        mv /data /persistent/data
-        ln -s /persistent/data /data
-        touch /data/.persistent_initialized
-    else
-       mkdir -p /trash
-       mv /data /trash
-       ln -s /persistent/data /data
-    fi
+    make_persistent /data /persistent/data
 fi
 
 # If persistent log:
 if [ "x$PERSISTENT_LOG" == "xTrue" ]; then
     echo "[INFO] Persistent log set"
-    if [ ! -f /persistent/log/.persistent_initialized ]; then
-        mv /var/log /persistent/log
-        ln -s /persistent/log /var/log
-        touch /var/log/.persistent_initialized
-    else
-       mkdir -p /trash
-       mv /var/log /trash
-       ln -s /persistent/log /var/log
-    fi
+    make_persistent /var/log /persistent/log
 fi
 
 # If persistent home:
 if [ "x$PERSISTENT_HOME" == "xTrue" ]; then
     echo "[INFO] Persistent home set"
-    if [ ! -f /persistent/home/.persistent_initialized ]; then
-        mv /home /persistent/home
-        ln -s /persistent/home /home
-        touch /home/.persistent_initialized
-    else
-       mkdir -p /trash
-       mv /home /trash
-       ln -s /persistent/home /home
-    fi
+    make_persistent /home /persistent/home
 fi
 
-
 # If persistent opt:
 if [ "x$PERSISTENT_OPT" == "xTrue" ]; then
     echo "[INFO] Persistent opt set"
-    if [ ! -f /persistent/opt/.persistent_initialized ]; then
-        mv /opt /persistent/opt
-        ln -s /persistent/opt /opt
-        touch /opt/.persistent_initialized
-    else
-       mkdir -p /trash
-       mv /opt /trash
-       ln -s /persistent/opt /opt
-    fi
+    make_persistent /opt /persistent/opt
 fi
 
 
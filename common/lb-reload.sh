@@ -0,0 +1,60 @@
+#!/bin/bash
+set -e
+
+# Generate the HAProxy conf from the env vars and the backends list (one "name ip" per line,
+# written by Reyns when instances of the target service are run or cleaned), then reload it.
+
+BACKENDS_FILE=/etc/haproxy/backends.list
+CONF_FILE=/etc/haproxy/haproxy.cfg
+LB_MODE=${LB_MODE:-tcp}
+
+touch $BACKENDS_FILE
+
+cat > $CONF_FILE.new << __EOT__
+global
+    maxconn 4096
+
+defaults
+    mode $LB_MODE
+    retries 3
+    option redispatch
+    timeout connect 5s
+    timeout client 1m
+    timeout server 1m
+
+listen stats
+    bind *:8404
+    mode http
+    stats enable
+    stats uri /stats
+    stats refresh 10s
+__EOT__
+
+# LB_PORTS is a comma-separated list of "listen_port:backend_port" (or just "port")
+for LB_PORT in ${LB_PORTS//,/ }
+do
+    LISTEN_PORT=${LB_PORT%%:*}
+    BACKEND_PORT=${LB_PORT##*:}
+    echo "" >> $CONF_FILE.new
+    echo "listen $LB_TARGET-$LISTEN_PORT" >> $CONF_FILE.new
+    echo "    bind *:$LISTEN_PORT" >> $CONF_FILE.new
+    echo "    balance ${LB_BALANCE:-roundrobin}" >> $CONF_FILE.new
+    if [[ "x$LB_MODE" == "xhttp" ]] ; then
+        echo "    option forwardfor" >> $CONF_FILE.new
+    fi
+    while read NAME IP
+    do
+        if [[ "x$IP" != "x" ]] ; then
+            echo "    server $NAME $IP:$BACKEND_PORT check inter 2s" >> $CONF_FILE.new
+        fi
+    done < $BACKENDS_FILE
+done
+
+# Check and install the new conf
+haproxy -c -f $CONF_FILE.new > /dev/null
+mv $CONF_FILE.new $CONF_FILE
+
+# Reload HAProxy, if running
+if [ -f /var/run/runhaproxy.pid ]; then
+    kill -HUP $(cat /var/run/runhaproxy.pid)
+fi
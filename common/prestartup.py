@@ -1,34 +1,146 @@
-
 import os
 import sys
+import time
+import signal
+import hashlib
 import datetime
+import threading
 import subprocess
-from collections import namedtuple
-
-def shell(command, interactive=False):
-    '''Execute a command in the shell. By default prints everything. If the capture switch is set,
-    then it returns a namedtuple with stdout, stderr, and exit code.'''
-    
-    if interactive:
-        exit_code = subprocess.call(command, shell=True)
-        if exit_code == 0:
-            return True
-        else:
-            return False
- 
-    process          = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=True)
-    (stdout, stderr) = process.communicate()
-    exit_code        = process.wait()
-
-    # Convert to str (Python 3)
-    stdout = stdout.decode(encoding='UTF-8')
-    stderr = stderr.decode(encoding='UTF-8')
-
-    # Output namedtuple
-    Output = namedtuple('Output', 'stdout stderr exit_code')
-
-    # Return
-    return Output(stdout, stderr, exit_code)
+
+# Conf
+LOGS_PATH           = '/var/log/reyns'
+LOGS_MAX_BYTES      = int(os.getenv('PRESTARTUP_LOGS_MAX_BYTES', 10*1024*1024))
+PRESTARTUP_TIMEOUT  = float(os.getenv('PRESTARTUP_TIMEOUT', 0) or 0)
+FORCE_PRESTARTUP    = os.getenv('FORCE_PRESTARTUP', 'False') == 'True'
+CACHE_PATH          = '/persistent/.prestartup_cache'
+
+# Lock for printing from the streaming threads
+print_lock = threading.Lock()
+
+
+def date_str():
+    return str(datetime.datetime.now()).split('.')[0]
+
+
+def safe_print(line):
+    '''Print a line as UTF-8 bytes, as printing non-ASCII text to a non-UTF-8 stdout raises (i.e. on Python 2)'''
+    if not isinstance(line, bytes):
+        line = line.encode('UTF-8')
+    with print_lock:
+        sys.stdout.flush()
+        out = getattr(sys.stdout, 'buffer', sys.stdout)
+        out.write(line + b'\n')
+        out.flush()
+
+
+def open_log_file(item, stream_name):
+    '''Open the log file for a given script and stream, rotating it first if over the size cap'''
+    log_file_path = '{}/{}.{}.log'.format(LOGS_PATH, item, stream_name)
+    try:
+        if os.path.exists(log_file_path) and os.path.getsize(log_file_path) >= LOGS_MAX_BYTES:
+            os.rename(log_file_path, log_file_path+'.1')
+        log_file = open(log_file_path, 'ab')
+        log_file.write('\n ======== {} ========\n'.format(date_str()).encode('UTF-8'))
+        return log_file
+    except Exception as e:
+        safe_print('[ERROR] Cannot write {} to file ({}: {}).'.format(stream_name, e.__class__.__name__, e))
+        return None
+
+
+def stream(pipe, prefix, log_file):
+    '''Print (with timestamps) and log a stream line by line, as soon as lines are available. Lines are
+    logged as they are, and printed as UTF-8.'''
+    written = 0
+    for line in iter(pipe.readline, b''):
+        line = line.rstrip(b'\n')
+        safe_print(u' {} [{}] {}'.format(prefix, date_str(), line.decode('UTF-8', 'replace')))
+        if log_file:
+            # Stop logging once the size cap (in bytes) is reached
+            if written < LOGS_MAX_BYTES:
+                log_file.write(line+b'\n')
+                written += len(line)+1
+                if written >= LOGS_MAX_BYTES:
+                    log_file.write('[truncated: log size cap of {} bytes reached]\n'.format(LOGS_MAX_BYTES).encode('UTF-8'))
+                log_file.flush()
+    pipe.close()
+
+
+def run_script(item, script):
+    '''Run a prestartup script streaming its output and enforcing the timeout, if any. Returns
+    a (exit_code, timed_out, stderr_log_file_path) tuple, the latter None if the log was not written.'''
+
+    # Use bash and not chmod + execute, see https://github.com/moby/moby/issues/9547. Also, start
+    # the script in its own process group so that in case of timeout we can kill its children as well.
+    process = subprocess.Popen(['bash', script], stdout=subprocess.PIPE, stderr=subprocess.PIPE, preexec_fn=os.setsid)
+
+    # Stream stdout and stderr
+    log_files = [open_log_file(item, 'stdout'), open_log_file(item, 'stderr')]
+    streamers = [threading.Thread(target=stream, args=(process.stdout, 'out:', log_files[0])),
+                 threading.Thread(target=stream, args=(process.stderr, 'err:', log_files[1]))]
+    for streamer in streamers:
+        streamer.daemon = True
+        streamer.start()
+
+    # Handle timeout
+    timed_out = []
+    def kill():
+        timed_out.append(True)
+        try:
+            os.killpg(process.pid, signal.SIGKILL)
+        except OSError:
+            pass
+    timer = None
+    if PRESTARTUP_TIMEOUT:
+        timer = threading.Timer(PRESTARTUP_TIMEOUT, kill)
+        timer.start()
+
+    exit_code = process.wait()
+    if timer:
+        timer.cancel()
+    for streamer in streamers:
+        # Children left in background may keep the pipes open, do not wait for them forever
+        streamer.join(1)
+    for log_file in log_files:
+        if log_file:
+            log_file.close()
+
+    return (exit_code, bool(timed_out), log_files[1].name if log_files[1] else None)
+
+
+def get_cache_hash(script):
+    '''If the script declares itself as cacheable (with a "# reyns: cacheable [VAR1 VAR2 ...]" annotation),
+    return the hash of its content plus the values of the declared input env vars. Otherwise, return None.'''
+    with open(script, 'rb') as f:
+        content = f.read()
+    for line in content.decode('UTF-8', 'replace').split('\n'):
+        line = line.strip()
+        if line.startswith('#') and line[1:].strip().startswith('reyns:'):
+            annotation = line[1:].strip()[6:].strip()
+            if annotation.split(' ')[0] == 'cacheable':
+                input_env_vars = sorted(annotation.split()[1:])
+                cache_hash = hashlib.sha256(content)
+                for input_env_var in input_env_vars:
+                    cache_hash.update('\n{}={}'.format(input_env_var, os.getenv(input_env_var, '')).encode('UTF-8'))
+                return cache_hash.hexdigest()
+    return None
+
+
+def is_cached(item, cache_hash):
+    try:
+        with open('{}/{}'.format(CACHE_PATH, item)) as f:
+            return f.read().strip() == cache_hash
+    except IOError:
+        return False
+
+
+def set_cached(item, cache_hash):
+    try:
+        if not os.path.isdir(CACHE_PATH):
+            os.makedirs(CACHE_PATH)
+        with open('{}/{}'.format(CACHE_PATH, item), 'w') as f:
+            f.write(cache_hash)
+    except Exception as e:
+        safe_print('[ERROR] Cannot save prestartup cache marker for "{}" ({}: {}).'.format(item, e.__class__.__name__, e))
 
 
 prestartup_scripts_path='/prestartup'
@@ -36,69 +148,55 @@ def sorted_ls(path):
     mtime = lambda f: os.stat(os.path.join(path, f)).st_mtime
     return list(sorted(os.listdir(path), key=mtime))
 
+def print_summary(executed, skipped, failed, total_time):
+    # This line is parsed by Reyns on the host, keep the format stable
+    safe_print('[INFO] Prestartup summary: executed={} skipped={} failed={} total_time={:.2f}s'.format(executed, skipped, failed, total_time))
+
+# The idempotency cache is available only if we have persistency (persistent and master instances)
+use_cache = os.path.isdir('/persistent')
+if use_cache and FORCE_PRESTARTUP:
+    safe_print('[INFO] Forcing execution of all the prestartup scripts, ignoring the cache')
+
+executed = 0
+skipped = 0
+total_start = time.time()
 for item in sorted_ls(prestartup_scripts_path):
     if item.endswith('.sh'):
-        
+
+        # Skip this startup script if cacheable and unchanged since its last successful execution
+        cache_hash = get_cache_hash(prestartup_scripts_path+'/'+item) if use_cache else None
+        if cache_hash and not FORCE_PRESTARTUP and is_cached(item, cache_hash):
+            safe_print('[INFO] Skipping prestartup script "{}" as unchanged since its last execution (cached)'.format(item))
+            skipped += 1
+            continue
+
         # Execute this startup script
-        print('[INFO] Executing prestartup script "{}"...'.format(item))
+        safe_print('[INFO] Executing prestartup script "{}"...'.format(item))
         script = prestartup_scripts_path+'/'+item
 
-        # Use bash and not chmod + execute, see https://github.com/moby/moby/issues/9547
-        out = shell('bash {}'.format(script))
-
-        # Set date
-        date_str = str(datetime.datetime.now()).split('.')[0]
-
-        # Print and log stdout and stderr
-        for line in out.stdout.strip().split('\n'):
-            print(' out: {}'.format(line))
-        
-        #try:
-        #    with open('/var/log/reyns/{}.stdout.log'.format(item), 'a') as stdout_file:
-        #        stdout_file.write('\n ======== {} ========\n'.format(date_str))
-        #        stdout_file.write(out.stdout)
-        #except Exception as e:
-        #    print('[ERROR] Cannot write stdout to file ({}: {}).'.format(e.__class__.__name__, e))
-
-        for line in out.stderr.strip().split('\n'):
-            print(' err: {}'.format(line))
-        
-        #try:
-        #    with open('/var/log/reyns/{}.stderr.log'.format(item), 'a') as stderr_file:
-        #        stderr_file.write('\n ======== {} ========\n'.format(date_str))
-        #        stderr_file.write(out.stderr)
-        #except Exception as e:
-        #    print('[ERROR] Cannot write stderr to file ({}: {}).'.format(e.__class__.__name__, e))
-        
+        script_start = time.time()
+        (exit_code, timed_out, stderr_log_file_path) = run_script(item, script)
+        script_time = time.time() - script_start
+        executed += 1
+
         # Handle error in the startup script
-        if out.exit_code:
-            #print('[ERROR] Exit code "{}" for "{}", check log in /var/log/reyns/{}.stderr.log'.format(out.exit_code, item, item))            
-            print('[ERROR] Exit code "{}" for "{}"'.format(out.exit_code, item))            
+        if timed_out:
+            safe_print('[ERROR] Timeout of {}s reached for "{}", killed'.format(PRESTARTUP_TIMEOUT, item))
+
+        if exit_code:
+            print_summary(executed, skipped, 1, time.time() - total_start)
+            if stderr_log_file_path:
+                safe_print('[ERROR] Exit code "{}" for "{}" after {:.2f}s, check log in {}'.format(exit_code, item, script_time, stderr_log_file_path))
+            else:
+                safe_print('[ERROR] Exit code "{}" for "{}" after {:.2f}s (no log written, see the output above)'.format(exit_code, item, script_time))
 
             # Exit with error code 1
             sys.exit(1)
 
+        safe_print('[INFO] Prestartup script "{}" completed in {:.2f}s'.format(item, script_time))
 
-        
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
+        # Mark as executed for the cache
+        if cache_hash:
+            set_cached(item, cache_hash)
 
+print_summary(executed, skipped, 0, time.time() - total_start)
@@ -52,5 +52,16 @@ fi
 
 
 
+# Update DNS resolv only if the update is deferred (i.e. for a rolling re-run replacement, which
+# is registered on the DNS by Reyns only once ready)
+if [[ "x$DNS_DEFER_UPDATE" == "xTrue" ]] ; then
+                cp /etc/resolv.conf /etc/resolv.conf.bak
+                cat > /etc/resolv.conf << __EOT__
+search local.zone
+nameserver $DNS_SERVICE_IP
+__EOT__
+    exit 0
+fi
+
 # Update DNS
 /update-dns.sh $DNS_SERVICE_IP &> /var/log/update-dns.log &
@@ -0,0 +1,12 @@
+#!/bin/bash
+set -e
+
+if [[ "x$LB_TARGET" == "x" ]] || [[ "x$LB_PORTS" == "x" ]] ; then
+    echo "CRITICAL: Empty LB_TARGET or LB_PORTS env var, check conf"
+    exit 1
+fi
+
+# Start with no backends, Reyns will update them once running
+rm -f /var/run/runhaproxy.pid
+> /etc/haproxy/backends.list
+/lb-reload.sh
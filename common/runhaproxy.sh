@@ -0,0 +1,32 @@
+#!/bin/bash
+
+# HAProxy is reloaded gracefully on SIGHUP (sent by /lb-reload.sh): the new process takes
+# over the listening sockets, while the old one finishes serving its connections and exits.
+
+PIDFILE=/var/run/haproxy.pid
+echo $$ > /var/run/runhaproxy.pid
+
+reload() {
+    haproxy -f /etc/haproxy/haproxy.cfg -p $PIDFILE -D -sf $(cat $PIDFILE)
+}
+
+stop() {
+    rm -f /var/run/runhaproxy.pid
+    kill $(cat $PIDFILE)
+    exit 0
+}
+
+trap reload HUP
+trap stop TERM INT
+
+haproxy -f /etc/haproxy/haproxy.cfg -p $PIDFILE -D || exit 1
+
+while true
+do
+    sleep 1 &
+    wait $!
+    if ! kill -0 $(cat $PIDFILE) &> /dev/null ; then
+        echo "HAProxy is not running anymore, exiting"
+        exit 1
+    fi
+done
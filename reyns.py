@@ -7,8 +7,19 @@ import os
 import sys
 import inspect
 import uuid
+import glob
+import fnmatch
+import tarfile
+import tempfile
+import csv
+import heapq
+import hashlib
+import copy
+import zlib
+import shutil
 import logging
 import json
+import errno
 import socket
 try:
     import fcntl
@@ -17,8 +28,14 @@ except ImportError:
 import struct
 import platform
 import re
+import shlex
+import select
 import subprocess
-from collections import namedtuple
+import threading
+import time
+from collections import namedtuple, OrderedDict
+from io import BytesIO
+from multiprocessing.pool import ThreadPool
 from time import sleep
 
 # Python 3.5 compatibility
@@ -26,6 +43,16 @@ try:
     type(raw_input)
 except NameError:
     raw_input = input
+try:
+    from shlex import quote as shell_quote
+except ImportError:
+    from pipes import quote as shell_quote
+
+# Asyncio execution engine, if available (Python 3.8+, see reyns_engine.py)
+try:
+    import reyns_engine
+except (ImportError, SyntaxError):
+    reyns_engine = None
 
 
 #--------------------------
@@ -62,8 +89,27 @@ CWD                 = os.getcwd()
 SERVICES_IMAGES_DIR = os.getenv('SERVICES_IMAGES_DIR', os.getcwd() + '/services')
 BASE_IMAGES_DIR     = os.getenv('BASE_IMAGES_DIR', os.getcwd() + '/base')
 LOG_LEVEL           = os.getenv('LOG_LEVEL', 'INFO')
+PROMPTS_ENABLED     = True
 SUPPORTED_OSES      = ['ubuntu14.04','centos7.2','ubuntu18.04']
-REDIRECT            = '&> /dev/null'
+BUILD_CONTEXT_WARNING_MB = int(os.getenv('BUILD_CONTEXT_WARNING_MB', 100))
+BUILD_CACHE_REGISTRY = os.getenv('BUILD_CACHE_REGISTRY', None)
+CPU_PINNING_HOST_CORES = int(os.getenv('CPU_PINNING_HOST_CORES', 1))
+CPUSET_CUSTOM_LABEL = 'reyns.cpuset=custom'
+ROLLING_READY_TIMEOUT = int(os.getenv('ROLLING_READY_TIMEOUT', 120))
+RUN_CONCURRENCY     = int(os.getenv('RUN_CONCURRENCY', 8))
+CLONE_CONCURRENCY   = int(os.getenv('CLONE_CONCURRENCY', 8))
+PUBLISH_PORTS_RANGE = os.getenv('PUBLISH_PORTS_RANGE', '20000-29999')
+BACKUP_DIR          = os.getenv('BACKUP_DIR', PROJECT_DIR + '/backups_' + PROJECT_NAME)
+BACKUP_CONCURRENCY  = int(os.getenv('BACKUP_CONCURRENCY', 8))
+BACKUP_CHUNK_SIZE   = 4*1024*1024
+HOST_FACTS_FILE     = PROJECT_DIR + '/.host_facts.json'
+HOST_FACTS_TTL      = int(os.getenv('HOST_FACTS_TTL', 300))
+USE_ENGINE          = os.getenv('USE_ENGINE', 'True') == 'True'
+ENGINE_CONCURRENCY  = int(os.getenv('ENGINE_CONCURRENCY', 16))
+ENGINE_HOST_CONCURRENCY = int(os.getenv('ENGINE_HOST_CONCURRENCY', 8))
+SHELL_TIMEOUT       = float(os.getenv('SHELL_TIMEOUT', 0) or 0)
+OUTPUT_FORMATS      = ['text', 'json', 'ndjson']
+VOLUME_OPTIONS      = ['ro', 'rw', 'z', 'Z', 'nocopy', 'shared', 'rshared', 'slave', 'rslave', 'private', 'rprivate', 'consistent', 'cached', 'delegated']
 VERSION             = 'v0.10.0'
 
 # Sanitize conf
@@ -88,9 +134,6 @@ if LOG_LEVEL not in ['DEBUG', 'INFO', 'ERROR', 'CRITICAL']:
 
 # Platform-specific conf tricks
 if running_on_windows():
-    
-    # Don't use redirect as there is no Bash when calling external os_shell calls
-    REDIRECT = ''
 
     # Remove c:/ and similar in data dir and replace with Unix-like /c/
     if len(DATA_DIR) >= 3 and DATA_DIR[1:3] == ':/':
@@ -134,20 +177,33 @@ def safeprint(s):
         else:
             print(s.encode('utf8'))
 
-# Sanitize encoding
+# Sanitize encoding, to concatenate a text with str (bytes on Python 2, unicode on Python 3)
 def sanitize_encoding(text):
-    return text.encode("utf-8", errors="ignore")
+    if sys.version_info >= (3,):
+        return text.decode('utf-8', 'ignore') if isinstance(text, bytes) else text
+    return text.encode('utf-8', 'ignore') if isinstance(text, unicode) else text
     
+# Error raised on fatal errors (see abort). On the command line it is printed before exiting.
+class ReynsError(Exception):
+    pass
+
 # Abort
 def abort(message):
-    print('Aborting due to fatal error: {}. \n'.format(message))
-    sys.exit(1)
+    raise ReynsError(message)
+
+# Ask the user, if allowed (not when used as a library, see Client)
+def ask(message=''):
+    if not PROMPTS_ENABLED:
+        abort('Cannot ask for input when not interactive{}'.format(' ("{}")'.format(message.strip()) if message.strip() else ''))
+    return raw_input(message)
 
 # Confirm
 def confirm(message):
+    if not PROMPTS_ENABLED:
+        abort('Cannot ask for confirmation when not interactive ("{}")'.format(message))
     while True:
         print('{}  [Y/n] '.format(message), end='')
-        confirm = raw_input().lower()
+        confirm = ask().lower()
         if confirm in ('y', ''):
             return True
         elif confirm == 'n':
@@ -155,6 +211,43 @@ def confirm(message):
         else:
             print('I didn\'t understand you. Please specify "(y)es" or "(n)o".')
 
+# Caches shared among the commands of a batch (see the batch task): the run confs and the services metadata, checked
+# against the modification time of their files, and the containers listings (see os_shell). They are disabled out of
+# batches, as other processes could change the containers meanwhile.
+batch_caches = {'enabled': False, 'confs': {}, 'metadata': {}, 'containers': {}}
+
+# Docker commands which do not change the containers
+READ_ONLY_DOCKER_COMMANDS = ['ps', 'inspect', 'info', 'version', 'images', 'logs', 'port']
+
+# Get cached
+def get_cached(cache, key, function, files=()):
+    '''Get a value from a batch cache, or compute it with the given function (and cache it) if not cached or if
+    any of the given files changed in the meantime'''
+    if not batch_caches['enabled']:
+        return function()
+    stamp = [os.path.getmtime(path) if os.path.exists(path) else None for path in files]
+    if key in batch_caches[cache] and batch_caches[cache][key][0] == stamp:
+        return copy.deepcopy(batch_caches[cache][key][1])
+    value = function()
+    batch_caches[cache][key] = (stamp, copy.deepcopy(value))
+    return value
+
+# Check output format
+def check_output_format(format):
+    if format not in OUTPUT_FORMATS:
+        abort('Unknown output format "{}", supported formats are: {}'.format(format, ', '.join(OUTPUT_FORMATS)))
+
+# Print records
+def print_records(records, format):
+    '''Print records (dicts) in a machine-readable format: "json" prints the list of the records once they are
+    all known, "ndjson" prints one record per line as soon as it is known.'''
+    if format == 'ndjson':
+        for record in records:
+            print(json.dumps(record))
+            sys.stdout.flush()
+    else:
+        print(json.dumps(list(records), indent=4, separators=(',', ': ')))
+
 # Load host conf
 def load_host_conf():
     host_conf = {}
@@ -174,6 +267,10 @@ def save_host_conf(host_conf):
     with open(PROJECT_DIR+'/host.conf', 'w') as outfile:
         json.dump(host_conf, outfile)
 
+# Get the path of a file given by the user, which is relative to the project dir (the reyns command runs from the Reyns dir)
+def get_project_path(path):
+    return path if os.path.isabs(path) else os.path.join(PROJECT_DIR, path)
+
 # Get IP address of an interface              
 def get_ip_address(ifname):
     logger.debug('Getting IP address for interface "{}"'.format(ifname))
@@ -189,7 +286,7 @@ def get_ip_address(ifname):
             ip_address = socket.inet_ntoa(fcntl.ioctl(
                 s.fileno(),
                 0x8915,  # SIOCGIFADDR
-                struct.pack('256s', ifname[:15])
+                struct.pack('256s', ifname[:15].encode('UTF-8'))
             )[20:24])
         else:
             raise Exception('Sorry not supported on this OS (missing fcntl module)') 
@@ -276,7 +373,7 @@ def sanity_checks(service, instance=None, notrunning_ok=False):
 
 
 def is_base_service(service):
-    return (service.startswith('reyns-common-') or service.startswith('reyns-base-') or service.startswith('reyns-dns'))
+    return (service.startswith('reyns-common-') or service.startswith('reyns-base-') or service.startswith('reyns-dns') or service.startswith('reyns-lb'))
 
 
 def get_running_services_instances_matching(service,instance=None):
@@ -336,19 +433,112 @@ def get_service_dir(service=None, onlychecking=False):
     # Return
     return service_dir
 
-def os_shell(command, capture=False, verbose=False, interactive=False, silent=False):
+# Execution engine, started on first use (see get_engine)
+engine = {}
+engine_lock = threading.Lock()
+
+def get_engine():
+    '''Get the asyncio execution engine (see reyns_engine.py), or None if not available or disabled'''
+    if not reyns_engine or not USE_ENGINE:
+        return None
+    with engine_lock:
+        if 'engine' not in engine:
+            engine['engine'] = reyns_engine.Engine(concurrency=ENGINE_CONCURRENCY, host_concurrency=ENGINE_HOST_CONCURRENCY)
+    return engine['engine']
+
+def cancel_shell_commands():
+    '''Cancel the commands running in the execution engine, if any, killing their processes'''
+    if 'engine' in engine:
+        engine['engine'].cancel_all()
+
+def format_command(command):
+    '''Format a command given as a list of arguments as a shell command line, i.e. for logging'''
+    if not isinstance(command, list):
+        return command
+    return ' '.join([shell_quote(arg) for arg in command])
+
+def get_command_host(command):
+    '''Get the host a command runs on, for the per-host concurrency limits of the execution engine: the
+    Docker daemon for the Docker commands, the target for the SSH ones and None (the local host) otherwise'''
+    if command.startswith('docker '):
+        return os.getenv('DOCKER_HOST', 'docker')
+    if command.startswith('ssh ') and '@' in command:
+        return command.split('@')[1].split(' ')[0]
+    return None
+
+def uses_terminal(command):
+    '''Check if a command needs the terminal (i.e. "docker exec -it" or "ssh -t"), and so cannot be run by
+    the execution engine, which runs the commands detached from it. A pseudo-TTY alone does not need it (i.e.
+    "docker create -t" or "docker run -d -t"), only if stdin is attached as well or if it is for ssh.'''
+    try:
+        args = shlex.split(command)
+    except ValueError:
+        args = command.split()
+    flags = set()
+    for arg in args:
+        if arg in ['--interactive', '--tty', '--detach']:
+            flags.add(arg[2])
+        elif re.match(r'^-[a-zA-Z]+$', arg):
+            flags.update(arg[1:])
+    if args and os.path.basename(args[0]) == 'ssh':
+        return 't' in flags
+    return 'i' in flags and 't' in flags and 'd' not in flags
+
+# Output of os_shell in capture mode
+Output = namedtuple('Output', 'stdout stderr exit_code')
+
+def os_shell_many(commands):
+    '''Execute many commands (strings or lists of arguments, see os_shell) concurrently and return their outputs
+    (as os_shell in capture mode), using the execution engine if available or a pool of RUN_CONCURRENCY threads otherwise'''
+    engine = get_engine()
+    commands_lines = [format_command(command) for command in commands]
+    if engine and not [command_line for command_line in commands_lines if uses_terminal(command_line)]:
+        for command_line in commands_lines:
+            logger.debug('Shell executing command: "%s"', command_line)
+        results = engine.shell_many(commands, timeout=SHELL_TIMEOUT or None, hosts=[get_command_host(command_line) for command_line in commands_lines])
+        return [Output(result.stdout[:-1] if result.stdout.endswith('\n') else result.stdout,
+                       result.stderr[:-1] if result.stderr.endswith('\n') else result.stderr, result.exit_code) for result in results]
+    if not commands:
+        return []
+    pool = ThreadPool(min(RUN_CONCURRENCY, len(commands)))
+    try:
+        return pool.map(lambda command: os_shell(command, capture=True), commands)
+    finally:
+        pool.close()
+
+def os_shell(command, capture=False, verbose=False, interactive=False, silent=False, timeout=None, input=None, env=None):
     '''Execute a command in the os_shell. By default prints everything. If the capture switch is set,
-    then it returns a namedtuple with stdout, stderr, and exit code.'''
+    then it returns a namedtuple with stdout, stderr, and exit code. If the timeout (in seconds, default
+    SHELL_TIMEOUT) is reached, the command is killed. Unless interactive or verbose, commands are run by
+    the execution engine if available. The command can be given as a list of arguments as well, which is
+    executed directly and not trough the shell, so that the arguments need no quoting. In capture mode,
+    the input (a string) is written to the command stdin, if given. The env (a dict), if given, replaces
+    the environment of the command, leaving the one of the current process untouched.'''
     
     if capture and verbose:
         raise Exception('You cannot ask at the same time for capture and verbose, sorry')
 
     # Log command
-    logger.debug('Shell executing command: "%s"', command)
+    use_shell = not isinstance(command, list)
+    command_line = format_command(command)
+    logger.debug('Shell executing command: "%s"', command_line)
+
+    # In a batch, the containers listings are cached until a Docker command which can change them is executed
+    if batch_caches['enabled'] and 'docker' in command_line:
+        if command_line.split(' ')[0:2] == ['docker', 'ps']:
+            if capture and command_line in batch_caches['containers']:
+                logger.debug('Using cached output for command "%s"', command_line)
+                return batch_caches['containers'][command_line]
+        elif command_line.split(' ')[0] != 'docker' or command_line.split(' ')[1] not in READ_ONLY_DOCKER_COMMANDS:
+            batch_caches['containers'].clear()
 
     # Execute command in interactive mode    
     if verbose or interactive:
-        exit_code = subprocess.call(command, shell=True)
+        try:
+            exit_code = subprocess.call(command, shell=use_shell, env=env)
+        except OSError as e:
+            print(e)
+            return False
         if exit_code == 0:
             return True
         else:
@@ -357,21 +547,40 @@ def os_shell(command, capture=False, verbose=False, interactive=False, silent=Fa
     # Execute command getting stdout and stderr
     # http://www.saltycrane.com/blog/2008/09/how-get-stdout-and-stderr-using-python-subprocess-module/
     
-    process          = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=True)
-    (stdout, stderr) = process.communicate()
-    exit_code        = process.wait()
-
-    # Convert to str (Python 3)
-    stdout = stdout.decode(encoding='UTF-8')
-    stderr = stderr.decode(encoding='UTF-8')
+    timeout = timeout or SHELL_TIMEOUT or None
+    engine = get_engine()
+    if engine and not uses_terminal(command_line):
+        result = engine.shell(command, timeout=timeout, host=get_command_host(command_line),
+                              input=input.encode('UTF-8') if input is not None else None, env=env)
+        (stdout, stderr, exit_code) = (result.stdout, result.stderr, result.exit_code)
+        if result.timed_out:
+            stderr += '{}Killed as the timeout of {}s was reached'.format('\n' if stderr.strip() else '', timeout)
+    else:
+        try:
+            process          = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=use_shell,
+                                                stdin=subprocess.PIPE if input is not None else None, env=env)
+        except OSError as e:
+            # As the shell does when the command is not found
+            (stdout, stderr, exit_code) = (b'', str(e).encode('UTF-8'), 127)
+        else:
+            timer = None
+            if timeout:
+                # Only the shell is killed here, not its children
+                timer = threading.Timer(timeout, process.kill)
+                timer.start()
+            (stdout, stderr) = process.communicate(input.encode('UTF-8') if input is not None else None)
+            exit_code        = process.wait()
+            if timer:
+                timer.cancel()
+
+        # Convert to str (Python 3)
+        stdout = stdout.decode(encoding='UTF-8')
+        stderr = stderr.decode(encoding='UTF-8')
 
     # Formatting..
     stdout = stdout[:-1] if (stdout and stdout[-1] == '\n') else stdout
     stderr = stderr[:-1] if (stderr and stderr[-1] == '\n') else stderr
 
-    # Output namedtuple
-    Output = namedtuple('Output', 'stdout stderr exit_code')
-
     if exit_code != 0:
         if capture:
             return Output(stdout, stderr, exit_code)
@@ -380,6 +589,8 @@ def os_shell(command, capture=False, verbose=False, interactive=False, silent=Fa
             return False    
     else:
         if capture:
+            if batch_caches['enabled'] and command_line.split(' ')[0:2] == ['docker', 'ps']:
+                batch_caches['containers'][command_line] = Output(stdout, stderr, exit_code)
             return Output(stdout, stderr, exit_code)
         elif not silent:
             # Just print stdout and stderr cleanly
@@ -416,6 +627,9 @@ def booleanize(*args, **kwargs):
 
 def get_required_env_vars(service):
     required_env_vars_file = SERVICES_IMAGES_DIR+'/'+service+'/required_env_vars.json'
+    return get_cached('metadata', required_env_vars_file, lambda: load_required_env_vars(required_env_vars_file), files=[required_env_vars_file])
+
+def load_required_env_vars(required_env_vars_file):
     if not os.path.isfile(required_env_vars_file):
         return []
     try:
@@ -446,12 +660,16 @@ def get_required_env_vars(service):
     logger.debug('Loaded required env vars: %s', required_env_vars)
     return required_env_vars
 
-def get_services_run_conf(conf_file=None):
-
-    conf_file = 'default.conf' if not conf_file else conf_file
-
+def get_conf_file(conf=None):
+    '''Get the file name of a conf (the default one if not set)'''
+    conf_file = 'default.conf' if not conf else conf
     if not conf_file.endswith('.conf'):
         conf_file = conf_file+'.conf'
+    return conf_file
+
+def get_services_run_conf(conf_file=None, expand_replicas=True):
+
+    conf_file = get_conf_file(conf_file)
     
     if os.path.isfile(PROJECT_DIR+'/'+conf_file):
         conf_file_path = PROJECT_DIR+'/'+conf_file
@@ -462,11 +680,22 @@ def get_services_run_conf(conf_file=None):
             raise IOError('No conf file {} found'.format(conf_file))
         else:
             return []
+
+    registered_services = get_cached('confs', conf_file_path, lambda: load_services_run_conf(conf_file_path), files=[conf_file_path])
+
+    # Expand the replicas
+    if expand_replicas:
+        registered_services = expand_services_replicas(registered_services)
+
+    # Ok return
+    return registered_services
+
+def load_services_run_conf(conf_file_path):
         
     # Now load it
     try:  
         with open(conf_file_path) as f:
-            logger.debug ('Loading conf from %s/%s', PROJECT_DIR, conf_file)
+            logger.debug ('Loading conf from %s', conf_file_path)
             content = f.read()#.replace('\n','').replace('  ',' ')
             json_content = []
             # Handle comments
@@ -493,17 +722,289 @@ def get_services_run_conf(conf_file=None):
     # Validate vars
     valid_service_description_keys = ['service','instance','publish_ports','persistent_data','persistent_opt', 'persistent_log', 'persistent_home',
                                       'links', 'sleep', 'env_vars', 'instance_type', 'volumes', 'nethost', 'safe_persistency','group', 'autorun',
-                                      'persistent_shared', 'extra_args', 'publish_ssh_on']
+                                      'persistent_shared', 'extra_args', 'publish_ssh_on',
+                                      'cpus', 'cpu_shares', 'memory', 'memory_reservation', 'blkio_weight', 'cpu_pinning', 'replicas']
     
     for service_description in registered_services:
         for key in service_description:
             # TODO: Chek minimal subset of required keys, like "service" and "instance" 
             if key not in valid_service_description_keys:
                 raise Exception('Error: key "{}" for "{}" service description is not valid'.format(key, service_description['service']))
+        validate_resources_limits(service_description)
+        if 'replicas' in service_description:
+            if not isinstance(service_description['replicas'], int) or isinstance(service_description['replicas'], bool) or service_description['replicas'] < 0:
+                raise Exception('Error: key "replicas" for "{}" service description must be a number, got "{}"'.format(service_description['service'], service_description['replicas']))
+            if not service_description.get('instance', None):
+                raise Exception('Error: key "replicas" for "{}" service description requires an instance name'.format(service_description['service']))
 
-    # Ok return
     return registered_services
+
+def expand_services_replicas(services_descriptions):
+    '''Expand the service descriptions with the "replicas" key in one description per replica. Replicas are named
+    after the instance with an index (i.e. "worker1", "worker2"...) and register on the DNS with the APPEND policy,
+    so that the service name resolves to all of them in round robin. The number of replicas set by the scale
+    command, if any, overrides the one of the conf.'''
+    replicas_overrides = load_host_conf().get('replicas', {})
+    expanded_services_descriptions = []
+    for service_description in services_descriptions:
+        if 'replicas' not in service_description:
+            expanded_services_descriptions.append(service_description)
+            continue
+        replicas = replicas_overrides.get('{}-{}'.format(service_description['service'], service_description['instance']), service_description['replicas'])
+        for i in range(1, replicas+1):
+            replica_description = dict(service_description)
+            del replica_description['replicas']
+            replica_description['instance'] = '{}{}'.format(service_description['instance'], i)
+            replica_description['env_vars'] = dict(service_description.get('env_vars', {}))
+            replica_description['env_vars'].setdefault('DNS_UPDATE_POLICY', 'APPEND')
+            expanded_services_descriptions.append(replica_description)
+
+    # Check for clashes between the replicas names and the other instances
+    names = [(service_description.get('service', None), service_description['instance']) for service_description in expanded_services_descriptions if service_description.get('instance', None)]
+    for name in set(names):
+        if names.count(name) > 1:
+            raise Exception('Error: service "{}", instance "{}" is defined more than once (check the replicas names)'.format(*name))
+    return expanded_services_descriptions
  
+def parse_memory_size(value):
+    '''Parse a memory size as Docker does (bytes, or a number with a b, k, m or g unit) and return it in bytes'''
+    units = {'b': 1, 'k': 1024, 'm': 1024**2, 'g': 1024**3}
+    value = str(value).strip().lower()
+    if value and value[-1] in units:
+        return int(float(value[:-1]) * units[value[-1]])
+    return int(value)
+
+def validate_resources_limits(service_description):
+    '''Validate the CPU, memory and I/O limits of a service description'''
+    where = 'for "{}" service description'.format(service_description.get('service', None))
+
+    def check_number(key, number_type, min_value, max_value=None):
+        if key in service_description:
+            try:
+                value = number_type(service_description[key])
+            except (TypeError, ValueError):
+                raise Exception('Error: key "{}" {} must be a number, got "{}"'.format(key, where, service_description[key]))
+            if value < min_value or (max_value is not None and value > max_value):
+                raise Exception('Error: key "{}" {} must be between {} and {}, got "{}"'.format(key, where, min_value, max_value if max_value is not None else 'any', value))
+
+    check_number('cpus', float, 0.01)
+    check_number('cpu_shares', int, 2, 262144)
+    check_number('blkio_weight', int, 10, 1000)
+    for key in ['memory', 'memory_reservation']:
+        if key in service_description:
+            try:
+                size = parse_memory_size(service_description[key])
+            except ValueError:
+                raise Exception('Error: key "{}" {} must be a size as "512m" or "2g", got "{}"'.format(key, where, service_description[key]))
+            # Docker requires at least 6 MB
+            if size < 6*1024**2:
+                raise Exception('Error: key "{}" {} must be at least 6m, got "{}"'.format(key, where, service_description[key]))
+    if 'memory' in service_description and 'memory_reservation' in service_description:
+        if parse_memory_size(service_description['memory_reservation']) > parse_memory_size(service_description['memory']):
+            raise Exception('Error: memory_reservation {} cannot be greater than memory'.format(where))
+    if 'cpu_pinning' in service_description:
+        cpu_pinning = service_description['cpu_pinning']
+        if not isinstance(cpu_pinning, bool) and not (isinstance(cpu_pinning, int) and cpu_pinning > 0):
+            raise Exception('Error: key "cpu_pinning" {} must be true/false or a number of cores, got "{}"'.format(where, cpu_pinning))
+
+def get_host_capacity():
+    '''Get the number of CPUs and the total memory (in bytes) of the host running the containers, asking the Docker
+    daemon first (on Mac and Windows this is the virtual machine) and falling back on the local ones.'''
+    facts = get_host_facts()
+    if facts['docker'] and facts['docker']['cpus'] and facts['docker']['memory']:
+        return (facts['docker']['cpus'], facts['docker']['memory'])
+    logger.debug('Cannot get the host capacity from the Docker daemon, using the local one')
+    return (facts['cpus'], dict(facts['memory_topology'])[None])
+
+def check_resources_reservations(services_confs):
+    '''Check that the sum of the CPU and memory reservations of a set of services fits the host capacity.
+    The memory reservation is the "memory_reservation" key if set, or the "memory" limit otherwise.'''
+    cpus = sum([float(service_conf['cpus']) for service_conf in services_confs if 'cpus' in service_conf])
+    memory = sum([parse_memory_size(service_conf.get('memory_reservation', service_conf.get('memory'))) for service_conf in services_confs
+                  if 'memory_reservation' in service_conf or 'memory' in service_conf])
+    if not cpus and not memory:
+        return
+    (host_cpus, host_memory) = get_host_capacity()
+    docker = get_host_facts()['docker']
+    if docker and memory and docker['memory_limit'] is False:
+        print('WARNING: the Docker daemon does not support memory limits, they will be ignored')
+    print('Resources reserved: {:g} CPUs of {}, {:.0f} MB of memory of {}'.format(cpus, host_cpus, memory/1048576.0,
+                                                                          '{:.0f} MB'.format(host_memory/1048576.0) if host_memory else 'unknown'))
+    if cpus > host_cpus:
+        abort('The CPUs reserved by the services ({:g}) exceed the ones available on the host ({})'.format(cpus, host_cpus))
+    if host_memory and memory > host_memory:
+        abort('The memory reserved by the services ({:.0f} MB) exceeds the one available on the host ({:.0f} MB)'.format(memory/1048576.0, host_memory/1048576.0))
+
+def parse_cpu_list(cpu_list):
+    '''Parse a Linux CPU list (i.e. "0-3,8,10-11") in a list of CPU numbers'''
+    cpus = []
+    for item in cpu_list.strip().split(','):
+        if '-' in item:
+            (first, last) = item.split('-')
+            cpus.extend(range(int(first), int(last)+1))
+        elif item:
+            cpus.append(int(item))
+    return cpus
+
+def format_cpu_list(cpus):
+    '''Format a list of CPU numbers as a Linux CPU list'''
+    ranges = []
+    for cpu in sorted(cpus):
+        if ranges and ranges[-1][1] == cpu-1:
+            ranges[-1][1] = cpu
+        else:
+            ranges.append([cpu, cpu])
+    return ','.join([str(first) if first == last else '{}-{}'.format(first, last) for (first, last) in ranges])
+
+def get_cpu_topology(sys_path='/sys/devices/system'):
+    '''Get the CPU topology of the host as an ordered dict of NUMA nodes, each one with the list of its cores,
+    each one with the list of its CPUs (hyperthreads). If the NUMA nodes are not exposed, a single node "None"
+    is returned. If the cores are not exposed either, every CPU is considered as a core.'''
+    nodes = OrderedDict()
+    node_dirs = sorted(glob.glob(sys_path+'/node/node[0-9]*'), key=lambda node_dir: int(node_dir.rsplit('node', 1)[1]))
+    for node_dir in node_dirs:
+        with open(node_dir+'/cpulist') as f:
+            cpus = parse_cpu_list(f.read())
+        if cpus:
+            nodes[int(node_dir.rsplit('node', 1)[1])] = cpus
+    if not nodes:
+        try:
+            with open(sys_path+'/cpu/online') as f:
+                nodes[None] = parse_cpu_list(f.read())
+        except IOError:
+            import multiprocessing
+            nodes[None] = list(range(multiprocessing.cpu_count()))
+
+    topology = OrderedDict()
+    for (node, cpus) in nodes.items():
+        topology[node] = []
+        for cpu in cpus:
+            if [core for core in topology[node] if cpu in core]:
+                continue
+            try:
+                with open('{}/cpu/cpu{}/topology/thread_siblings_list'.format(sys_path, cpu)) as f:
+                    topology[node].append([sibling for sibling in parse_cpu_list(f.read()) if sibling in cpus])
+            except IOError:
+                topology[node].append([cpu])
+    return topology
+
+def allocate_cpus(name, cores_count, cpu_pinning, topology):
+    '''Allocate a number of dedicated cores to an instance, given the current allocations (a dict of instance names
+    and CPU lists, updated in place) and the host CPU topology. The first CPU_PINNING_HOST_CORES cores are left to
+    the host. Cores are taken from a single NUMA node if possible, choosing the one with the least free cores
+    which still fits, to keep larger blocks available. Returns the allocated CPUs.'''
+
+    # Keep the current allocation, if still valid
+    host_cpus = [cpu for cores in topology.values() for core in cores for cpu in core]
+    if name in cpu_pinning:
+        current_cores = [core for cores in topology.values() for core in cores if set(core) & set(cpu_pinning[name])]
+        if len(current_cores) == cores_count and set(cpu_pinning[name]) <= set(host_cpus):
+            return cpu_pinning[name]
+        del cpu_pinning[name]
+
+    # Get the free cores per node
+    allocated_cpus = set([cpu for cpus in cpu_pinning.values() for cpu in cpus])
+    free_cores = OrderedDict()
+    host_cores = CPU_PINNING_HOST_CORES
+    for (node, cores) in topology.items():
+        free_cores[node] = []
+        for core in cores:
+            if host_cores > 0:
+                host_cores -= 1
+                continue
+            if not set(core) & allocated_cpus:
+                free_cores[node].append(core)
+
+    # Best fit on a single node, or spread across nodes
+    fitting_nodes = [node for node in free_cores if len(free_cores[node]) >= cores_count]
+    if fitting_nodes:
+        node = min(fitting_nodes, key=lambda node: len(free_cores[node]))
+        cores = free_cores[node][0:cores_count]
+    else:
+        cores = [core for node in free_cores for core in free_cores[node]][0:cores_count]
+        if len(cores) < cores_count:
+            abort('Cannot pin {} dedicated cores for "{}", only {} free (see reyns cpumap)'.format(cores_count, name, len(cores)))
+        print('WARNING: cannot pin {} dedicated cores for "{}" on a single NUMA node, spreading them across nodes'.format(cores_count, name))
+
+    cpu_pinning[name] = sorted([cpu for core in cores for cpu in core])
+    return cpu_pinning[name]
+
+def get_cpus_nodes(cpus, topology):
+    '''Get the NUMA nodes of a list of CPUs (empty if NUMA nodes are not exposed)'''
+    return [node for (node, cores) in topology.items() if node is not None and set(cpus) & set([cpu for core in cores for cpu in core])]
+
+def update_unpinned_cpusets(cpu_pinning, topology):
+    '''Restrict the existent instances which are not pinned (running or not) to the CPUs not dedicated to the pinned
+    ones, or to all the CPUs if none is, so that the dedicated cores are not shared with them. The instances with
+    their own CPU set (in the extra args, see CPUSET_CUSTOM_LABEL) are left as they are.'''
+    allocated_cpus = [cpu for cpus in cpu_pinning.values() for cpu in cpus]
+    free_cpus = [cpu for cores in topology.values() for core in cores for cpu in core if cpu not in allocated_cpus]
+    if not free_cpus:
+        print('WARNING: all the CPUs are dedicated to pinned instances, not restricting the other ones')
+        return
+    # The replacements of the pinned instances (see rolling rerun) share their cores
+    names = [name for name in get_project_containers() if (name[:-len('_rolling')] if name.endswith('_rolling') else name) not in cpu_pinning]
+    if names:
+        out = os_shell('docker ps -a --filter label={} --format "{{{{.Names}}}}"'.format(CPUSET_CUSTOM_LABEL), capture=True)
+        if out.exit_code != 0:
+            print(format_shell_error(out.stdout, out.stderr, out.exit_code))
+            abort('Cannot list the instances with their own CPU set')
+        custom = [name.strip()[len(PROJECT_NAME)+1:] for name in out.stdout.split('\n') if name.strip()]
+        names = [name for name in names if name not in custom]
+    if not names:
+        return
+    out = os_shell(['docker', 'update', '--cpuset-cpus={}'.format(format_cpu_list(free_cpus))] + [PROJECT_NAME+'-'+name for name in names], capture=True)
+    if out.exit_code != 0:
+        print(format_shell_error(out.stdout, out.stderr, out.exit_code))
+        print('WARNING: cannot restrict the instances which are not pinned to CPUs {}'.format(format_cpu_list(free_cpus)))
+    else:
+        print('Restricted {} instances which are not pinned to CPUs {}'.format(len(names), format_cpu_list(free_cpus)))
+
+def allocate_specs_cpus(specs):
+    '''Allocate the dedicated cores of the pinned instances of a set of instances (or release the ones of the
+    instances not pinned anymore) and save them in the host conf, before any container of the set is created,
+    so that the instances not pinned get only the cores not dedicated to any of them. Returns the host CPU topology,
+    or None if CPU pinning is not used.'''
+
+    host_conf = load_host_conf()
+    cpu_pinning = host_conf.get('cpu_pinning', {})
+    if not cpu_pinning and not [spec for spec in specs if spec['cpu_pinning']]:
+        return None
+    if not running_on_unix():
+        abort('Sorry, CPU pinning is supported only on Linux hosts')
+    docker = get_host_facts()['docker']
+    if docker and docker['cpuset'] is False:
+        abort('Sorry, the Docker daemon does not support CPU pinning (no cpuset cgroup)')
+    topology = get_host_cpu_topology()
+
+    # Release first, so that the released cores can be allocated again
+    previous_cpu_pinning = dict(cpu_pinning)
+    for spec in specs:
+        if not spec['cpu_pinning']:
+            cpu_pinning.pop('{}-{}'.format(spec['service'], spec['instance']), None)
+    for spec in specs:
+        if spec['cpu_pinning']:
+            allocate_cpus('{}-{}'.format(spec['service'], spec['instance']), spec['cpu_pinning'], cpu_pinning, topology)
+    if cpu_pinning != previous_cpu_pinning:
+        host_conf = load_host_conf()
+        host_conf['cpu_pinning'] = cpu_pinning
+        save_host_conf(host_conf)
+        # Take the dedicated cores away from (or give them back to) the existent instances which are not pinned
+        update_unpinned_cpusets(cpu_pinning, topology)
+    return topology
+
+def release_cpus(name):
+    '''Release the dedicated cores of an instance, if any, giving them back to the instances which are not pinned'''
+    host_conf = load_host_conf()
+    cpu_pinning = host_conf.get('cpu_pinning', {})
+    if name not in cpu_pinning:
+        return
+    print('Releasing CPUs {} of "{}"'.format(format_cpu_list(cpu_pinning[name]), name))
+    del cpu_pinning[name]
+    host_conf['cpu_pinning'] = cpu_pinning
+    save_host_conf(host_conf)
+    update_unpinned_cpusets(cpu_pinning, get_host_cpu_topology())
+
 def is_service_registered(service, conf=None):
     registered_services = get_services_run_conf(conf)   
     for registered_service in registered_services:
@@ -522,6 +1023,17 @@ def is_service_running(service, instance):
                 return True
     return False
 
+def remove_instance(service, instance, release=True):
+    '''Stop and remove an instance. If running, the instance is deregistered from the DNS first, as with the APPEND
+    update policy the service name would otherwise keep resolving to it as well. Its dedicated cores, if pinned,
+    are released unless its replacement is taking them over (see rolling rerun).'''
+    container = PROJECT_NAME+'-'+service+'-'+instance
+    os_shell(['docker', 'exec', container, 'bash', '-c', '[ ! -x /deregister-dns.sh ] || /deregister-dns.sh'], capture=True)
+    os_shell(['docker', 'stop', container], capture=True)
+    os_shell(['docker', 'rm', container], capture=True)
+    if release:
+        release_cpus('{}-{}'.format(service, instance))
+
 def service_exits_but_not_running(service, instance):
     '''Returns True if the service is existent but not running, False otherwise'''  
     running = info(service=service, instance=instance, capture=True)
@@ -592,6 +1104,10 @@ def get_service_ip(service, instance):
 
 # Find dependencies recursive function
 def find_dependencies(service_dir):
+    dockerfile = SERVICES_IMAGES_DIR+'/'+service_dir+'/Dockerfile'
+    return get_cached('metadata', dockerfile, lambda: load_dependencies(service_dir), files=[dockerfile])
+
+def load_dependencies(service_dir):
     with open(SERVICES_IMAGES_DIR+'/'+service_dir+'/Dockerfile') as f:
         content = f.read()
         for line in content.split('\n'):
@@ -606,6 +1122,417 @@ def find_dependencies(service_dir):
                         return []
 
 
+def get_dockerfile_sources(dockerfile_content):
+    '''Return the list of the build context sources used by the COPY and ADD instructions of a Dockerfile,
+    or None if they cannot be computed (i.e. if they use build args or env vars).'''
+    sources = []
+
+    # Join continuation lines and remove comments
+    lines = []
+    current_line = ''
+    for line in dockerfile_content.split('\n'):
+        if line.strip().startswith('#'):
+            continue
+        if line.rstrip().endswith('\\'):
+            current_line += line.rstrip()[:-1] + ' '
+        else:
+            lines.append(current_line + line)
+            current_line = ''
+    lines.append(current_line)
+
+    for line in lines:
+        line = line.strip()
+        instruction = line.split(' ')[0].upper()
+        if instruction not in ['COPY', 'ADD']:
+            continue
+        args = line[len(instruction):].strip()
+        
+        # Handle flags (i.e. --chown=reyns:reyns). Copying from other stages or images does not use the context.
+        from_stage = False
+        while args.startswith('--'):
+            flag = args.split(' ')[0]
+            if flag.startswith('--from='):
+                from_stage = True
+            args = args[len(flag):].strip()
+        if from_stage:
+            continue
+
+        # Handle both the JSON and the plain form
+        if args.startswith('['):
+            try:
+                args = json.loads(args)
+            except ValueError:
+                return None
+        else:
+            args = args.split()
+
+        for source in args[:-1]:
+            if '$' in source:
+                return None
+            if instruction == 'ADD' and re.match(r'^[a-z]+://', source):
+                continue
+            source = source.lstrip('/')
+            while source.startswith('./'):
+                source = source[2:]
+            sources.append(source if source else '.')
+    return sources
+
+
+def load_dockerignore(context_dir):
+    '''Return the list of the .dockerignore patterns of a context dir, if any'''
+    patterns = []
+    try:
+        with open(context_dir + '/.dockerignore') as f:
+            for line in f.read().split('\n'):
+                line = line.strip()
+                if not line or line.startswith('#'):
+                    continue
+                negated = line.startswith('!')
+                pattern = os.path.normpath(line.lstrip('!').strip().lstrip('/'))
+                patterns.append((pattern, negated))
+    except IOError:
+        pass
+    return patterns
+
+
+def is_dockerignored(path, patterns):
+    '''Check if a path (relative to the context) is excluded by the .dockerignore patterns. As in
+    Docker, the last matching pattern wins and a path is excluded if any of its parents is.'''
+    ignored = False
+    path_pieces = path.split('/')
+    for pattern, negated in patterns:
+        for i in range(1, len(path_pieces)+1):
+            if fnmatch.fnmatchcase('/'.join(path_pieces[0:i]), pattern) or (pattern.startswith('**/') and fnmatch.fnmatchcase('/'.join(path_pieces[0:i]), pattern[3:])):
+                ignored = not negated
+                break
+    return ignored
+
+
+def get_build_context_paths(context_dir, dockerfile, minimal=True):
+    '''Get the list of the paths of a build context (relative to the context dir) honouring the .dockerignore file,
+    if any. If minimal is set, only the Dockerfile and the sources used by its COPY and ADD instructions are included,
+    and None is returned if these cannot be computed.'''
+
+    dockerignore_patterns = load_dockerignore(context_dir)
+    paths = set([dockerfile])
+
+    if minimal:
+        with open(context_dir + '/' + dockerfile) as f:
+            sources = get_dockerfile_sources(f.read())
+        if sources is None:
+            return None
+
+        # Expand the sources into the list of the files to include
+        for source in sources:
+            for source_path in glob.glob(os.path.join(context_dir, source)):
+                if os.path.isdir(source_path) and not os.path.islink(source_path):
+                    for root, dirs, files in os.walk(source_path):
+                        for name in dirs + files:
+                            paths.add(os.path.relpath(os.path.join(root, name), context_dir))
+                source_path = os.path.relpath(source_path, context_dir)
+                if source_path != '.':
+                    paths.add(source_path)
+
+        # Add parent dirs as well
+        for path in list(paths):
+            while '/' in path:
+                path = path.rsplit('/', 1)[0]
+                paths.add(path)
+    else:
+        for root, dirs, files in os.walk(context_dir):
+            for name in dirs + files:
+                paths.add(os.path.relpath(os.path.join(root, name), context_dir))
+
+    return sorted([path for path in paths if path == dockerfile or not is_dockerignored(path, dockerignore_patterns)])
+
+
+def make_build_context(context_dir, dockerfile):
+    '''Make a minimal build context tar archive, containing only the Dockerfile and the sources used by its
+    COPY and ADD instructions (honouring the .dockerignore file, if any). Returns a namedtuple with the archive
+    path, its size and the number of files, or None if the sources cannot be computed.'''
+
+    paths = get_build_context_paths(context_dir, dockerfile)
+    if paths is None:
+        return None
+
+    # Create the archive (uid/gid are reset as the Docker client does, to preserve the build cache)
+    def reset_owner(tarinfo):
+        tarinfo.uid = tarinfo.gid = 0
+        tarinfo.uname = tarinfo.gname = ''
+        return tarinfo
+
+    (fd, context_path) = tempfile.mkstemp(prefix='reyns_context_', suffix='.tar')
+    os.close(fd)
+    with tarfile.open(context_path, 'w') as context_tar:
+        for path in paths:
+            context_tar.add(os.path.join(context_dir, path), arcname=path, recursive=False, filter=reset_owner)
+
+    BuildContext = namedtuple('BuildContext', 'path size files')
+    return BuildContext(context_path, os.path.getsize(context_path), len(paths))
+
+
+def make_dockerignore(context_dir, dockerfile):
+    '''Make the content of a .dockerignore file excluding everything but the Dockerfile and the sources used by its
+    COPY and ADD instructions, or return None if these cannot be computed.'''
+    with open(context_dir + '/' + dockerfile) as f:
+        sources = get_dockerfile_sources(f.read())
+    if sources is None:
+        return None
+    lines = ['# Generated by Reyns: only the Dockerfile and the sources used by its COPY and ADD instructions', '*', '!' + dockerfile]
+    for source in sources:
+        if source == '.':
+            return None
+        if '!' + source not in lines:
+            lines.append('!' + source)
+    return '\n'.join(lines) + '\n'
+
+
+def get_image_digest(image):
+    '''Get a digest of the content of an image which is the same on every host, pulling the image if not found: its
+    repository digest if it was pulled from (or pushed to) a registry, its ID otherwise. Returns None if not found.'''
+    for attempt in range(2):
+        out = os_shell('docker inspect --type=image --format "{{json .RepoDigests}} {{.Id}}" ' + image, capture=True)
+        if out.exit_code == 0:
+            (repo_digests, image_id) = out.stdout.strip().rsplit(' ', 1)
+            # The same image can be in more repositories, use only the digest part of the first one
+            repo_digests = sorted([repo_digest.split('@')[-1] for repo_digest in json.loads(repo_digests) or []])
+            return repo_digests[0] if repo_digests else image_id
+        if attempt == 0:
+            print('Pulling the base image "{}" to compute the build cache tag...'.format(image))
+            if os_shell('docker pull ' + image, capture=True).exit_code != 0:
+                return None
+    return None
+
+def get_build_hash(context_dir, dockerfile, build_args, base_image_digest):
+    '''Compute a content-addressed hash for a build, from the build context files used by the Dockerfile (names,
+    types, executable bits and contents), the build args and the digest of the base image (see get_image_digest).
+    Full permissions and times are not included, as they differ across hosts for the same sources.'''
+
+    paths = get_build_context_paths(context_dir, dockerfile)
+    if paths is None:
+        paths = get_build_context_paths(context_dir, dockerfile, minimal=False)
+
+    build_hash = hashlib.sha256('{}\n{}\n'.format(build_args, base_image_digest).encode('utf-8'))
+    for path in paths:
+        full_path = os.path.join(context_dir, path)
+        if os.path.islink(full_path):
+            build_hash.update('{} link {}\n'.format(path, os.readlink(full_path)).encode('utf-8'))
+        elif os.path.isdir(full_path):
+            build_hash.update('{} dir\n'.format(path).encode('utf-8'))
+        else:
+            build_hash.update('{} file {}\n'.format(path, bool(os.stat(full_path).st_mode & 0o111)).encode('utf-8'))
+            with open(full_path, 'rb') as f:
+                for chunk in iter(lambda: f.read(1048576), b''):
+                    build_hash.update(chunk)
+    return build_hash.hexdigest()
+
+
+def get_buildkit_steps(output):
+    '''Parse the BuildKit plain progress output and return the list of the Dockerfile steps,
+    as dicts with the step name, if it was cached and how long it took to build.'''
+    steps = OrderedDict()
+    for line in output.split('\n'):
+        line = line.strip()
+        # i.e. "#5 [2/4] RUN apt-get update" or "#7 [stage-1 3/5] COPY . /app"
+        match = re.match(r'^#(\d+) (\[[^\]]*\d+/\d+\] .*)$', line)
+        if match:
+            steps.setdefault(match.group(1), {'name': match.group(2), 'cached': False, 'time': None})
+            continue
+        match = re.match(r'^#(\d+) CACHED$', line)
+        if match and match.group(1) in steps:
+            steps[match.group(1)]['cached'] = True
+            continue
+        match = re.match(r'^#(\d+) DONE (\S+)$', line)
+        if match and match.group(1) in steps:
+            steps[match.group(1)]['time'] = match.group(2)
+    return list(steps.values())
+
+
+#--------------------------
+# Host facts
+#--------------------------
+
+# Host facts, loaded once per process (see get_host_facts)
+host_facts = OrderedDict()
+
+def get_interfaces():
+    '''Get the IPv4 and IPv6 addresses of all the network interfaces of the host, as an ordered dict of
+    interface names and dicts with the "ipv4" and "ipv6" lists of addresses.'''
+    interfaces = OrderedDict()
+    if running_on_osx():
+        interface = None
+        for line in os_shell('ifconfig', capture=True).stdout.split('\n'):
+            if line and not line[0].isspace():
+                interface = line.split(':')[0]
+                interfaces[interface] = {'ipv4': [], 'ipv6': []}
+            elif interface and line.strip().split(' ')[0] in ['inet', 'inet6']:
+                (family, address) = line.strip().split()[0:2]
+                interfaces[interface]['ipv4' if family == 'inet' else 'ipv6'].append(address.split('%')[0])
+    elif running_on_unix():
+        out = os_shell('ip -o addr show', capture=True)
+        if out.exit_code == 0:
+            for line in out.stdout.split('\n'):
+                items = line.split()
+                if len(items) < 4 or items[2] not in ['inet', 'inet6']:
+                    continue
+                interface = items[1].split('@')[0]
+                interfaces.setdefault(interface, {'ipv4': [], 'ipv6': []})
+                interfaces[interface]['ipv4' if items[2] == 'inet' else 'ipv6'].append(items[3].split('/')[0])
+        else:
+            # No iproute2, use the ioctl for the IPv4 addresses and the proc filesystem for the IPv6 ones
+            logger.debug('Cannot list the network interfaces with "ip", using ioctl and /proc')
+            for interface in sorted(os.listdir('/sys/class/net')):
+                interfaces[interface] = {'ipv4': [], 'ipv6': []}
+                try:
+                    interfaces[interface]['ipv4'].append(get_ip_address(interface))
+                except Exception:
+                    pass
+            try:
+                with open('/proc/net/if_inet6') as f:
+                    for line in f:
+                        items = line.split()
+                        address = ':'.join([items[0][i:i+4] for i in range(0, 32, 4)])
+                        address = socket.inet_ntop(socket.AF_INET6, socket.inet_pton(socket.AF_INET6, address))
+                        interfaces.setdefault(items[5], {'ipv4': [], 'ipv6': []})['ipv6'].append(address)
+            except IOError:
+                pass
+    return interfaces
+
+def get_memory_topology(sys_path='/sys/devices/system'):
+    '''Get the total memory (in bytes) of the host and of each of its NUMA nodes, if exposed, as an ordered dict
+    with the "None" key for the host.'''
+    memory = OrderedDict()
+    try:
+        memory[None] = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    except (AttributeError, ValueError, OSError):
+        memory[None] = None
+    for node_dir in sorted(glob.glob(sys_path+'/node/node[0-9]*'), key=lambda node_dir: int(node_dir.rsplit('node', 1)[1])):
+        try:
+            with open(node_dir+'/meminfo') as f:
+                for line in f:
+                    # i.e. "Node 0 MemTotal:       16314748 kB"
+                    if 'MemTotal:' in line:
+                        memory[int(node_dir.rsplit('node', 1)[1])] = int(line.split()[-2])*1024
+        except (IOError, ValueError):
+            pass
+    return memory
+
+def get_docker_facts():
+    '''Get the version and the capabilities of the Docker daemon, or None if it cannot be reached'''
+    out = os_shell('docker info --format "{{json .}}"', capture=True)
+    try:
+        if out.exit_code == 0:
+            info = json.loads(out.stdout)
+            return OrderedDict([('version', info.get('ServerVersion')), ('os', info.get('OperatingSystem')),
+                                ('os_type', info.get('OSType')), ('architecture', info.get('Architecture')),
+                                ('kernel_version', info.get('KernelVersion')), ('cpus', info.get('NCPU')),
+                                ('memory', info.get('MemTotal')), ('storage_driver', info.get('Driver')),
+                                ('cgroup_driver', info.get('CgroupDriver')), ('cgroup_version', info.get('CgroupVersion')),
+                                ('cpuset', info.get('CPUSet')), ('cpu_shares', info.get('CPUShares')),
+                                ('memory_limit', info.get('MemoryLimit')), ('swap_limit', info.get('SwapLimit'))])
+    except (ValueError, AttributeError):
+        pass
+    logger.debug('Cannot get the Docker daemon facts (%s)', out.stderr)
+    return None
+
+def gather_host_facts():
+    '''Gather the host facts, see get_host_facts()'''
+    import multiprocessing
+    facts = OrderedDict()
+    facts['version']         = VERSION
+    facts['timestamp']       = time.time()
+    facts['hostname']        = socket.gethostname()
+    facts['platform']        = platform.system()
+    facts['interfaces']      = get_interfaces()
+    facts['cpus']            = multiprocessing.cpu_count()
+    # Stored as lists of [node, value] as NUMA nodes can be None, which is not a valid JSON key
+    facts['cpu_topology']    = [[node, cores] for (node, cores) in get_cpu_topology().items()]
+    facts['memory_topology'] = [[node, memory] for (node, memory) in get_memory_topology().items()]
+    facts['docker']          = get_docker_facts()
+    return facts
+
+def get_host_facts(refresh=False):
+    '''Get the facts about the host: hostname, network interfaces (IPv4 and IPv6), CPU and memory topology and
+    Docker daemon capabilities. They are gathered once and cached in the project dir for HOST_FACTS_TTL seconds,
+    unless refresh is set.'''
+    if host_facts and not refresh:
+        return host_facts
+    facts = None
+    if not refresh:
+        try:
+            with open(HOST_FACTS_FILE) as f:
+                facts = json.load(f, object_pairs_hook=OrderedDict)
+        except (IOError, ValueError):
+            logger.debug('No valid cached host facts in %s', HOST_FACTS_FILE)
+        else:
+            # The project dir can be shared among hosts, i.e. over NFS
+            if (facts.get('version') != VERSION or facts.get('hostname') != socket.gethostname()
+                or not 0 <= time.time() - facts.get('timestamp', 0) < HOST_FACTS_TTL):
+                logger.debug('Cached host facts in %s are outdated', HOST_FACTS_FILE)
+                facts = None
+    if facts is None:
+        facts = gather_host_facts()
+        try:
+            with open(HOST_FACTS_FILE+'.tmp', 'w') as f:
+                json.dump(facts, f, indent=4, separators=(',', ': '))
+            os.rename(HOST_FACTS_FILE+'.tmp', HOST_FACTS_FILE)
+        except (IOError, OSError) as e:
+            logger.debug('Cannot cache host facts in %s (%s)', HOST_FACTS_FILE, e)
+    host_facts.clear()
+    host_facts.update(facts)
+    return host_facts
+
+def get_host_cpu_topology():
+    '''Get the CPU topology of the host from its facts, see get_cpu_topology()'''
+    return OrderedDict([(node, cores) for (node, cores) in get_host_facts()['cpu_topology']])
+
+def get_interface_ip(interface):
+    '''Get the (first) IPv4 address of a network interface from the host facts. If not found, the facts are
+    refreshed once, as the interface could have just been brought up.'''
+    for refresh in [False, True]:
+        interfaces = get_host_facts(refresh=refresh)['interfaces']
+        if interface in interfaces and interfaces[interface]['ipv4']:
+            return interfaces[interface]['ipv4'][0]
+    if not interfaces:
+        # Cannot enumerate the interfaces on this platform, ask for this one
+        return get_ip_address(interface)
+    raise IOError('Network interface "{}" not found or without an IPv4 address'.format(interface))
+
+def print_host_facts(facts):
+    memory = OrderedDict([(node, node_memory) for (node, node_memory) in facts['memory_topology']])
+    numa_nodes = [node for (node, _) in facts['cpu_topology'] if node is not None]
+    print('Host "{}" ({}), facts gathered {:.0f}s ago'.format(facts['hostname'], facts['platform'], time.time()-facts['timestamp']))
+    print('  CPUs:       {}{}'.format(facts['cpus'], ' on {} NUMA nodes'.format(len(numa_nodes)) if numa_nodes else ''))
+    print('  Memory:     {}{}'.format('{:.0f} MB'.format(memory[None]/1048576.0) if memory.get(None) else 'unknown',
+                                      ' ({})'.format(', '.join(['node {}: {:.0f} MB'.format(node, memory[node]/1048576.0) for node in memory if node is not None])) if len(memory) > 1 else ''))
+    print('  Interfaces:')
+    for (interface, addresses) in facts['interfaces'].items():
+        print('    {:<12} {}'.format(interface, ', '.join(addresses['ipv4'] + addresses['ipv6']) or '-'))
+    docker = facts['docker']
+    if not docker:
+        print('  Docker:     not reachable')
+        return
+    print('  Docker:     {} ({}/{}, {} storage{}), {} CPUs, {:.0f} MB'.format(docker['version'], docker['os_type'], docker['architecture'], docker['storage_driver'],
+                                                                      ', cgroup v{} {}'.format(docker['cgroup_version'], docker['cgroup_driver']) if docker['cgroup_version'] else '',
+                                                                      docker['cpus'], (docker['memory'] or 0)/1048576.0))
+    print('  Limits:     {}'.format(', '.join(['{} {}'.format(name, 'yes' if docker[key] else 'no') for (key, name) in
+                                              [('cpuset', 'CPU pinning'), ('cpu_shares', 'CPU shares'), ('memory_limit', 'memory'), ('swap_limit', 'swap')]])))
+
+def check_docker_version(facts):
+    '''Check the version of the Docker daemon against the minimum one required (1.9.0)'''
+    if facts['docker'] and facts['docker']['version']:
+        if [int(number) for number in re.findall(r'\d+', facts['docker']['version'])[0:3]] < [1, 9, 0]:
+            print('WARNING: Docker {} is not supported, Reyns requires Docker > 1.9.0'.format(facts['docker']['version']))
+
+#task
+def facts(refresh=False):
+    '''Show the host facts (network interfaces, CPU and memory topology, Docker capabilities) used by Reyns.
+    If refresh is set, gather them again instead of using the cached ones.'''
+    current_facts = get_host_facts(refresh=booleanize(refresh=refresh))
+    print_host_facts(current_facts)
+    check_docker_version(current_facts)
+
+
 #--------------------------
 # Installation management
 #--------------------------
@@ -621,10 +1548,19 @@ def uninstall(how=''):
     os_shell(os.getcwd()+'/uninstall.sh {}'.format(how), interactive=True)
 
 #task
-def version():
+def version(format='text'):
     '''Get Reyns version'''
+    check_output_format(format)
     
     last_commit_info = os_shell('cd ' + os.getcwd() + ' && git log | head -n3', capture=True).stdout
+    if format != 'text':
+        record = OrderedDict([('version', VERSION), ('commit', None), ('commit_date', None)])
+        if last_commit_info:
+            last_commit_info_lines = last_commit_info.split('\n')
+            record['commit'] = last_commit_info_lines[0].split(' ')[1][0:7]
+            record['commit_date'] = last_commit_info_lines[-1].replace('Date:', '').strip()
+        print_records([record], format)
+        return
     if not last_commit_info:
         print('Reyns v0.10.0')
     else:
@@ -705,11 +1641,27 @@ def init(os_to_init='ubuntu14.04', verbose=False, cache=False):
                 print(format_shell_error(out.stdout, out.stderr, out.exit_code))
                 abort('Something wrong happened, see output above')
 
+    # Update the load balancer service as well, if present
+    if os_to_init in ['ubuntu14.04', 'ubuntu18.04']:
+        if os_shell('docker inspect reyns/reyns-lb', capture=True).exit_code == 0:
+            print('Updating load balancer service as well...')
+            build(service='reyns-lb-{}'.format(os_to_init), cache=cache, verbose=verbose)
+            out = os_shell('docker tag reyns/reyns-lb-{} reyns/reyns-lb'.format(os_to_init), capture=True)
+            if out.exit_code != 0:
+                print(format_shell_error(out.stdout, out.stderr, out.exit_code))
+                abort('Something wrong happened, see output above')
+
+
 
+# Shared build cache hits and misses, for the build summary
+build_cache_stats = {'hits': 0, 'misses': 0}
 
 #task
-def build(service=None, verbose=False, cache=True, relative=True, fromall=False, built=[]):
-    '''Build a given service. If service name is set to "all" then builds all the services'''
+def build(service=None, verbose=False, cache=True, relative=True, fromall=False, built=[], nodeps=False, backend='classic', prune_context=False, registry=None):
+    '''Build a given service. If service name is set to "all" then builds all the services. The build backend
+    can be the "classic" Docker one or "buildkit" (which supports cache mounts and parallel stages). If a registry
+    is set (or the BUILD_CACHE_REGISTRY env var), it is used as a shared build cache. If prune_context is set, only
+    the files used by the Dockerfile are sent as build context (see make_build_context).'''
 
     # Sanitize...
     (service, _) = sanity_checks(service)
@@ -720,6 +1672,14 @@ def build(service=None, verbose=False, cache=True, relative=True, fromall=False,
     # Backcomp #TODO: remove 'verbose'
     if verbose:
         verbose = True
+
+    # Check build backend
+    if backend not in ['classic', 'buildkit']:
+        abort('Unknown build backend "{}", supported ones are "classic" and "buildkit"'.format(backend))
+
+    # Shared build cache registry
+    if not registry:
+        registry = BUILD_CACHE_REGISTRY
     
     if service.upper()=='ALL':
 
@@ -743,14 +1703,16 @@ def build(service=None, verbose=False, cache=True, relative=True, fromall=False,
                     for dependent_service in dependencies:
                         if dependent_service not in built:
                             # Build by recursively calling myself
-                            build(service=dependent_service, verbose=verbose, cache=cache, fromall=True, built=built)
+                            build(service=dependent_service, verbose=verbose, cache=cache, fromall=True, built=built, backend=backend, prune_context=prune_context, registry=registry)
                             built.append(dependent_service)
-                build(service=service, verbose=verbose, cache=cache, fromall=True)
+                build(service=service, verbose=verbose, cache=cache, fromall=True, backend=backend, prune_context=prune_context, registry=registry)
                 built.append(service)
                     
             except IOError:
                 pass
 
+        print_build_cache_summary(registry)
+
     else:
         # Build a given service
         service_dir = get_service_dir(service)
@@ -760,8 +1722,8 @@ def build(service=None, verbose=False, cache=True, relative=True, fromall=False,
             logger.debug('Not building service "{}" as "no_autobuild" file present.'.format(service))
             return
 
-        # Build dependencies if not from all
-        if not is_base_service(service) and not fromall:
+        # Build dependencies if not from all (or explicitly asked not to)
+        if not is_base_service(service) and not fromall and not nodeps:
             dependencies = find_dependencies(service)
             if dependencies:
                 logger.debug('Service %s depends on: %s',service_dir, dependencies)
@@ -772,7 +1734,7 @@ def build(service=None, verbose=False, cache=True, relative=True, fromall=False,
                 for dependent_service in dependencies:
                     if dependent_service not in built:
                         # Build by recursively calling myself
-                        build(service=dependent_service, verbose=verbose, cache=cache, fromall=True, built=built)
+                        build(service=dependent_service, verbose=verbose, cache=cache, fromall=True, built=built, backend=backend, prune_context=prune_context, registry=registry)
                         built.append(dependent_service)
                 print ('Done, now building the service:\n')
                         
@@ -789,12 +1751,16 @@ def build(service=None, verbose=False, cache=True, relative=True, fromall=False,
         if not image:
             abort('Missing "FROM" in Dockerfile?!')
 
+        # Cache mounts and other BuildKit-only features require the BuildKit backend
+        if backend != 'buildkit' and re.search(r'^RUN\s+--mount=', content, re.MULTILINE):
+            abort('The Dockerfile uses "RUN --mount" which requires the BuildKit backend, use build:{},backend=buildkit'.format(service))
+
         # If reyns's 'FROM' images doe not existe, build them
         if image.startswith('reyns/'):
             logger.debug('Checking image "{}"...'.format(image))
             if os_shell('docker inspect {}'.format(image), capture=True).exit_code != 0:
                 print('Could not find Reyns base image "{}", will build it.\n'.format(image))
-                build(service=image.split('/')[1], verbose=verbose, cache=cache)
+                build(service=image.split('/')[1], verbose=verbose, cache=cache, backend=backend, prune_context=prune_context, registry=registry)
 
             else:
                 logger.debug('Found Reyns base image "{}", will not build it.'.format(image))
@@ -823,6 +1789,7 @@ def build(service=None, verbose=False, cache=True, relative=True, fromall=False,
         # Automatically set buildinguser/group args. This is experimental and only for Linux, since
         # Mac remaps everything on the user running Docker and Windows has no uid/gid support in Python.
         # Moreover, this is useless with safe persistency on. TODO: Do we want to keep this?
+        # With the shared build cache they are part of the cache key, so images are shared only with the same args.
         set_user_uid_gid_args = ''
         if running_on_unix():
             import pwd, grp
@@ -853,40 +1820,335 @@ def build(service=None, verbose=False, cache=True, relative=True, fromall=False,
             # Strip trailing space
             set_user_uid_gid_args = set_user_uid_gid_args.strip()
 
-        # Build command
+        # Build context location
         if relative:
-            if not cache:
-                print('Building without cache')
-                build_command = 'cd ' + service_dir + '/.. &&' + ' docker build ' + set_user_uid_gid_args + ' --no-cache -t ' + tag_prefix +'/' + service + ' ' + service_dir
-            else:
-                print('Building with cache')
-                build_command = 'cd ' + service_dir + '/.. &&' + ' docker build ' + set_user_uid_gid_args + ' -t ' + tag_prefix +'/' + service + ' ' + service_dir
+            context_dir = service_dir
+            dockerfile  = 'Dockerfile'
+        else:
+            context_dir = '.'
+            dockerfile  = service_dir + '/Dockerfile'
+
+        # Shared build cache: if an image built from the very same inputs is in the registry, use it
+        if registry:
+            cache_image = registry.rstrip('/') + '/' + tag_prefix + '/' + service
+            base_image_digest = get_image_digest(image)
+            if not base_image_digest:
+                abort('Cannot find or pull the base image "{}" to compute the build cache tag'.format(image))
+            cache_tag = cache_image + ':' + get_build_hash(context_dir, dockerfile, set_user_uid_gid_args, base_image_digest)[0:32]
+            logger.debug('Build cache tag: "{}"'.format(cache_tag))
+            if cache:
+                pull_start = time.time()
+                # No need to pull if already here (i.e. built or pulled before on this host)
+                if os_shell('docker image inspect ' + cache_tag, capture=True).exit_code == 0:
+                    found = 'found locally'
+                elif os_shell('docker pull ' + cache_tag, capture=True).exit_code == 0:
+                    found = 'pulled'
+                else:
+                    found = None
+                if found:
+                    if os_shell('docker tag ' + cache_tag + ' ' + tag_prefix + '/' + service, capture=True).exit_code != 0:
+                        abort('Error in tagging "{}" as "{}/{}"'.format(cache_tag, tag_prefix, service))
+                    build_cache_stats['hits'] += 1
+                    print('Build cache hit, {} "{}" (took {:.1f}s)\n'.format(found, cache_tag, time.time()-pull_start))
+                    if not fromall:
+                        print_build_cache_summary(registry)
+                    return
+            build_cache_stats['misses'] += 1
+            print('Build cache miss for "{}"'.format(cache_tag))
+
+        # Build backend. BuildKit progress output is set to plain to be able to parse it.
+        if backend == 'buildkit':
+            docker_build = 'docker build --progress=plain'
         else:
-            if not cache:
-                print('Building without cache')
-                build_command = 'docker build  ' + set_user_uid_gid_args + ' --no-cache -f '+ service_dir + '/Dockerfile -t ' + tag_prefix +'/' + service + ' .'
+            docker_build = 'docker build'
+
+        # Build context. If pruning, only the files used by the Dockerfile are sent to the daemon.
+        build_context = None
+        if booleanize(prune_context=prune_context):
+            context_start = time.time()
+            build_context = make_build_context(context_dir, dockerfile)
+            if build_context:
+                print('Build context: {} files, {:.2f} MB (prepared in {:.2f}s)'.format(build_context.files, build_context.size/1048576.0, time.time()-context_start))
+                if build_context.size > BUILD_CONTEXT_WARNING_MB * 1048576:
+                    print('WARNING: the build context is larger than {} MB, you might want to check the COPY/ADD instructions or to add a .dockerignore file in "{}"'.format(BUILD_CONTEXT_WARNING_MB, context_dir))
             else:
-                print('Building with cache')
-                build_command = 'docker build ' + set_user_uid_gid_args + ' -f '+ service_dir + '/Dockerfile -t ' + tag_prefix +'/' + service + ' .'
-                
+                logger.info('Cannot compute the minimal build context for service "%s" (sources with variables?), sending the whole context', service)
+
+        # Build command
+        build_command = docker_build + ' ' + set_user_uid_gid_args
+        if not cache:
+            print('Building without cache')
+            build_command += ' --no-cache'
+        else:
+            print('Building with cache')
+
+            # Use the latest image in the registry as cache source. BuildKit needs the cache metadata inlined.
+            if registry and os_shell('docker pull ' + cache_image + ':latest', capture=True).exit_code == 0:
+                build_command += ' --cache-from ' + cache_image + ':latest'
+                if backend == 'buildkit':
+                    build_command += ' --build-arg BUILDKIT_INLINE_CACHE=1'
+        if build_context:
+            build_command += ' -f ' + dockerfile + ' -t ' + tag_prefix + '/' + service + ' - < ' + build_context.path
+        elif relative:
+            build_command = 'cd ' + service_dir + '/.. && ' + build_command + ' -t ' + tag_prefix + '/' + service + ' ' + service_dir
+        else:
+            build_command += ' -f ' + dockerfile + ' -t ' + tag_prefix + '/' + service + ' .'
                            
         logger.debug('Build command: "{}"'.format(build_command))    
         
         # Build
         print('Building...')
-        if verbose:
-            if os_shell(build_command, verbose=True):
-                print('Build OK\n')
-            else:
-                print('')
-                abort('Something wrong happened, see output above. Reminder: in case of remote repositories errors (i.e. 404 Not Found) try to build without cache to refresh remote repositories lists (i.e. build:all,cache=False)')
-        else:
-            if os_shell(build_command, verbose=False, capture=False, silent=True):
-                print('Build OK\n')
+        build_start = time.time()
+        try:
+            run_build_command(build_command, backend, verbose)
+        finally:
+            if build_context:
+                os.remove(build_context.path)
+        print('Build OK (took {:.1f}s)\n'.format(time.time()-build_start))
+
+        # Push to the shared build cache. Errors here are not fatal, the image is built anyway.
+        if registry:
+            push_start = time.time()
+            for tag in [cache_tag, cache_image + ':latest']:
+                out = os_shell('docker tag ' + tag_prefix + '/' + service + ' ' + tag + ' && docker push ' + tag, capture=True)
+                if out.exit_code != 0:
+                    print('WARNING: could not push "{}" to the build cache registry: {}\n'.format(tag, (out.stderr or out.stdout).strip()))
+                    break
             else:
-                abort('Something wrong happened, see output above. Reminder: in case of remote repositories errors (i.e. 404 Not Found) try to build without cache to refresh remote repositories lists (i.e. build:all,cache=False)')
+                print('Pushed to the build cache registry (took {:.1f}s)\n'.format(time.time()-push_start))
+            if not fromall:
+                print_build_cache_summary(registry)
+
+
+def print_build_cache_summary(registry):
+    if registry:
+        print('Build cache summary: {} hits, {} misses (registry "{}")\n'.format(build_cache_stats['hits'], build_cache_stats['misses'], registry))
+
+
+def run_build_command(build_command, backend='classic', verbose=False):
+    '''Execute a build command with the given backend, aborting on errors'''
+
+    build_error_message = 'Something wrong happened, see output above. Reminder: in case of remote repositories errors (i.e. 404 Not Found) try to build without cache to refresh remote repositories lists (i.e. build:all,cache=False)'
+
+    if backend == 'buildkit':
+
+        # Enable BuildKit trough the env of the build command only (works on every platform, and does not affect
+        # the commands run concurrently), and always capture the output to parse it
+        build_env = dict(os.environ)
+        build_env['DOCKER_BUILDKIT'] = '1'
+        out = os_shell(build_command, capture=True, env=build_env)
+
+        if out.exit_code != 0:
+            print(format_shell_error(out.stdout, out.stderr, out.exit_code))
+            abort(build_error_message)
+        if verbose:
+            print(out.stdout)
+            print(out.stderr)
+
+        # Report per-step cache hits
+        steps = get_buildkit_steps(out.stdout + '\n' + out.stderr)
+        for step in steps:
+            print('  {}: {}'.format(step['name'], 'CACHED' if step['cached'] else 'built in {}'.format(step['time']) if step['time'] else 'built'))
+        print('{} of {} steps from cache'.format(len([step for step in steps if step['cached']]), len(steps)))
+
+    elif verbose:
+        if not os_shell(build_command, verbose=True):
+            print('')
+            abort(build_error_message)
+    else:
+        if not os_shell(build_command, verbose=False, capture=False, silent=True):
+            abort(build_error_message)
+
+
+def get_dir_snapshot(dirs):
+    '''Return a dict with modification time and size for every file in the given dirs'''
+    snapshot = {}
+    for dir in dirs:
+        for root, _, files in os.walk(dir):
+            for file in files:
+                path = os.path.join(root, file)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                snapshot[path] = (stat.st_mtime, stat.st_size)
+    return snapshot
+
+def get_file_digest(path):
+    '''Return the SHA1 digest of the content of a file, "dir" for a directory or None if not found'''
+    if os.path.isdir(path):
+        return 'dir'
+    try:
+        with open(path, 'rb') as f:
+            return hashlib.sha1(f.read()).hexdigest()
+    except (IOError, OSError):
+        return None
+
+def watch_changes(dirs, debounce=1.0, poll_interval=1.0):
+    '''Generator yielding the list of paths changed in the given dirs, once changes stop for "debounce"
+    seconds. Uses inotify (trough the inotifywait utility) if available, otherwise falls back on polling.
+    Changes happening while the caller is processing the yielded list are kept and yielded next. Files whose
+    content did not change (i.e. only touched, as the build does with the prestartup scripts) are not yielded.'''
+
+    inotifywait = None
+    if running_on_unix() and os_shell('which inotifywait', capture=True).exit_code == 0:
+        inotifywait = subprocess.Popen(['inotifywait', '-m', '-r', '-q', '--format', '%w%f',
+                                        '-e', 'close_write', '-e', 'create', '-e', 'delete', '-e', 'move'] + dirs,
+                                       stdout=subprocess.PIPE)
+        logger.debug('Watching %s using inotify', dirs)
+    else:
+        logger.info('Could not find "inotifywait" (inotify-tools), falling back on polling for changes')
+
+    try:
+        snapshot = get_dir_snapshot(dirs)
+        digests = dict([(path, get_file_digest(path)) for path in snapshot])
+        if inotifywait:
+            snapshot = None
+        buffer = b''
+        while True:
+            changed = set()
+            last_change = None
+            while True:
+                if inotifywait:
+                    # Do not use readline() here, as buffered data would not be seen by select()
+                    if select.select([inotifywait.stdout], [], [], 0.2)[0]:
+                        data = os.read(inotifywait.stdout.fileno(), 65536)
+                        if not data:
+                            abort('The inotifywait process exited unexpectedly')
+                        buffer += data
+                        lines = buffer.split(b'\n')
+                        buffer = lines.pop()
+                        for line in lines:
+                            changed.add(line.decode('utf-8'))
+                        last_change = time.time()
+                else:
+                    sleep(poll_interval)
+                    new_snapshot = get_dir_snapshot(dirs)
+                    for path in set(snapshot) | set(new_snapshot):
+                        if snapshot.get(path) != new_snapshot.get(path):
+                            changed.add(path)
+                            last_change = time.time()
+                    snapshot = new_snapshot
+
+                # Changes settled down?
+                if changed and (time.time() - last_change) >= debounce:
+                    # Only the ones with a different content count
+                    for path in list(changed):
+                        digest = get_file_digest(path)
+                        if digest == digests.get(path):
+                            changed.discard(path)
+                        digests[path] = digest
+                    if changed:
+                        break
+                    last_change = None
+
+            # What changed while the caller is processing (i.e. building) is found in the next round
+            yield sorted(changed)
+    finally:
+        if inotifywait:
+            inotifywait.terminate()
+
+
+#task
+def dockerignore(service=None, force=False):
+    '''Generate the .dockerignore file of a service from its Dockerfile, so that only the Dockerfile and the sources
+    used by its COPY and ADD instructions are sent to Docker as build context, as Docker itself excludes the others'''
+
+    # Sanitize...
+    if not service or service in ['all', 'reallyall']:
+        abort('You must provide the name of the service to generate the .dockerignore file for')
+    if is_base_service(service):
+        abort('Sorry, base services share the Reyns directory as build context and cannot have their own .dockerignore file')
+    service_dir = get_service_dir(service, onlychecking=True)
+    if not os.path.isfile(service_dir + '/Dockerfile'):
+        abort('No Dockerfile found (?!) I was looking in {}'.format(service_dir + '/Dockerfile'))
+
+    # Switches
+    force = booleanize(force=force)
+
+    if os.path.exists(service_dir + '/.dockerignore') and not force:
+        abort('A .dockerignore file already exists in "{}", use force=True to overwrite it'.format(service_dir))
+
+    content = make_dockerignore(service_dir, 'Dockerfile')
+    if content is None:
+        abort('Cannot compute the sources used by the Dockerfile of service "{}" (sources with variables, or the whole context copied?)'.format(service))
+
+    with open(service_dir + '/.dockerignore', 'w') as f:
+        f.write(content)
+    print('Generated "{}/.dockerignore", including only: {}'.format(service_dir, ', '.join([line[1:] for line in content.strip().split('\n') if line.startswith('!')])))
+
+
+#task
+def watch(service=None, instance=None, debounce=1, cache=True, verbose=False, backend='classic'):
+    '''Watch a service (and its project-level parents) for changes, and rebuild and rerun it when they happen.
+    Only the affected images are rebuilt, and only the instances using them are re-run.'''
+
+    # Sanitize...
+    if not service or service in ['all', 'reallyall']:
+        abort('You must provide the name of the service to watch')
+    if is_base_service(service):
+        abort('Sorry, watching base services is not supported')
+    if not os.path.exists(get_service_dir(service, onlychecking=True)):
+        abort('I cannot find source directory for this service ("{}"). Are you in the project\'s root? I was looking for "{}".'.format(service, get_service_dir(service, onlychecking=True)))
+
+    # Switches
+    verbose = booleanize(verbose=verbose)
+
+    # Image chain, from the farthest parent to the service itself
+    chain = find_dependencies(service) or []
+    chain.reverse()
+    chain.append(service)
+    chain_dirs = [get_service_dir(item, onlychecking=True) for item in chain]
+    
+    print('Watching service "{}" for changes (image chain: {}). Press Ctrl-C to stop.\n'.format(service, ' -> '.join(chain)))
+
+    changes = watch_changes(chain_dirs, debounce=float(debounce))
+    try:
+        for changed_paths in changes:
+
+            # Find the farthest image of the chain affected by the changes
+            first_changed = None
+            for i, chain_dir in enumerate(chain_dirs):
+                if [path for path in changed_paths if path.startswith(chain_dir + '/')]:
+                    first_changed = i
+                    break
+            if first_changed is None:
+                continue
+            to_rebuild = chain[first_changed:]
+            
+            print('Detected {} changed file(s) in "{}", now rebuilding {}...\n'.format(len(changed_paths), chain[first_changed], to_rebuild))
+            cycle_start = time.time()
+            try:
+                # Rebuild the affected images only, in order
+                for item in to_rebuild:
+                    build(service=item, verbose=verbose, cache=cache, built=[], nodeps=True, backend=backend)
+                build_time = time.time() - cycle_start
+
+                # Rerun the instances using the rebuilt images
+                rerun_start = time.time()
+                reruns = 0
+                for item in to_rebuild:
+                    for (running_service, running_instance) in get_running_services_instances_matching(item):
+                        if running_service != item:
+                            continue
+                        if instance and (running_service != service or running_instance != instance):
+                            continue
+                        rerun(running_service, running_instance)
+                        reruns += 1
+                rerun_time = time.time() - rerun_start
+                
+                print('\nCycle completed in {:.1f}s (build: {:.1f}s, rerun of {} instance(s): {:.1f}s). Waiting for changes...\n'.format(time.time() - cycle_start, build_time, reruns, rerun_time))
 
+            except (SystemExit, ReynsError) as e:
+                # Do not stop watching on errors, just wait for the next fix
+                if isinstance(e, ReynsError):
+                    print('Got fatal error: {}.'.format(e))
+                print('Cycle failed after {:.1f}s, see output above. Waiting for changes...\n'.format(time.time() - cycle_start))
 
+    except KeyboardInterrupt:
+        print('\nStopped watching.')
+    finally:
+        changes.close()
 
 
 #task
@@ -933,164 +2195,190 @@ def stop(service,instance=None):
 
 
 #task
-def rerun(service, instance=None):
-    '''Re-run a given service (instance is not mandatory if only one is running)'''
-    running_instances = get_running_services_instances_matching(service,instance)
-    if len(running_instances) == 0:
-        if instance:
-            abort('Could not find any instance named "{}" for service "{}"'.format(instance, service))   
-        else:
-            abort('Could not find any running instance of service matching "{}"'.format(service))                
-    if len(running_instances) > 1:
-        abort('Found more than one running instance for service "{}": {}, please specity wich one.'.format(service, running_instances))            
-    service = running_instances[0][0]
-    instance  = running_instances[0][1]
+def rerun(service=None, instance=None, group=None, rolling=False, surge=1, conf=None):
+    '''Re-run a given service (instance is not mandatory if only one is running) or the running instances of a group.
+    In rolling mode, every instance is replaced only once its replacement is ready, with up to "surge" replacements
+    at the same time. Persistent instances and the ones using ports on the host are handed over instead: their
+    replacement is created in advance, and started as soon as they are stopped.'''
+
+    # Switches
+    rolling = booleanize(rolling=rolling)
 
     # Load host conf 
     host_conf = load_host_conf()
+    if not conf:
+        conf = host_conf.get('last_conf', None)
 
-    # Clean    
-    clean(service,instance)
-    
-    # Re-run with the right conf
-    try:
-        last_conf = host_conf['last_conf']
-        run(service,instance,from_rerun=True, conf=last_conf)
-    except KeyError:
-        run(service,instance,from_rerun=True)
-    
-
-
-# TODO: clarify difference between False and None.
-#task
-def run(service=None, instance=None, group=None, instance_type=None, interactive=None, 
-        persistent_data=None, persistent_opt=None, persistent_log=None, persistent_home=None,
-        publish_ports=None, linked=None, seed_command=None, conf=None, safemode=None,
-        recursive=False, from_rerun=False, nethost=None, extra_args=None, publish_ssh_on=None):
-    '''Run a given service with a given instance. If no instance name is set,
-    a standard instance with a random name is run. If service name is set to "all"
-    then all the services are run, according to the conf.'''
+    # Get the instances to re-run
+    if group:
+        try:
+            services_confs = get_services_run_conf(conf)
+        except Exception as e:
+            abort('Got error in reading run conf: {}.'.format(e))
+        running_instances = get_running_project_instances()
+        instances = [(service_conf['service'], service_conf['instance']) for service_conf in services_confs
+                     if service_conf['instance'] and (group == 'all' or service_conf.get('group', None) == group)
+                     and (service_conf['service'], service_conf['instance']) in running_instances]
+        if not instances:
+            abort('Could not find any running instance for group "{}"'.format(group))
+    else:
+        if not service:
+            abort('Please give the service or the group to re-run')
+        running_instances = get_running_services_instances_matching(service,instance)
+        if len(running_instances) == 0:
+            if instance:
+                abort('Could not find any instance named "{}" for service "{}"'.format(instance, service))   
+            else:
+                abort('Could not find any running instance of service matching "{}"'.format(service))                
+        if len(running_instances) > 1:
+            abort('Found more than one running instance for service "{}": {}, please specity wich one.'.format(service, running_instances))            
+        instances = [(running_instances[0][0], running_instances[0][1])]
 
-    #------------------------
-    # Handle conf(s)
-    #------------------------
+    if not rolling:
+        for (service, instance) in instances:
 
-    # Load host conf 
-    host_conf = load_host_conf()
+            # Clean    
+            clean(service,instance)
     
-    # Handle last run conf
-    try:
-        last_conf = host_conf['last_conf']
-        #if not conf:
-        #    conf = last_conf
-    except KeyError:
-        if conf:
-            host_conf['last_conf'] = conf
-            save_host_conf(host_conf)
-    else:
-        if last_conf != conf:
-            host_conf['last_conf'] = conf
-            save_host_conf(host_conf)
+            # Re-run with the right conf
+            run(service,instance,from_rerun=True, conf=conf)
+        return
 
-    if not recursive:
-        print('Conf being used: "{}"'.format('default' if not conf else conf))
-    
-    #---------------------------
-    # Run a group of services
-    #---------------------------
-    if service == 'all' or group:
-        
-        if service == 'all':
-            #print('WARNING: using the magic keyword "all" is probably going to be deprecated, use group=all instead.')
-            group = 'all'
-        
-        print('\nRunning services in {} for group {}'.format(SERVICES_IMAGES_DIR,group))
+    # Rolling re-run. Check all the instances before replacing anything.
+    if not isinstance(surge, int) or isinstance(surge, bool) or surge < 1:
+        abort('The surge must be a positive number, got "{}"'.format(surge))
+    handovers = [(service, instance) for (service, instance) in instances if check_rolling_rerun(service, instance)]
 
-        if safemode or interactive:
-            abort('Sorry, you cannot set one of the "safemode" or "interactive" switches if you are running more than one service') 
+    for i in range(0, len(instances), surge):
+        batch = instances[i:i+surge]
 
-        # Load run conf             
+        # Start the replacements under a temporary name and wait for them to be ready. The ones handed over are
+        # created first, and started right after having stopped the instances they replace.
+        stopped = []
         try:
-            services_to_run_confs = get_services_run_conf(conf)
-        except Exception as e:
-            abort('Got error in reading run conf for automated execution: {}.'.format(e))
+            for (service, instance) in batch:
+                print('\n{} the replacement of service "{}", instance "{}"...'.format('Creating' if (service, instance) in handovers else 'Starting', service, instance))
+                run(service, instance, from_rerun=True, conf=conf, container_name=get_rolling_container_name(service, instance),
+                    handover=(service, instance) in handovers)
+            handover_start = time.time()
+            for (service, instance) in [item for item in batch if item in handovers]:
+                print('\nHanding over service "{}", instance "{}" to its replacement...'.format(service, instance))
+                container = PROJECT_NAME + '-' + service + '-' + instance
+                os_shell(['docker', 'exec', container, 'bash', '-c', '[ ! -x /deregister-dns.sh ] || /deregister-dns.sh'], capture=True)
+                out = os_shell(['docker', 'stop', container], capture=True)
+                stopped.append((service, instance))
+                if out.exit_code == 0:
+                    out = os_shell(['docker', 'start', get_rolling_container_name(service, instance)], capture=True)
+                if out.exit_code != 0:
+                    print(format_shell_error(out.stdout, out.stderr, out.exit_code))
+                    abort('Cannot hand over service "{}", instance "{}" to its replacement'.format(service, instance))
+                if not wait_for_prestartup(get_rolling_container_name(service, instance)):
+                    abort('Error in the prestartup phase of the replacement of service "{}", instance "{}". Check output above'.format(service, instance))
+            for (service, instance) in batch:
+                wait_for_instance_ready(get_rolling_container_name(service, instance))
+            if stopped:
+                print('Handed over in {:.1f}s'.format(time.time()-handover_start))
+        except BaseException:
+            # Also on Ctrl-C, not to leave the replacements around and the original instances stopped
+            cancel_shell_commands()
+            print('Rolling re-run stopped, removing the replacements and leaving the original instances running.')
+            for (service, instance) in batch:
+                os_shell(['docker', 'rm', '-f', get_rolling_container_name(service, instance)], capture=True)
+            for (service, instance) in stopped:
+                print('Starting again service "{}", instance "{}"...'.format(service, instance))
+                os_shell(['docker', 'start', PROJECT_NAME + '-' + service + '-' + instance], capture=True)
+            update_load_balancers()
+            raise
+
+        # Switch over: register the replacements on the DNS, remove the old instances and give their names to the replacements
+        for (service, instance) in batch:
+            os_shell(['docker', 'exec', get_rolling_container_name(service, instance), 'bash', '-c', '[ ! -f /mydnsdata ] || /usr/bin/nsupdate -t 5 -k /etc/rndc.key -v /mydnsdata'], capture=True)
+            remove_instance(service, instance, release=False)
+            out = os_shell('docker rename ' + get_rolling_container_name(service, instance) + ' ' + PROJECT_NAME + '-' + service + '-' + instance, capture=True)
+            if out.exit_code != 0:
+                print(format_shell_error(out.stdout, out.stderr, out.exit_code))
+                abort('Cannot rename the replacement of service "{}", instance "{}"'.format(service, instance))
+            print('Replaced service "{}", instance "{}"'.format(service, instance))
+        update_load_balancers()
 
-        if not services_to_run_confs:
-            
-            # TODO: Move this in a separate routine (duplicate from beginning of get_services_run_conf)
-            conf_file = 'default.conf' if not conf else conf
-            if not conf_file.endswith('.conf'):
-                conf_file = conf_file + '.conf'
-            
-            abort('No or empty conf file (looking for "{}"), are you in the project\'s root?'.format(conf_file))
-        
-        for service_conf in services_to_run_confs:
-            
-            # Check for service group.
-            # We will run the service if:
-            # a) the group is set to 'all'
-            # b) the group is set to 'x' and the service group is 'x'            
-            if group != 'all':
-                if 'group' in service_conf:
-                    if service_conf['group'] != group:
-                        continue
-                else:
-                    continue
-            else:
-                if 'autorun' in service_conf:
-                    if not service_conf['autorun']:
-                        continue
-                
-            # Check for service name
-            if 'service' not in service_conf:
-                abort('Missing service name for conf: {}'.format(service_conf))
-            else:
-                service = service_conf['service']
-              
-            # Check for instance name
-            if 'instance' not in service_conf:
-                abort('Missing instance name for conf: {}'.format(service_conf))
-            else:
-                instance = service_conf['instance']
 
-            # Handle the instance type.
-            if 'instance_type' in service_conf:
-                instance_type = service_conf['instance_type']
-            else:
-                instance_type = None
-
-            # Recursively call myself with proper args. The args of the call always win over the configuration(s)
-            run(service         = service,
-                instance        = instance,
-                instance_type   = instance_type,
-                persistent_data = persistent_data if persistent_data is not None else (service_conf['persistent_data'] if 'persistent_data' in service_conf else None),
-                persistent_log  = persistent_log  if persistent_log  is not None else (service_conf['persistent_log']  if 'persistent_log'  in service_conf else None),
-                persistent_opt  = persistent_opt  if persistent_opt  is not None else (service_conf['persistent_opt']  if 'persistent_opt'  in service_conf else None),
-                persistent_home = persistent_home if persistent_home is not None else (service_conf['persistent_home'] if 'persistent_home' in service_conf else None),
-                publish_ports   = publish_ports   if publish_ports   is not None else (service_conf['publish_ports']   if 'publish_ports'   in service_conf else None),
-                linked          = linked          if linked          is not None else (service_conf['linked']          if 'linked'          in service_conf else None),
-                interactive     = interactive,
-                safemode        = safemode,
-                conf            = conf,
-                extra_args      = extra_args,
-                recursive       = True)
-                
-        # Exit
-        return
+def get_rolling_container_name(service, instance):
+    return '{}-{}-{}_rolling'.format(PROJECT_NAME, service, instance)
 
-    #-----------------------
-    # Run a given service
-    #-----------------------
-    
-    # Sanitize...
-    (service, instance) = sanity_checks(service, instance)
+
+def check_rolling_rerun(service, instance):
+    '''Check if an instance can be replaced while still running. Returns False if so, True if its replacement has to
+    take over from it (handover) as it is persistent (the two containers would share the same data), it publishes
+    ports on the host or it uses the host networking (they would clash).'''
+    out = os_shell('docker inspect ' + PROJECT_NAME + '-' + service + '-' + instance, capture=True)
+    if out.exit_code != 0:
+        print(format_shell_error(out.stdout, out.stderr, out.exit_code))
+        abort('Cannot inspect service "{}", instance "{}"'.format(service, instance))
+    inspect_json = json.loads(out.stdout)[0]
+    for mount in inspect_json.get('Mounts', []):
+        if mount.get('Destination', None) in ['/persistent', '/safe_persistent']:
+            print('Service "{}", instance "{}" is persistent, its replacement will take over from it'.format(service, instance))
+            return True
+    port_bindings = inspect_json['HostConfig'].get('PortBindings', None) or {}
+    if running_on_osx():
+        # The SSH port is published on a random port on OSX
+        port_bindings.pop('22/tcp', None)
+    if port_bindings or inspect_json['HostConfig'].get('NetworkMode', None) == 'host':
+        print('Service "{}", instance "{}" uses ports on the host ({}), its replacement will take over from it'.format(service, instance,
+              ', '.join(sorted(port_bindings.keys())) if port_bindings else 'host networking'))
+        return True
+    return False
+
+
+def get_container_inspect(container_name):
+    '''Get the inspect data of a container (see docker inspect), aborting if not found'''
+    out = os_shell(['docker', 'inspect', container_name], capture=True)
+    if out.exit_code != 0:
+        print(format_shell_error(out.stdout, out.stderr, out.exit_code))
+        abort('Cannot inspect "{}"'.format(container_name))
+    return json.loads(out.stdout)[0]
+
+def wait_for_instance_ready(container_name):
+    '''Wait for all the Supervisor programs of an instance to be running (or exited), up to ROLLING_READY_TIMEOUT seconds.
+    Instances not running Supervisor (i.e. with a custom seed command) are waited for their healthcheck to pass, if
+    any, or for their container to be running otherwise.'''
+    print('Waiting for "{}" to be ready...'.format(container_name))
+    command = (get_container_inspect(container_name).get('Config', None) or {}).get('Cmd', None)
+    supervisor = command is None or 'supervisord' in [os.path.basename(arg) for arg in command]
+    start = time.time()
+    while True:
+        if supervisor:
+            out = os_shell('docker exec ' + container_name + ' supervisorctl status', capture=True)
+            status = out.stdout
+            states = [line.split()[1] for line in out.stdout.split('\n') if len(line.split()) > 1]
+            failed = [state for state in states if state in ['FATAL', 'BACKOFF', 'UNKNOWN']]
+            ready = states and not [state for state in states if state not in ['RUNNING', 'EXITED']]
+        else:
+            state = get_container_inspect(container_name).get('State', {})
+            health = (state.get('Health', None) or {}).get('Status', None)
+            status = 'Container status: {}{}'.format(state.get('Status', None), ', health: {}'.format(health) if health else '')
+            failed = health == 'unhealthy' or state.get('Status', None) in ['exited', 'dead']
+            ready = state.get('Running', False) and health in [None, 'healthy']
+        if failed:
+            print(status)
+            abort('Instance "{}" is not healthy, see {} above'.format(container_name, 'Supervisor status' if supervisor else 'its status'))
+        if ready:
+            print('Ready (took {:.1f}s)'.format(time.time()-start))
+            return
+        if time.time() - start > ROLLING_READY_TIMEOUT:
+            print(status)
+            abort('Timeout of {}s reached waiting for "{}" to be ready'.format(ROLLING_READY_TIMEOUT, container_name))
+        sleep(1)
+
+
+# TODO: clarify difference between False and None.
+def check_instance_to_run(service, instance, replacement=False):
+    '''Check that an instance can be run, building the Reyns' DNS and load balancer images if missing. Returns
+    False if the instance is already running. A replacement (see rolling rerun) is always run.'''
 
     # Layout
     print('')
 
-    # Set service dir
-    service_dir = get_service_dir(service)
-
     # Chek if we have to build a Reyns a missing service, and specifically the DNS
     if service == 'reyns-dns' :
         if os_shell('docker inspect reyns/reyns-dns', capture=True).exit_code != 0:
@@ -1101,25 +2389,111 @@ def run(service=None, instance=None, group=None, instance_type=None, interactive
                 print(format_shell_error(out.stdout, out.stderr, out.exit_code))
                 abort('Something wrong happened, see output above')
 
+    # ..and the load balancer
+    if service == 'reyns-lb' :
+        if os_shell('docker inspect reyns/reyns-lb', capture=True).exit_code != 0:
+            print('\nMissing load balancer service, now building it...')
+            build(service='reyns-lb-ubuntu14.04')
+            out = os_shell('docker tag reyns/reyns-lb-ubuntu14.04 reyns/reyns-lb', capture=True)
+            if out.exit_code != 0:
+                print(format_shell_error(out.stdout, out.stderr, out.exit_code))
+                abort('Something wrong happened, see output above')
+
     # Run a specific service
     print('Running service "{}" ("{}/{}"), instance "{}"...'.format(service, PROJECT_NAME, service, instance))
 
     # Check if this service is exited
-    if service_exits_but_not_running(service,instance):
+    if not replacement and service_exits_but_not_running(service,instance):
 
         abort('Service "{0}", instance "{1}" exists but it is not running, I cannot start it since the linking ' \
               'would be end up broken. Use reyns clean:{0},instance={1} to clean it and start over clean, ' \
               'or reyns _start:{0},instance={1} if you know what you are doing.'.format(service,instance))
 
     # Check if this service is already running
-    if is_service_running(service,instance):
+    if not replacement and is_service_running(service,instance):
         print('Service is already running, not starting.')
-        # Exit
-        return    
+        return False
+
+    return True
+
+
+def resolve_env_var(name, value, host_conf, resolution=None):
+    '''Resolve the value of an env var for running an instance: the env has always the precedence, then
+    the value automatically set (if any), then the host conf. As last resort, the user is asked for it.'''
+
+    env_value = os.getenv(name, None)
+    if env_value:
+        logger.debug('Found env var %s with value "%s"', name, env_value)
+        if value is not None:
+            print('WARNING: I am overriding atomaticaly set env var {} (value="{}") and I will use value "{}" as I found it in the env'.format(name, value, env_value))
+        value = env_value
+
+    if value is None:
+        logger.debug('Evaluating required ENV_VAR %s', name)
+
+        # Try to see if we can set this var according to the conf
+        if name in host_conf:
+            logger.debug('Loading ENV_VAR %s from host.conf', name)
+            value = host_conf[name]
+        else:
+            logger.debug('ENV_VAR %s not found even in host.conf, now asking the user', name)
+            if not PROMPTS_ENABLED:
+                abort('No value for the required ENV VAR "{}", export it or set it in host.conf'.format(name))
+
+            # Ask the user for the value of this var
+            host_conf[name] = ask('Please enter a value for the required ENV VAR "{}" (or export it before launching): '.format(name))
+            value = host_conf[name]
+
+            # Do we have to save the value for using it the next time?
+            answer = ''
+            while answer.lower() not in ['y','n']:
+                answer = ask('Should I save this value in host.conf for beign automatically used the next time? (y/n): ')
+
+            if answer == 'y':
+                # Then, dump the conf
+                save_host_conf(host_conf)
+            elif resolution is not None:
+                resolution.setdefault('unsaved', []).append(name)
+
+    # Handle the special case for *_IP var names, which can be set using a function
+    if name.endswith('_IP') and str(value).startswith('from_'):
+
+        # Obtain interface
+        interface = str(value).split('_')[-1]
+        logger.debug('Found function for %s: from(\'%s\').', name, interface)
+
+        try:
+            value = get_interface_ip(str(interface)) # Note: cast unicode to string..
+        except IOError:
+            abort('Error: network interface {} set in {} does not exist on the host'.format(interface, name))
+
+        logger.debug('Updating value for %s with IP address %s', name, value)
+        if resolution is not None:
+            resolution.setdefault('interfaces', {})[interface] = value
+
+    return value
+
+
+def get_run_spec(service, instance, instance_type=None, interactive=None,
+                 persistent_data=None, persistent_opt=None, persistent_log=None, persistent_home=None,
+                 publish_ports=None, linked=None, seed_command=None, conf=None, safemode=None,
+                 nethost=None, extra_args=None, publish_ssh_on=None, force_prestartup=None,
+                 container_name=None, host_conf=None, resolution=None):
+    '''Resolve everything needed to run an instance (switches, env vars, volumes, ports, annotations) in a spec,
+    which is a JSON-serializable dict. What depends on the state of the host at run time (the links to the running
+    instances, the data dirs, the CPU pinning) is just declared and handled by run_spec(). Returns None if the user
+    chose not to proceed. The values resolved from network interfaces and the env vars asked to the user and not
+    saved in the host conf are reported in the resolution dict, if given.'''
+
+    if host_conf is None:
+        host_conf = load_host_conf()
+
+    # Set service dir
+    service_dir = get_service_dir(service)
 
     # Init service conf, requested env vars and privileged switch
     service_conf = None
-    ENV_VARs     = {}
+    ENV_VARs     = OrderedDict()
     privileged   = False
 
     # Add to the ENV_VARs the ones specified in the required.env_vars.json file
@@ -1128,18 +2502,18 @@ def run(service=None, instance=None, group=None, instance_type=None, interactive
 
     # Check if this service is listed in the run conf:
     if is_service_registered(service, conf):
-        
+
         # If the service is registered, the the rules of the run conf applies, so:
 
         # 1) Read the conf if any
         try:
             services_to_run_confs = get_services_run_conf(conf)
         except Exception as e:
-            abort('Got error in reading run conf for loading service info: {}.'.format(e))        
-    
+            abort('Got error in reading run conf for loading service info: {}.'.format(e))
+
         for item in services_to_run_confs:
             # The configuration for a given service is ALWAYS applied.
-            # TODO: Allow to have different confs per different instances? Could be useful for linking a node with a given server. 
+            # TODO: Allow to have different confs per different instances? Could be useful for linking a node with a given server.
             # i.e. node instance A with server instance A, node instance B with server instance B.
             if instance:
                 if (service == item['service'] and instance == item['instance']):
@@ -1152,8 +2526,8 @@ def run(service=None, instance=None, group=None, instance_type=None, interactive
         if not service_conf:
             conf_file = conf if conf else 'default'
             if not confirm('WARNING: Could not find conf for service {}, instance {} in the conf in use ("{}"). Should I proceed?'.format(service, instance, conf_file)):
-                return
-        
+                return None
+
         # 2) Handle the instance type.
         if service_conf and not instance_type:
             if 'instance_type' in service_conf:
@@ -1166,23 +2540,23 @@ def run(service=None, instance=None, group=None, instance_type=None, interactive
                     instance_type = service_conf['instance']
                 else:
                     instance_type = 'standard'
-                                          
+
         # 3) Now, enumerate the vars required by this service:
-        if service_conf and 'env_vars' in service_conf:     
+        if service_conf and 'env_vars' in service_conf:
             for env_var in service_conf['env_vars']:
                 ENV_VARs[env_var] = service_conf['env_vars'][env_var]
 
     # Set emptu service_conf dict to avoid looking up in a None object
     if not isinstance(service_conf,dict):
         service_conf={}
- 
+
     # Prelminary set of switches
     persistent_data = persistent_data if persistent_data is not None else (service_conf['persistent_data'] if 'persistent_data' in service_conf else None)
     persistent_log  = persistent_log  if persistent_log  is not None else (service_conf['persistent_log']  if 'persistent_log'  in service_conf else None)
     persistent_opt  = persistent_opt  if persistent_opt  is not None else (service_conf['persistent_opt']  if 'persistent_opt'  in service_conf else None)
     persistent_home = persistent_home if persistent_home is not None else (service_conf['persistent_home'] if 'persistent_home'  in service_conf else None)
     publish_ports   = publish_ports   if publish_ports   is not None else (service_conf['publish_ports']   if 'publish_ports'   in service_conf else None)
-    linked          = linked          if linked          is not None else (service_conf['linked']          if 'linked'          in service_conf else None)               
+    linked          = linked          if linked          is not None else (service_conf['linked']          if 'linked'          in service_conf else None)
     nethost         = nethost         if nethost         is not None else (service_conf['nethost']         if 'nethost'         in service_conf else None)
 
     # Handle the instance type.
@@ -1201,7 +2575,7 @@ def run(service=None, instance=None, group=None, instance_type=None, interactive
     persistent_data = setswitch(persistent_data=persistent_data, instance_type=instance_type)
     persistent_log  = setswitch(persistent_log=persistent_log, instance_type=instance_type)
     persistent_opt  = setswitch(persistent_opt=persistent_opt, instance_type=instance_type)
-    persistent_home = setswitch(persistent_home=persistent_home, instance_type=instance_type)    
+    persistent_home = setswitch(persistent_home=persistent_home, instance_type=instance_type)
     publish_ports   = setswitch(publish_ports=publish_ports, instance_type=instance_type)
     interactive     = setswitch(interactive=interactive, instance_type=instance_type)
     safemode        = setswitch(safemode=safemode, instance_type=instance_type)
@@ -1215,35 +2589,43 @@ def run(service=None, instance=None, group=None, instance_type=None, interactive
     ENV_VARs['PERSISTENT_OPT']  = persistent_opt
     ENV_VARs['PERSISTENT_HOME'] = persistent_home
     ENV_VARs['SAFEMODE']        = safemode
-    ENV_VARs['HOST_HOSTNAME']   = socket.gethostname()
-            
-    # Start building run command
-    if nethost:
-        run_cmd = 'docker run --name {}-{}-{} --net host'.format(PROJECT_NAME, service,instance)
-    else:
-        run_cmd = 'docker run --name {}-{}-{} '.format(PROJECT_NAME, service,instance)
-
-    # Handle linking...
+    ENV_VARs['FORCE_PRESTARTUP']= booleanize(force_prestartup=force_prestartup) if force_prestartup is not None else False
+    ENV_VARs['HOST_HOSTNAME']   = get_host_facts()['hostname']
+
+    # Replacements are registered on the DNS only once ready (see rolling rerun)
+    if container_name:
+        ENV_VARs['DNS_DEFER_UPDATE'] = True
+
+    # Init the spec
+    spec = OrderedDict()
+    spec['service']        = service
+    spec['instance']       = instance
+    spec['instance_type']  = instance_type
+    spec['container_name'] = container_name if container_name else '{}-{}-{}'.format(PROJECT_NAME, service, instance)
+    spec['nethost']        = bool(nethost)
+    spec['links']          = []
+
+    # Handle linking. The running instances to link are looked up at run time.
     if linked:
         if service_conf and 'links' in service_conf:
             for link in service_conf['links']:
 
                 if not link:
                     continue
-              
+
                 # Handle link shortcut
-                if isinstance(link, str) or isinstance(link, unicode):
-                    
+                if isinstance(link, str) or (sys.version_info[0] < 3 and isinstance(link, unicode)):
+
                     if (not '-' in link) or (not ':' in link):
                         abort('Wrong link shortcut string format, cannot find dash or column. See doc.')
-                    
+
                     link_pieces = link.split(':')[0].split('-')
-                    
+
                     # Shortcuts
                     link_name      = link.split(':')[1]
                     link_service = '-'.join(link_pieces[:-1])
-                    link_instance  = link_pieces[-1]         
-                
+                    link_instance  = link_pieces[-1]
+
                 elif isinstance(link, dict):
                     if 'name' not in link:
                         abort('Sorry, you need to give me a link name (ore use the string shortcut for defining it)')
@@ -1251,7 +2633,7 @@ def run(service=None, instance=None, group=None, instance_type=None, interactive
                         abort('Sorry, you need to give me a link service (ore use the string shortcut for defining it)')
                     if 'instance' not in link:
                         abort('Sorry, you need to give me a link instance (ore use the string shortcut for defining it)')
-                    
+
                     # Shortcuts
                     link_name      = link['name']
                     link_service = link['service']
@@ -1259,35 +2641,7 @@ def run(service=None, instance=None, group=None, instance_type=None, interactive
                 else:
                     abort('Sorry, link must be defining using a dict or a string shortcut (see doc), got {}'.format(link.__class__.__name__))
 
-                
-                running_instances = get_running_services_instances_matching(service)
-                
-                # Validate: detect if there is a running service for link['service'], link['instance']
-
-                # Obtain any running instances. If link_instance is None, finds all running instances for service and
-                # warns if more than one instance is found.
-                running_instances = get_running_services_instances_matching(link_service, link_instance)         
-                
-                if len(running_instances) == 0:
-                    if link_instance:
-                        logger.info('Could not find a running instance named "{}" of service "{}" which is required for linking by service "{}", instance "{}". I will expect an env var for proper linking setup'.format(link_instance, link_service, service, instance))
-                    else:
-                        logger.info('Could not find any running instance of service matching "{}" which is required for linking by service "{}", instance "{}". I will expect an env var for proper linking setup'.format(link_service, service, instance))
-                    ENV_VARs[link_name.upper()+'_SERVICE_IP'] = None
-                    
-                else:
-                    if len(running_instances) > 1:
-                        logger.warning('Found more than one running instance for service "{}" which is required for linking: {}. I will use the first one ({}). You can set explicity on which instance to link on in the conf file'.format(link_service, running_instances, running_instances[0]))
-                      
-                    link_service = running_instances[0][0]
-                    link_instance  = running_instances[0][1]
-    
-                    # Now add linking flag for this link
-                    run_cmd += ' --link {}:{}'.format(PROJECT_NAME+'-'+link_service+'-'+link_instance, link_name)
-                    
-                    # Also, add an env var with the linked service IP
-                    ENV_VARs[link_name.upper()+'_SERVICE_IP'] = get_service_ip(link_service, link_instance)
-
+                spec['links'].append([link_name, link_service, link_instance])
 
     # If instance has publish_ports enabld (also for master and published) then check
     # that SERVICE_IP is set (and if not, warn)
@@ -1295,162 +2649,95 @@ def run(service=None, instance=None, group=None, instance_type=None, interactive
         if instance_type == 'master':
             abort('SERVICE_IP env var is required when running in master mode')
         elif service == 'reyns-dns':
-            abort('SERVICE_IP env var is required when publishing the reyns-dns service')            
+            abort('SERVICE_IP env var is required when publishing the reyns-dns service')
         else:
             pass
             # TODO: improve the followign warning, decide if show it or not and in which conditions (i.e. MULTIHOST env var?)
             #logger.warning('You are publishing the service but you have not set the SERVICE_IP env var. This mean that the service(s) might not be completely accessible outside the Docker network.')
 
-    # Try to set the env vars from the env (they have always the precedence):
-    for requested_ENV_VAR in ENV_VARs.keys():
-        requested_ENV_VAR_env_value = os.getenv(requested_ENV_VAR, None)
-        if requested_ENV_VAR_env_value:
-            logger.debug('Found env var %s with value "%s"', requested_ENV_VAR, requested_ENV_VAR_env_value)
-            
-            if ENV_VARs[requested_ENV_VAR] is not None:
-                print('WARNING: I am overriding atomaticaly set env var {} (value="{}") and I will use value "{}" as I found it in the env'.format(requested_ENV_VAR, ENV_VARs[requested_ENV_VAR], requested_ENV_VAR_env_value))
-
-            ENV_VARs[requested_ENV_VAR] = requested_ENV_VAR_env_value
-
-
-    # Check that we have all the required env vars. Do NOT move this section around, it has to stay here.
-    if None in ENV_VARs.values():
-        logger.debug('After checking the env I still cannot find some required env vars, proceeding with the host conf')
-
-        for requested_ENV_VAR in ENV_VARs:
-            
-            if ENV_VARs[requested_ENV_VAR] is None:
-                
-                logger.debug('Evaluating required ENV_VAR %s', requested_ENV_VAR)
-                
-                # Try to see if we can set this var according to the conf
-                if requested_ENV_VAR in host_conf:
-                    logger.debug('Loading ENV_VAR %s from host.conf', requested_ENV_VAR)
-                    ENV_VARs[requested_ENV_VAR] = host_conf[requested_ENV_VAR]
-                else:
-                    
-                    logger.debug('ENV_VAR %s not found even in host.conf, now asking the user', requested_ENV_VAR)
-                    
-                    # Ask the user for the value of this var
-                    host_conf[requested_ENV_VAR] = raw_input('Please enter a value for the required ENV VAR "{}" (or export it before launching): '.format(requested_ENV_VAR))
-                    ENV_VARs[requested_ENV_VAR] = host_conf[requested_ENV_VAR]
-                    
-                    # Do we have to save the value for using it the next time? 
-                    answer = ''
-                    while answer.lower() not in ['y','n']:
-                        answer = raw_input('Should I save this value in host.conf for beign automatically used the next time? (y/n): ')
-                    
-                    if answer == 'y':
-                        # Then, dump the conf #TODO: dump just at the end..
-                        save_host_conf(host_conf)
-
-    logger.debug('Done setting ENV vars. Summary: %s', ENV_VARs)
-
-    # Handle the special case for *_IP var names
-    found_function = False
+    # Set the env vars from the env, the host conf or the user, and apply the IP functions
     for ENV_VAR in ENV_VARs:
-        if ENV_VAR.endswith('_IP'):
-            logger.debug('%s ENV_VAR ends with _IP, I am now going to ckeck if I have to apply a function to it...', ENV_VAR)
-            
-            if ENV_VARs[ENV_VAR].startswith('from_'):
-                found_function = True
-                
-                # Obtain interface
-                interface = ENV_VARs[ENV_VAR].split('_')[-1]
-                logger.debug('Found function for %s: from(\'%s\').', ENV_VAR, interface)
-                 
-                try:
-                    IP = get_ip_address(str(interface)) # Note: cast unicode to string..
-                except IOError:
-                    abort('Error: network interface {} set in {} does not exist on the host'.format(interface, ENV_VAR))
-                    
-                logger.debug('Updating value for %s with IP address %s', ENV_VAR, IP)
-                ENV_VARs[ENV_VAR] = IP
-
-    # Prind updated environment:
-    if found_function:
-        logger.debug('Done applying functions to ENV vars. New summary: %s', ENV_VARs)
-
+        ENV_VARs[ENV_VAR] = resolve_env_var(ENV_VAR, ENV_VARs[ENV_VAR], host_conf, resolution)
+    logger.debug('Done setting ENV vars. Summary: %s', ENV_VARs)
 
     # Handle safe persistency
     if service_conf and 'safe_persistency' in service_conf and service_conf['safe_persistency']:
         ENV_VARs['SAFE_PERSISTENCY'] = True
         privileged = True
 
-    # Handle persistency
+    # Handle persistency. The data dirs are created at run time.
+    volumes = []
+    spec['persistent_dir'] = None
     if persistent_data or persistent_log or persistent_opt or persistent_home:
+        spec['persistent_dir'] = DATA_DIR + '/' + service + '-' + instance
 
-        # Check project data dir exists:
-        if not os.path.exists(DATA_DIR):
-            if not confirm('WARNING: You are running with persistency enabled but I cannot find the data directory "{}". If this is the first time you are runnign the project with persitsency enabled, this is fine. Otherwise, you might want to check you configuration. Proceed?'.format(DATA_DIR)):
-                abort('Exiting...')             
-            os.makedirs(DATA_DIR)
-            
-        # Check service instance dir exists:
-        service_instance_dir = DATA_DIR + '/' + service + '-' + instance
-        if not os.path.exists(service_instance_dir):
-            logger.debug('Data dir for service instance not existent, creating it.. ({})'.format(service_instance_dir))
-            os.mkdir(service_instance_dir)
-        
         # Now mount the dir in /persistent in the Docker: here we just provide a persistent storage in the Docker service.
         # the handling of data, opt and log is done in the Dockerfile.
         if service_conf and 'safe_persistency' in service_conf:
-            run_cmd += ' -v {}:/safe_persistent'.format(service_instance_dir)
+            volumes.append('{}:/safe_persistent'.format(spec['persistent_dir']))
         else:
-            run_cmd += ' -v {}:/persistent'.format(service_instance_dir)
+            volumes.append('{}:/persistent'.format(spec['persistent_dir']))
 
     # Handle shared data between all instances
-    if service_conf and 'persistent_shared' in service_conf and service_conf['persistent_shared']:
-        if not os.path.exists(DATA_DIR+'/shared'):
-            os.makedirs(DATA_DIR+'/shared')
-        run_cmd += ' -v {}/shared:/shared'.format(DATA_DIR)
+    spec['persistent_shared'] = bool(service_conf and 'persistent_shared' in service_conf and service_conf['persistent_shared'])
+    if spec['persistent_shared']:
+        volumes.append('{}/shared:/shared'.format(DATA_DIR))
     else:
         # The following is a Doker Volume, not to be confused with a path
-        run_cmd += ' -v {}-shared:/shared'.format(PROJECT_NAME)
-
-    # Clean temp volume for this service/instance if any was lefted over from previous half-successful runs...
-    os_shell('docker volume rm {}-{}-{}-tmp {}'.format(PROJECT_NAME, service,instance, REDIRECT), capture=True)
+        volumes.append('{}-shared:/shared'.format(PROJECT_NAME))
 
-    # TODO: reading service conf like above is wrong, conf should be loaded at beginning and now we should have only variables.
     # Handle extra volumes
     if service_conf and 'volumes' in service_conf:
-        volumes = service_conf['volumes'].split(',')
-        for volume in volumes:
+        for volume in service_conf['volumes'].split(','):
             if volume.startswith('$PROJECT_DIR'):
                 # Project dir wildard. This is beacuse Docker does not allow relitive paths, basically.
-                volume = volume.replace('$PROJECT_DIR', PROJECT_DIR_CROSSPLAT)
-                run_cmd += ' -v {}'.format(volume)
+                volumes.append(volume.replace('$PROJECT_DIR', PROJECT_DIR_CROSSPLAT))
             elif volume.startswith('$TEMP_VOLUME'):
                 # Temp volume
                 if volume.split(':')[0] in ['$TEMP_VOLUME', '$TEMP_VOLUME/']:
-                    run_cmd += ' -v {}-{}-{}-tmp:{}'.format(PROJECT_NAME,service,instance,volume.split(':')[1])
+                    volumes.append('{}-{}-{}-tmp:{}'.format(PROJECT_NAME,service,instance,volume.split(':')[1]))
                 else:
                     abort('You cannot use any path in the temp volume')
             else:
                 # Standard (folder) volume
-                run_cmd += ' -v {}'.format(volume)
-    
+                volumes.append(volume)
+    spec['volumes'] = volumes
+
     # Handle extra (Docker) args
     if not extra_args and service_conf and 'extra_args' in service_conf:
         extra_args = service_conf['extra_args']
-    if extra_args:
-        run_cmd += ' {}'.format(extra_args)
+    spec['extra_args'] = extra_args if extra_args else None
+
+    # Handle CPU, memory and I/O limits. CPU pinning is allocated at run time.
+    spec['resources'] = OrderedDict()
+    for key in ['cpus', 'cpu_shares', 'memory', 'memory_reservation', 'blkio_weight']:
+        if key in service_conf:
+            spec['resources'][key] = service_conf[key]
+    spec['cpu_pinning'] = int(service_conf.get('cpu_pinning', 0))
 
     # Handle publish ssh port
+    publish = []
     if not publish_ssh_on and service_conf and 'publish_ssh_on' in service_conf:
         publish_ssh_on = service_conf['publish_ssh_on']
     if publish_ssh_on:
-        run_cmd += ' -p{}:22'.format(publish_ssh_on)
+        publish.append('{}:22'.format(publish_ssh_on))
 
     # Init ports lists
     ports =     []
     udp_ports = []
-    
+
     # If is dns service:
     if service == 'reyns-dns' :
         ports.append('53')
         udp_ports.append('53')
-        
+
+    # If is load balancer service, publish the ports it listens on
+    if service == 'reyns-lb' :
+        if not ENV_VARs.get('LB_TARGET', None) or not ENV_VARs.get('LB_PORTS', None):
+            abort('LB_TARGET and LB_PORTS env vars are required for the reyns-lb service')
+        for lb_port in str(ENV_VARs['LB_PORTS']).split(','):
+            ports.append(lb_port.split(':')[0].strip())
+
     # Handle Reyn's annotations
     if not is_base_service(service):
         try:
@@ -1458,45 +2745,45 @@ def run(service=None, instance=None, group=None, instance_type=None, interactive
                 dockerfile = f.readlines()
         except IOError:
             abort('No Dockerfile found (?!) I was looking in {}'.format(get_service_dir(service)+'/Dockerfile'))
-        
-    
+
+
         for line in dockerfile:
-            
+
             # Clean up text
             line = line.strip()
-            
+
             # Check if comment line
             if line.startswith('#'):
-    
+
                 # Re-clean text
                 comment = line[1:].strip()
-    
+
                 # Look for a Reyns' annotation
                 if comment.startswith('reyns:'):
-    
+
                     # Re-re clean text
                     reyns_annotation = comment[6:].strip()
-    
+
                     # Init avalid annotation commands
                     annotation_commands= ['expose', 'privileged']
                     found_valid_annotation_command = False
-                    
+
                     # Look if we have a valid annotation command
                     for annotation_command in annotation_commands:
-    
+
                         if reyns_annotation.startswith(annotation_command):
-    
+
                             # Set annotation command and annotation command arg
                             annotation_command_arg = reyns_annotation.replace(annotation_command,'').strip()
-    
+
                             # Handle the annotation command. This part will need to be refacotered/decoupled
-    
+
                             #--------------------------------
                             # Expose annotation command
                             #--------------------------------
                             if annotation_command == 'expose':
-                                
-                                # Handle exposing (publishing) ports as other ports 
+
+                                # Handle exposing (publishing) ports as other ports
                                 if 'as' in annotation_command_arg:
                                     # Obtain container and host ports
                                     try:
@@ -1504,11 +2791,11 @@ def run(service=None, instance=None, group=None, instance_type=None, interactive
                                     except ValueError:
                                         abort('Too many sub-arguments in annotation command argument "{}"'.format(annotation_command_arg))
                                     container_port = container_port.strip()
-                                    host_port      = host_port.strip() 
+                                    host_port      = host_port.strip()
                                 else:
                                     container_port = host_port = annotation_command_arg
-        
-    
+
+
                                 # Do we have a specific protocol in source or dest port?
                                 if '/' in container_port:
                                     try:
@@ -1518,7 +2805,7 @@ def run(service=None, instance=None, group=None, instance_type=None, interactive
                                 else:
                                     container_port_number  = container_port
                                     container_port_protocol = 'tcp'
-                                
+
                                 if '/' in host_port:
                                     try:
                                         host_port_number, host_port_protocol = host_port.split('/')
@@ -1526,18 +2813,20 @@ def run(service=None, instance=None, group=None, instance_type=None, interactive
                                         abort('Too many slashes in port definiton ("{}")'.format(host_port))
                                 else:
                                     host_port_number   = host_port
-                                    host_port_protocol = 'tcp'
-    
+                                    host_port_protocol = container_port_protocol if host_port == 'auto' else 'tcp'
+
                                 # Check taht we have valid port numbers
                                 try:
                                     container_port_number = int(container_port_number)
                                 except ValueError:
                                     abort('Port value "{}" is not valid'.format(container_port_number))
                                 try:
-                                    host_port_number = int(host_port_number)
+                                    # The host port can be allocated automatically (see allocate_specs_ports)
+                                    if host_port_number != 'auto':
+                                        host_port_number = int(host_port_number)
                                 except ValueError:
                                     abort('Port value "{}" is not valid'.format(host_port_number))
-            
+
                                 # Check we have a valid protocolol and that it is the same between source and dest ports
                                 if container_port_protocol not in ['tcp', 'udp']:
                                     abort('Unknown expose protocol "{}"'.format(container_port_protocol))
@@ -1547,42 +2836,41 @@ def run(service=None, instance=None, group=None, instance_type=None, interactive
                                     abort('Expose container port protocol "{}" and host port protocol "{}" are not the same.'.format(container_port_protocol,host_port_protocol))
                                 else:
                                     ports_protocol = container_port_protocol
-    
+
                                 # Ok, add this port mapping to the container (if we have to publish it)
                                 if publish_ports:
                                     if ports_protocol == 'tcp':
                                         ports.append([container_port_number,host_port_number])
                                     elif ports_protocol == 'udp':
                                         udp_ports.append([container_port_number,host_port_number])
-    
-    
+
+
                             #--------------------------------
                             # Privileged annotation command
                             #--------------------------------
                             elif annotation_command == 'privileged':
                                 privileged=True
-    
-    
+
+
                             #--------------------------------
                             # Inconsistent annotation command
-                            #--------------------------------                       
-                            else:                            
+                            #--------------------------------
+                            else:
                                 abort('Inconsistent annotation command "{}"'.format(annotation_command))
-                        
+
                             # We validated this command, noo net to go trought the others
                             found_valid_annotation_command = True
                             # Also we can stop here, no need to go trought the rest
                             break
-    
+
                     # If no valid annotation command found abort
                     if not found_valid_annotation_command:
                         abort('Got Reyns annotation with unknown command (annotation="{}")'.format(reyns_annotation))
-                   
+
 
     # Handle privileged mode
-    if privileged:
-        run_cmd += ' --privileged'
-               
+    spec['privileged'] = privileged
+
     # Handle published ports
     if publish_ports:
 
@@ -1599,58 +2887,36 @@ def run(service=None, instance=None, group=None, instance_type=None, interactive
             if isinstance(port, list):
                 container_port = port[0]
                 host_port = port[1]
-            else: 
+            else:
                 container_port = port
                 host_port = port
-            run_cmd += ' -p {}{}:{}'.format(pubish_on_ip, host_port, container_port)
+            publish.append('{}{}:{}'.format(pubish_on_ip, host_port, container_port))
 
         # UDP ports publishing
         for port in udp_ports:
             if isinstance(port, list):
                 container_port = port[0]
                 host_port = port[1]
-            else: 
+            else:
                 container_port = port
                 host_port = port
-            run_cmd += ' -p {}{}:{}/udp'.format(pubish_on_ip, container_port, host_port)
+            publish.append('{}{}:{}/udp'.format(pubish_on_ip, host_port, container_port))
 
     # If OSX, expose ssh on a different port
-    if running_on_osx():
-        from random import randint
-
-        while True:
-
-            # Get a random ephimeral port
-            port = randint(49152, 65535)
-
-            # Check port is available
-            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            result = sock.connect_ex(('127.0.0.1', port))
-            if result == 0:
-                logger.info('Found not available ephimeral port ({}) , choosing another one...'.format(port))
-                import time
-                time.sleep(1)
-            else:
-                break
-
-        run_cmd += ' -p {}:22'.format(port)
+    if running_on_osx() and not publish_ssh_on:
+        publish.append('auto:22')
+    spec['ports'] = publish
 
-
-    # Add env vars..
-    logger.debug("Adding env vars: %s", ENV_VARs)
-    for ENV_VAR in ENV_VARs:  
-        # TODO: all vars are understood as strings. Why?  
-        if isinstance(ENV_VAR, bool) or isinstance(ENV_VAR, float) or isinstance(ENV_VAR, int):
-            run_cmd += ' -e {}={}'.format(ENV_VAR, ENV_VARs[ENV_VAR])
-        else:
-            run_cmd += ' -e {}="{}"'.format(ENV_VAR, str(ENV_VARs[ENV_VAR]))
+    # Set the env vars as strings (all vars are understood as strings by Docker)
+    spec['env'] = [[ENV_VAR, str(ENV_VARs[ENV_VAR])] for ENV_VAR in ENV_VARs]
 
     # Handle hostname
-    if not nethost:
-        if service_conf and 'hostname' in service_conf:
-            run_cmd += ' -h {}'.format(service_conf['hostname'])
-        else:
-            run_cmd += ' -h {}-{}'.format(service,instance)
+    if nethost:
+        spec['hostname'] = None
+    elif service_conf and 'hostname' in service_conf:
+        spec['hostname'] = service_conf['hostname']
+    else:
+        spec['hostname'] = '{}-{}'.format(service,instance)
 
     # Set seed command
     if not seed_command:
@@ -1659,72 +2925,608 @@ def run(service=None, instance=None, group=None, instance_type=None, interactive
         else:
             seed_command = 'supervisord'
 
-    # Default tag prefix to PROJECT_NAME    
-    tag_prefix = PROJECT_NAME
+    # Default tag prefix to PROJECT_NAME, but if we are running a Reyns service, use Reyns image
+    tag_prefix = 'reyns' if is_base_service(service) else PROJECT_NAME
+    spec['image']       = '{}/{}:latest'.format(tag_prefix, service)
+    spec['command']     = seed_command
+    spec['interactive'] = interactive
+    spec['sleep']       = int(service_conf['sleep']) if 'sleep' in service_conf else 0
+
+    return spec
+
+
+def get_env_file():
+    '''Create an empty temporary env file, readable only by the user as env vars can hold secrets'''
+    (fd, env_file) = tempfile.mkstemp(prefix='reyns_env_', suffix='.env')
+    os.close(fd)
+    return env_file
+
+def write_env_file(env_file, env_vars):
+    '''Write env vars in an env file for the --env-file option of Docker, returning the ones which cannot be written
+    there (the multi-line ones, as the file has a variable per line and its values are not quoted)'''
+    not_written = OrderedDict()
+    with open(env_file, 'wb') as f:
+        for (env_var, value) in env_vars.items():
+            value = str(value)
+            if '\n' in value or '\r' in value:
+                not_written[env_var] = value
+            else:
+                f.write('{}={}\n'.format(env_var, value).encode('UTF-8'))
+    return not_written
 
-    # But if we are running a Reyns service, use Reyns image
-    if is_base_service(service):
-        tag_prefix = 'reyns'
+def get_run_spec_options(spec, env_file):
+    '''Get the options of the docker run (or create) command for an instance from its spec (see get_run_spec) as
+    a list of arguments, after having linked the running instances, created the data dirs and allocated the CPUs.
+    The env vars are written in the env file (see get_env_file), to be removed once the command is executed.'''
 
-    if interactive:
-        run_cmd += ' --rm  -i -t {}/{}:latest {}'.format(tag_prefix, service, seed_command)
-        os_shell(run_cmd,interactive=True)
-        
-    else:
-        run_cmd += ' -d -t {}/{}:latest {}'.format(tag_prefix, service, seed_command)   
-        
-        out = os_shell(run_cmd, capture=True)
-        if out.exit_code:
-            print(format_shell_error(out.stdout, out.stderr, out.exit_code))
-            abort('Something failed when executing "docker run"')
-        
-        container_id = out.stdout
-        
-        # Chech logs and wait untill prestartup scripts are executed (both correctly and incorrectly)
-        # TODO: this check is weak, improve it!
-        ok_string    = '[INFO] Executing Docker entrypoint command'
-        error_string = '[ERROR] Exit code'
-        
-        print('Waiting for pre-startup scripts to be executed...')
-        while True:
-            
-            # Check for ok or error strings in container output
-            check_cmd = 'docker logs {}'.format(container_id)
-            out = os_shell(check_cmd, capture=True)
-            
-            # Docker logs command merge container stdout and stderr into stdout
-            out_lines = out.stdout.split('\n')
-            
-            # Check if we have ok or error string in output lines
-            passed = None
-            for line in out_lines:
-                if ok_string in line:
-                    passed = True             
-                if error_string in line:
-                    passed = False
+    service  = spec['service']
+    instance = spec['instance']
+    ENV_VARs = OrderedDict(spec['env'])
+    host_conf = load_host_conf()
 
-            # Handle passed / not passed / unknown
-            if passed == True:
-                break
-            elif passed == False:
-                for line in out_lines:
-                    print(line)
-                abort('Error in service prestartup phase. Check output above') 
+    # Start building run command
+    run_cmd = ['--name', spec['container_name']]
+    if spec['nethost']:
+        run_cmd += ['--net', 'host']
+
+    # Handle linking...
+    for (link_name, link_service, link_instance) in spec['links']:
+
+        # Validate: detect if there is a running service for link['service'], link['instance']
+
+        # Obtain any running instances. If link_instance is None, finds all running instances for service and
+        # warns if more than one instance is found.
+        running_instances = get_running_services_instances_matching(link_service, link_instance)
+
+        if len(running_instances) == 0:
+            if link_instance:
+                logger.info('Could not find a running instance named "{}" of service "{}" which is required for linking by service "{}", instance "{}". I will expect an env var for proper linking setup'.format(link_instance, link_service, service, instance))
             else:
-                sleep(1)
-            
-        print('Done.')
-   
+                logger.info('Could not find any running instance of service matching "{}" which is required for linking by service "{}", instance "{}". I will expect an env var for proper linking setup'.format(link_service, service, instance))
+            link_service_ip = None
+
+        else:
+            if len(running_instances) > 1:
+                logger.warning('Found more than one running instance for service "{}" which is required for linking: {}. I will use the first one ({}). You can set explicity on which instance to link on in the conf file'.format(link_service, running_instances, running_instances[0]))
+
+            link_service = running_instances[0][0]
+            link_instance  = running_instances[0][1]
+
+            # Now add linking flag for this link
+            run_cmd += ['--link', '{}:{}'.format(PROJECT_NAME+'-'+link_service+'-'+link_instance, link_name)]
+
+            # Also, add an env var with the linked service IP
+            link_service_ip = get_service_ip(link_service, link_instance)
+
+        ENV_VARs[link_name.upper()+'_SERVICE_IP'] = resolve_env_var(link_name.upper()+'_SERVICE_IP', link_service_ip, host_conf)
+
+    # Handle persistency
+    if spec['persistent_dir']:
+
+        # Check project data dir exists:
+        if not os.path.exists(DATA_DIR):
+            if not confirm('WARNING: You are running with persistency enabled but I cannot find the data directory "{}". If this is the first time you are runnign the project with persitsency enabled, this is fine. Otherwise, you might want to check you configuration. Proceed?'.format(DATA_DIR)):
+                abort('Exiting...')
+            os.makedirs(DATA_DIR)
+
+        # Check service instance dir exists:
+        if not os.path.exists(spec['persistent_dir']):
+            logger.debug('Data dir for service instance not existent, creating it.. ({})'.format(spec['persistent_dir']))
+            os.mkdir(spec['persistent_dir'])
+
+    # Handle shared data between all instances
+    if spec['persistent_shared'] and not os.path.exists(DATA_DIR+'/shared'):
+        os.makedirs(DATA_DIR+'/shared')
+
+    # Clean temp volume for this service/instance if any was lefted over from previous half-successful runs...
+    os_shell(['docker', 'volume', 'rm', '{}-{}-{}-tmp'.format(PROJECT_NAME, service, instance)], capture=True)
+
+    # Handle volumes
+    for volume in spec['volumes']:
+        run_cmd += ['-v', volume]
+
+    # Handle extra (Docker) args. The instances setting their own CPU set are marked, see update_unpinned_cpusets.
+    has_custom_cpuset = False
+    if spec['extra_args']:
+        extra_args = shlex.split(spec['extra_args'])
+        run_cmd += extra_args
+        if [arg for arg in extra_args if arg == '--cpuset-cpus' or arg.startswith('--cpuset-cpus=')]:
+            has_custom_cpuset = True
+            run_cmd += ['--label', CPUSET_CUSTOM_LABEL]
+
+    # Handle CPU, memory and I/O limits
+    for (key, flag) in [('cpus', '--cpus'), ('cpu_shares', '--cpu-shares'), ('memory', '--memory'),
+                        ('memory_reservation', '--memory-reservation'), ('blkio_weight', '--blkio-weight')]:
+        if key in spec['resources']:
+            run_cmd += ['{}={}'.format(flag, spec['resources'][key])]
+
+    # Handle CPU pinning: pinned instances get dedicated cores, the others all the cores not dedicated (when run
+    # in a set, see run_specs, the cores of all the instances of the set are already allocated at this point)
+    topology = allocate_specs_cpus([spec])
+    if topology:
+        cpu_pinning = load_host_conf().get('cpu_pinning', {})
+        if spec['cpu_pinning']:
+            cpus = cpu_pinning['{}-{}'.format(service, instance)]
+            run_cmd += ['--cpuset-cpus={}'.format(format_cpu_list(cpus))]
+            nodes = get_cpus_nodes(cpus, topology)
+            if nodes:
+                run_cmd += ['--cpuset-mems={}'.format(format_cpu_list(nodes))]
+            print('Pinned to CPUs {}{}'.format(format_cpu_list(cpus), ' (NUMA node {})'.format(format_cpu_list(nodes)) if nodes else ''))
+        elif has_custom_cpuset:
+            logger.info('Not restricting "%s-%s" to the CPUs not dedicated, as it sets its own CPU set', service, instance)
+        elif cpu_pinning:
+            allocated_cpus = [cpu for cpus in cpu_pinning.values() for cpu in cpus]
+            free_cpus = [cpu for cores in topology.values() for core in cores for cpu in core if cpu not in allocated_cpus]
+            if free_cpus:
+                run_cmd += ['--cpuset-cpus={}'.format(format_cpu_list(free_cpus))]
+            else:
+                print('WARNING: all the CPUs are dedicated to pinned instances, not restricting this one')
+
+    # Handle privileged mode
+    if spec['privileged']:
+        run_cmd += ['--privileged']
+
+    # Handle published ports
+    for port in spec['ports']:
+        run_cmd += ['-p', port]
+
+    # Add env vars, in bulk trough the env file (but the ones which cannot be written there)
+    logger.debug("Adding env vars: %s", ENV_VARs)
+    for (ENV_VAR, value) in write_env_file(env_file, ENV_VARs).items():
+        run_cmd += ['-e', '{}={}'.format(ENV_VAR, value)]
+    run_cmd += ['--env-file', env_file]
+
+    # Handle hostname
+    if spec['hostname']:
+        run_cmd += ['-h', spec['hostname']]
+
+    return run_cmd
+
+
+def wait_for_prestartup(container, name=None):
+    '''Wait for the prestartup scripts of an instance to be executed. Returns True if they were successful,
+    otherwise prints the container output and returns False.'''
+
+    # Chech logs and wait untill prestartup scripts are executed (both correctly and incorrectly)
+    # TODO: this check is weak, improve it!
+    ok_string    = '[INFO] Executing Docker entrypoint command'
+    error_string = '[ERROR] Exit code'
+
+    print('Waiting for pre-startup scripts to be executed{}...'.format(' for "{}"'.format(name) if name else ''))
+    while True:
+
+        # Check for ok or error strings in container output
+        check_cmd = 'docker logs {}'.format(container)
+        out = os_shell(check_cmd, capture=True)
+
+        # Docker logs command merge container stdout and stderr into stdout
+        out_lines = out.stdout.split('\n')
+
+        # Check if we have ok or error string in output lines
+        passed = None
+        for line in out_lines:
+            if ok_string in line:
+                passed = True
+            if error_string in line:
+                passed = False
+
+        # Handle passed / not passed / unknown
+        if passed == True:
+            # Report the prestartup scripts execution summary, if any
+            for line in out_lines:
+                if '[INFO] Prestartup summary:' in line:
+                    print('Pre-startup scripts: {}'.format(line.split('[INFO] Prestartup summary:')[1].strip()))
+            return True
+        elif passed == False:
+            for line in out_lines:
+                print(line)
+            return False
+        else:
+            sleep(1)
+
+
+def run_spec(spec, recursive=False, from_rerun=False, handover=False):
+    '''Run an instance from its spec (see get_run_spec). On handover (see rolling rerun), the container
+    is only created, taking over the host ports of the running instance once this is stopped.'''
+
+    service = spec['service']
+    spec = allocate_specs_ports([spec], handover=handover)[0]
+    check_published_ports([spec], handover=handover)
+    env_file = get_env_file()
+    try:
+        if handover:
+            run_cmd = ['docker', 'create'] + get_run_spec_options(spec, env_file) + ['-t', spec['image']] + shlex.split(spec['command'])
+            out = os_shell(run_cmd, capture=True)
+        elif spec['interactive']:
+            run_cmd = ['docker', 'run'] + get_run_spec_options(spec, env_file)
+            run_cmd += ['--rm', '-i', '-t', spec['image']] + shlex.split(spec['command'])
+            os_shell(run_cmd, interactive=True)
+        else:
+            run_cmd = ['docker', 'run'] + get_run_spec_options(spec, env_file)
+            run_cmd += ['-d', '-t', spec['image']] + shlex.split(spec['command'])
+            out = os_shell(run_cmd, capture=True)
+    finally:
+        os.remove(env_file)
+
+    if handover:
+        if out.exit_code:
+            print(format_shell_error(out.stdout, out.stderr, out.exit_code))
+            abort('Something failed when executing "docker create"')
+        print('Created, will be started once the instance is stopped.')
+        return
+
+    if not spec['interactive']:
+        if out.exit_code:
+            print(format_shell_error(out.stdout, out.stderr, out.exit_code))
+            abort('Something failed when executing "docker run"')
+
+        if not wait_for_prestartup(out.stdout):
+            abort('Error in service prestartup phase. Check output above')
+
+        print('Done.')
+        print_ports_mapping([spec])
+
+        # Update the load balancers targeting this service (or the load balancer itself)
+        if not recursive:
+            update_load_balancers(service if service != 'reyns-lb' else None)
+
     # In the end, the sleep..
-    if service_conf and 'sleep' in service_conf:
-        if not interactive and not from_rerun:
-            to_sleep = int(service_conf['sleep'])
-            if to_sleep:
-                print('Now sleeping {} seconds to allow service setup...'.format(to_sleep))
+    if spec['sleep'] and not spec['interactive'] and not from_rerun:
+        print('Now sleeping {} seconds to allow service setup...'.format(spec['sleep']))
+        sleep(spec['sleep'])
+
+
+def is_spec_linked_to(spec, other_spec):
+    '''Check if an instance links to another one (the link instance can be a wildcard or not set)'''
+    for (link_name, link_service, link_instance) in spec['links']:
+        if fnmatch.fnmatch(other_spec['service'], link_service) and fnmatch.fnmatch(other_spec['instance'], link_instance or '*'):
+            return True
+    return False
+
+
+def get_run_specs_waves(specs):
+    '''Group a list of specs in waves of instances which can be started together. An instance is started after the
+    instances it links to, and after the instances with a sleep which come before it in the conf.'''
+    levels = []
+    for (i, spec) in enumerate(specs):
+        level = 0
+        for j in range(i):
+            if specs[j]['sleep'] or is_spec_linked_to(spec, specs[j]):
+                level = max(level, levels[j]+1)
+        levels.append(level)
+    return [[spec for (spec, level) in zip(specs, levels) if level == wave] for wave in sorted(set(levels))]
+
+
+def parse_published_port(port):
+    '''Parse a published port (as in the -p option) in a (ip, host port, container port, protocol) tuple.
+    The host port can be "auto" (see allocate_specs_ports).'''
+    protocol = 'udp' if port.endswith('/udp') else 'tcp'
+    pieces = port.split('/')[0].split(':')
+    if len(pieces) == 3:
+        (ip, host_port, container_port) = pieces
+    elif len(pieces) == 2:
+        (ip, host_port, container_port) = [''] + pieces
+    else:
+        raise ValueError('Cannot parse published port "{}"'.format(port))
+    return (ip, host_port if host_port == 'auto' else int(host_port), int(container_port), protocol)
+
+
+def format_published_port(ip, host_port, container_port, protocol):
+    return '{}{}:{}{}'.format(ip+':' if ip else '', host_port, container_port, '/udp' if protocol == 'udp' else '')
+
+
+def is_port_in_use(ip, port, protocol):
+    '''Check if a port is in use on the host by trying to bind it'''
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM if protocol == 'udp' else socket.SOCK_STREAM)
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind((ip or '0.0.0.0', port))
+    except socket.error as e:
+        # Not being allowed to bind a privileged port or a non local IP address does not mean that it is in use
+        return e.errno == errno.EADDRINUSE
+    finally:
+        sock.close()
+    return False
+
+
+def get_ports_name(spec):
+    '''Get the name under which the ports of an instance are reserved (service-instance, also for its replacement
+    in a rolling rerun, which takes them over)'''
+    return '{}-{}'.format(spec['service'], spec['instance'])
+
+
+def allocate_specs_ports(specs, handover=False):
+    '''Allocate the host ports of a set of instances and reserve them in the host conf. The "auto" host ports get the
+    host port they had the last time, if still free, or the first free one in PUBLISH_PORTS_RANGE. The ports reserved
+    by other instances which exist (even if not running) cannot be used. On handover (see rolling rerun), the ports
+    the instances had the last time are used even if in use, as they will be freed. Returns the specs with the ports allocated.'''
+
+    reservations = load_host_conf().get('ports', {})
+    names = [get_ports_name(spec) for spec in specs]
+    existent = get_project_containers()
+
+    # The ports already taken, by the other instances
+    taken = [parse_published_port(port)[0:2] + parse_published_port(port)[3:] + (name,) for (name, ports) in reservations.items()
+             if name not in names for port in ports]
+    def get_owner(ip, host_port, protocol):
+        for (other_ip, other_host_port, other_protocol, name) in taken:
+            if (host_port, protocol) == (other_host_port, other_protocol) and (ip == other_ip or not ip or not other_ip):
+                return name
+        return None
+
+    (first_port, last_port) = [int(port) for port in PUBLISH_PORTS_RANGE.split('-')]
+    allocated_specs = []
+    for (spec, name) in zip(specs, names):
+        previous_ports = [parse_published_port(port) for port in reservations.get(name, [])]
+        ports = []
+        for port in spec['ports']:
+            try:
+                (ip, host_port, container_port, protocol) = parse_published_port(port)
+            except ValueError as e:
+                abort('Invalid published port for "{}": {}'.format(name, e))
+            if host_port == 'auto':
+                candidates = [previous_port[1] for previous_port in previous_ports if (previous_port[0], previous_port[2], previous_port[3]) == (ip, container_port, protocol)]
+                for candidate in candidates + list(range(first_port, last_port+1)):
+                    if not get_owner(ip, candidate, protocol) and ((handover and candidate in candidates) or not is_port_in_use(ip, candidate, protocol)):
+                        host_port = candidate
+                        break
+                else:
+                    abort('No free ports left in the range {} for port {}/{} of "{}"'.format(PUBLISH_PORTS_RANGE, container_port, protocol, name))
+            else:
+                owner = get_owner(ip, host_port, protocol)
+                if owner and owner in existent:
+                    abort('Port {}/{} published by "{}" is reserved by "{}"'.format(host_port, protocol, name, owner))
+            taken.append((ip, host_port, protocol, name))
+            ports.append(format_published_port(ip, host_port, container_port, protocol))
+        reservations[name] = ports
+        allocated_spec = OrderedDict(spec)
+        allocated_spec['ports'] = ports
+        allocated_specs.append(allocated_spec)
+
+    host_conf = load_host_conf()
+    host_conf['ports'] = reservations
+    save_host_conf(host_conf)
+    return allocated_specs
+
+
+def check_published_ports(specs, handover=False):
+    '''Check that the published ports of a set of instances do not clash with each other nor with the ports in use on the host
+    (but on handover, see rolling rerun, where they are in use by the instances being replaced)'''
+    published_ports = {}
+    for spec in specs:
+        name = '{}-{}'.format(spec['service'], spec['instance'])
+        for port in spec['ports']:
+            (ip, host_port, container_port, protocol) = parse_published_port(port)
+            for (other_ip, other_host_port, other_protocol) in published_ports:
+                if (host_port, protocol) == (other_host_port, other_protocol) and (ip == other_ip or not ip or not other_ip):
+                    abort('Port {}/{} is published by both "{}" and "{}"'.format(host_port, protocol, published_ports[(other_ip, other_host_port, other_protocol)], name))
+            if not handover and is_port_in_use(ip, host_port, protocol):
+                abort('Port {}/{} published by "{}" is already in use on the host'.format(host_port, protocol, name))
+            published_ports[(ip, host_port, protocol)] = name
+
+
+def print_ports_mapping(specs):
+    '''Print the published ports of a set of instances'''
+    rows = []
+    for spec in specs:
+        for port in spec['ports']:
+            (ip, host_port, container_port, protocol) = parse_published_port(port)
+            rows.append(('{}-{}'.format(spec['service'], spec['instance']), '{}{}'.format(ip+':' if ip else '', host_port), '{}/{}'.format(container_port, protocol)))
+    if rows:
+        print('\nPublished ports:')
+        for row in rows:
+            print('  {:<30} {:>21} -> {}'.format(*row))
+
+
+def validate_run_specs(specs):
+    '''Validate the images, the published ports and the volumes of a set of instances before running them'''
+
+    # Check that all the images are available, concurrently
+    images = sorted(set([spec['image'] for spec in specs]))
+    outs = os_shell_many(['docker inspect --type=image {}'.format(image) for image in images])
+    missing_images = [image for (image, out) in zip(images, outs) if out.exit_code != 0]
+    if missing_images:
+        abort('Cannot find the image(s) {}, build them first'.format(', '.join(missing_images)))
+
+    # Check that the published ports do not clash with each other nor with the ports in use on the host
+    check_published_ports(specs)
+
+    # Check the volumes format and that no mount point is used twice in the same instance
+    for spec in specs:
+        name = '{}-{}'.format(spec['service'], spec['instance'])
+        mount_points = []
+        for volume in spec['volumes']:
+            pieces = volume.split(':')
+            if len(pieces) not in [2, 3] or not pieces[0] or not pieces[1].startswith('/'):
+                abort('Invalid volume "{}" for "{}", the format is "source:/mount/point[:options]"'.format(volume, name))
+            if len(pieces) == 3 and [option for option in pieces[2].split(',') if option not in VOLUME_OPTIONS]:
+                abort('Invalid options "{}" for volume "{}" of "{}"'.format(pieces[2], volume, name))
+            if pieces[1] in mount_points:
+                abort('Mount point "{}" is used twice by "{}"'.format(pieces[1], name))
+            mount_points.append(pieces[1])
+
+
+def run_specs(specs):
+    '''Run a set of instances in two phases. First, all the containers are created, concurrently and after having
+    validated their images, ports and volumes. Then, they are started in dependency waves (see get_run_specs_waves).
+    The instances linking to other ones of the set are created in their wave, once these are running. If anything
+    fails, all the containers created so far are removed, leaving the already running instances as they were.'''
+
+    if not specs:
+        return
+
+    specs = allocate_specs_ports(specs)
+    waves = get_run_specs_waves(specs)
+    validate_run_specs(specs)
+
+    # Allocate the dedicated cores of all the pinned instances before creating any container, so that the ones
+    # not pinned are not given the cores of the pinned ones coming later in the set
+    allocate_specs_cpus(specs)
+
+    def create(specs):
+        # Get the options in sequence, as they can involve the user and update the host conf
+        env_files = []
+        try:
+            commands = []
+            for spec in specs:
+                env_files.append(get_env_file())
+                commands.append(['docker', 'create'] + get_run_spec_options(spec, env_files[-1]) + ['-t', spec['image']] + shlex.split(spec['command']))
+            # If interrupted while creating, any of them could have been created
+            creating.extend(specs)
+            outs = os_shell_many(commands)
+            del creating[:]
+        finally:
+            for env_file in env_files:
+                os.remove(env_file)
+        for (spec, out) in zip(specs, outs):
+            if out.exit_code == 0:
+                created.append(spec)
+        for (spec, out) in zip(specs, outs):
+            if out.exit_code != 0:
+                print(format_shell_error(out.stdout, out.stderr, out.exit_code))
+                abort('Cannot create the container for service "{}", instance "{}"'.format(spec['service'], spec['instance']))
+
+    created = []
+    creating = []
+    try:
+        # Phase 1: create all the containers not depending on other instances of the set
+        to_create = [spec for spec in specs if not [other_spec for other_spec in specs if other_spec is not spec and is_spec_linked_to(spec, other_spec)]]
+        if to_create:
+            print('\nCreating {} containers...'.format(len(to_create)))
+            start = time.time()
+            create(to_create)
+            print('Created in {:.1f}s'.format(time.time()-start))
+
+        # Phase 2: start the waves
+        for (i, wave) in enumerate(waves):
+            print('\nStarting wave {} of {}: {}'.format(i+1, len(waves), ', '.join(['{}-{}'.format(spec['service'], spec['instance']) for spec in wave])))
+            start = time.time()
+            to_create = [spec for spec in wave if spec not in created]
+            if to_create:
+                create(to_create)
+            pool = ThreadPool(min(RUN_CONCURRENCY, len(wave)))
+            try:
+                outs = pool.map(lambda spec: os_shell('docker start {}'.format(spec['container_name']), capture=True), wave)
+            finally:
+                pool.close()
+            for (spec, out) in zip(wave, outs):
+                if out.exit_code != 0:
+                    print(format_shell_error(out.stdout, out.stderr, out.exit_code))
+                    abort('Cannot start service "{}", instance "{}"'.format(spec['service'], spec['instance']))
+            for spec in wave:
+                if not wait_for_prestartup(spec['container_name'], '{}-{}'.format(spec['service'], spec['instance'])):
+                    abort('Error in prestartup phase of service "{}", instance "{}". Check output above'.format(spec['service'], spec['instance']))
+            print('Started in {:.1f}s'.format(time.time()-start))
+
+            # The sleep of the wave, before starting the next one
+            to_sleep = max([spec['sleep'] for spec in wave])
+            if to_sleep and i < len(waves)-1:
+                print('Now sleeping {} seconds to allow services setup...'.format(to_sleep))
                 sleep(to_sleep)
- 
-    
-    
+
+    except BaseException:
+        cancel_shell_commands()
+        if created or creating:
+            print('Run stopped, removing the {} containers created{}...'.format(len(created), ' (and the {} being created)'.format(len(creating)) if creating else ''))
+            for spec in created + creating:
+                os_shell(['docker', 'rm', '-f', spec['container_name']], capture=True)
+        raise
+
+    print_ports_mapping(specs)
+
+
+#task
+def run(service=None, instance=None, group=None, instance_type=None, interactive=None,
+        persistent_data=None, persistent_opt=None, persistent_log=None, persistent_home=None,
+        publish_ports=None, linked=None, seed_command=None, conf=None, safemode=None,
+        recursive=False, from_rerun=False, nethost=None, extra_args=None, publish_ssh_on=None, force_prestartup=None,
+        container_name=None, handover=False):
+    '''Run a given service with a given instance. If no instance name is set,
+    a standard instance with a random name is run. If service name is set to "all"
+    then all the services are run, according to the conf (using the cached run plan
+    if still valid, see plan). The container name can be overridden to run a
+    replacement of an instance, which is only created on handover (see rolling rerun).'''
+
+    #------------------------
+    # Handle conf(s)
+    #------------------------
+
+    # Load host conf
+    host_conf = load_host_conf()
+
+    # Handle last run conf
+    try:
+        last_conf = host_conf['last_conf']
+        #if not conf:
+        #    conf = last_conf
+    except KeyError:
+        if conf:
+            host_conf['last_conf'] = conf
+            save_host_conf(host_conf)
+    else:
+        if last_conf != conf:
+            host_conf['last_conf'] = conf
+            save_host_conf(host_conf)
+
+    if not recursive:
+        print('Conf being used: "{}"'.format('default' if not conf else conf))
+
+    #---------------------------
+    # Run a group of services
+    #---------------------------
+    if service == 'all' or group:
+
+        if service == 'all':
+            #print('WARNING: using the magic keyword "all" is probably going to be deprecated, use group=all instead.')
+            group = 'all'
+
+        print('\nRunning services in {} for group {}'.format(SERVICES_IMAGES_DIR,group))
+
+        if safemode or interactive:
+            abort('Sorry, you cannot set one of the "safemode" or "interactive" switches if you are running more than one service')
+
+        # Get the plan. The args of the call always win over the configuration(s)
+        run_plan = get_run_plan(group, conf, get_run_plan_args(persistent_data, persistent_log, persistent_opt, persistent_home,
+                                                               publish_ports, linked, extra_args, force_prestartup))
+
+        # Check that the host can fit the resources reservations before starting anything
+        check_resources_reservations([spec['resources'] for spec in run_plan['specs']])
+
+        # Run the instances not already running, creating and then starting them
+        specs_to_run = []
+        for spec in run_plan['specs']:
+            sanity_checks(spec['service'], spec['instance'])
+            if check_instance_to_run(spec['service'], spec['instance']):
+                specs_to_run.append(spec)
+        run_specs(specs_to_run)
+
+        # Update the load balancers, if any
+        update_load_balancers()
+
+        # Exit
+        return
+
+    #-----------------------
+    # Run a given service
+    #-----------------------
+
+    # Sanitize...
+    (service, instance) = sanity_checks(service, instance)
+
+    # Check that we can (and have to) run it
+    if not check_instance_to_run(service, instance, replacement=bool(container_name)):
+        return
+
+    # Resolve its spec and run it
+    spec = get_run_spec(service, instance, instance_type=instance_type, interactive=interactive,
+                        persistent_data=persistent_data, persistent_opt=persistent_opt, persistent_log=persistent_log,
+                        persistent_home=persistent_home, publish_ports=publish_ports, linked=linked, seed_command=seed_command,
+                        conf=conf, safemode=safemode, nethost=nethost, extra_args=extra_args, publish_ssh_on=publish_ssh_on,
+                        force_prestartup=force_prestartup, container_name=container_name, host_conf=host_conf)
+    if spec:
+        run_spec(spec, recursive=recursive, from_rerun=from_rerun, handover=handover)
+
+
 #task
 def clean(service=None, instance=None, group=None, force=False, conf=None, strict=False):
     '''Clean a given service. If service name is set to "all" then clean all the services according 
@@ -1736,8 +3538,10 @@ def clean(service=None, instance=None, group=None, force=False, conf=None, stric
     if service == 'reallyall':        
         if confirm('Clean all services? WARNING: this will stop and remove *really all* Docker services running on this host!'):
             print('Cleaning all Docker services on the host...')
-            os_shell('docker stop $(docker ps -a -q) ' + REDIRECT, silent=True)
-            os_shell('docker rm $(docker ps -a -q) ' + REDIRECT, silent=True)
+            containers = os_shell(['docker', 'ps', '-a', '-q'], capture=True).stdout.split()
+            if containers:
+                os_shell(['docker', 'stop'] + containers, capture=True)
+                os_shell(['docker', 'rm'] + containers, capture=True)
 
     elif service == 'all' or group:
         
@@ -1823,8 +3627,7 @@ def clean(service=None, instance=None, group=None, force=False, conf=None, stric
                     print('WARNING: I Cannot clean {}, instance='.format(service_conf['service'], service_conf['instance']))
                 else:
                     print('Cleaning service "{}", instance "{}"..'.format(service_conf['service'], service_conf['instance']))          
-                    os_shell("docker stop "+PROJECT_NAME+"-"+service_conf['service']+"-"+service_conf['instance']+" " + REDIRECT, silent=True)
-                    os_shell("docker rm "+PROJECT_NAME+"-"+service_conf['service']+"-"+service_conf['instance']+" " + REDIRECT, silent=True)
+                    remove_instance(service_conf['service'], service_conf['instance'])
                             
     else:
         
@@ -1851,13 +3654,78 @@ def clean(service=None, instance=None, group=None, force=False, conf=None, stric
             print('I did not find any running instance to clean, exiting. Please note that if the instance is not running, you have to specify the instance name to let it be clened')
         else:
             print('Cleaning service "{}", instance "{}"..'.format(service,instance))   
-            os_shell("docker stop "+PROJECT_NAME+"-"+service+"-"+instance+" " + REDIRECT, silent=True)
-            os_shell("docker rm "+PROJECT_NAME+"-"+service+"-"+instance+" " + REDIRECT, silent=True)
+            remove_instance(service, instance)
 
     # Also, remove shared volume (and ignore any error which means it is still in use):
-    os_shell('docker volume rm {}-shared {}'.format(PROJECT_NAME, REDIRECT), capture=True)
+    os_shell(['docker', 'volume', 'rm', '{}-shared'.format(PROJECT_NAME)], capture=True)
     # ..and temp volume, ignoring errors which mean it does not exist (never requested)
-    os_shell('docker volume rm {}-{}-{}-tmp {}'.format(PROJECT_NAME, service,instance, REDIRECT), capture=True)
+    os_shell(['docker', 'volume', 'rm', '{}-{}-{}-tmp'.format(PROJECT_NAME, service, instance)], capture=True)
+
+    # Update the load balancers, if any
+    if service != 'reallyall':
+        update_load_balancers()
+
+
+#task
+def scale(service=None, replicas=None, instance=None, conf=None):
+    '''Set the number of replicas of a service (for the conf entries with the "replicas" key), running the
+    missing replicas or cleaning the ones in excess, without touching the others.'''
+
+    if not service or replicas is None:
+        abort('Please give the service and the number of replicas (i.e. scale:your_service_name,replicas=3)')
+    if not isinstance(replicas, int) or isinstance(replicas, bool) or replicas < 0:
+        abort('The number of replicas must be a number, got "{}"'.format(replicas))
+
+    # Get the conf entry to scale
+    host_conf = load_host_conf()
+    if not conf:
+        conf = host_conf.get('last_conf', None)
+    print('Conf being used: "{}"'.format('default' if not conf else conf))
+    try:
+        services_descriptions = get_services_run_conf(conf, expand_replicas=False)
+    except Exception as e:
+        abort('Got error in reading run conf: {}.'.format(e))
+    replicated = [service_description for service_description in services_descriptions if service_description.get('service', None) == service
+                  and 'replicas' in service_description and (not instance or service_description['instance'] == instance)]
+    if not replicated:
+        abort('No conf entry with replicas found for service "{}"{}'.format(service, ', instance "{}"'.format(instance) if instance else ''))
+    if len(replicated) > 1:
+        abort('More than one conf entry with replicas found for service "{}", please specify the instance'.format(service))
+    instance = replicated[0]['instance']
+
+    # Save the new number of replicas, overriding the conf
+    host_conf.setdefault('replicas', {})['{}-{}'.format(service, instance)] = replicas
+    save_host_conf(host_conf)
+
+    # Get the existent replicas (the instances named after the instance plus an index, and not defined on their own)
+    out = os_shell('docker ps -a --format "{{.Names}}"', capture=True)
+    if out.exit_code != 0:
+        print(format_shell_error(out.stdout, out.stderr, out.exit_code))
+        abort('Cannot list the existent instances')
+    defined = [service_description['instance'] for service_description in services_descriptions if service_description.get('service', None) == service]
+    existent = []
+    for name in out.stdout.split('\n'):
+        match = re.match(r'^{}-{}-{}([0-9]+)$'.format(re.escape(PROJECT_NAME), re.escape(service), re.escape(instance)), name.strip())
+        if match and '{}{}'.format(instance, match.group(1)) not in defined:
+            existent.append(int(match.group(1)))
+    print('Scaling service "{}", instance "{}" from {} to {} replicas'.format(service, instance, len(existent), replicas))
+
+    # Clean the replicas in excess, then run the missing ones all together (see run_specs)
+    for i in sorted(existent, reverse=True):
+        if i > replicas:
+            print('Cleaning service "{}", instance "{}{}"..'.format(service, instance, i))
+            remove_instance(service, '{}{}'.format(instance, i))
+    specs = []
+    for i in range(1, replicas+1):
+        if i not in existent:
+            if check_instance_to_run(service, '{}{}'.format(instance, i)):
+                spec = get_run_spec(service, '{}{}'.format(instance, i), conf=conf, host_conf=load_host_conf())
+                if spec:
+                    specs.append(spec)
+    run_specs(specs)
+
+    # Update the load balancers targeting this service, if any
+    update_load_balancers(service)
 
 
 #task
@@ -1978,14 +3846,18 @@ def shell(service=None, instance=None, command=None, capture=False, jsonout=Fals
 #    os_shell('fab --list', capture=False)
 
 #task
-def getip(service=None, instance=None):
+def getip(service=None, instance=None, format='text'):
     '''Get a service IP'''
 
     # Sanitize...
     (service, instance) = sanity_checks(service,instance)
+    check_output_format(format)
     
     # Get running instances
     running_instances = get_running_services_instances_matching(service)
+    if format != 'text':
+        print_records(get_ip_records(running_instances), format)
+        return
     # For each instance found print the ip address
     for i in running_instances:
         print('IP address for {} {}: {}'.format(i[0], i[1], get_service_ip(i[0], i[1])))
@@ -1993,15 +3865,17 @@ def getip(service=None, instance=None):
 # TODO: split in function plus task, allstates goes in the function
 
 #task
-def info(service=None, instance=None, capture=False):
+def info(service=None, instance=None, capture=False, format='text'):
     '''Obtain info about a given service'''
-    return ps(service=service, instance=instance, capture=capture, info=True)
+    return ps(service=service, instance=instance, capture=capture, info=True, format=format)
 
 #task
-def ps(service=None, instance=None, capture=False, onlyrunning=False, info=False, conf=None):
+def ps(service=None, instance=None, capture=False, onlyrunning=False, info=False, conf=None, format='text'):
     '''Info on running services. Give a service name to obtain informations only about that specific service.
     Use the magic words 'all' to list also the not running ones, and 'reallyall' to list also the services not managed by
-    Reyns (both running and not running)'''
+    Reyns (both running and not running). The format can be "text", "json" or "ndjson".'''
+
+    check_output_format(format)
 
     # TODO: this function has to be COMPLETELY refactored. Please do not look at this code.
     # TODO: return a list of namedtuples instead of a list of lists
@@ -2027,6 +3901,9 @@ def ps(service=None, instance=None, capture=False, onlyrunning=False, info=False
     
     # If error:
     if out.exit_code != 0:
+        # Do not print anything in the machine-readable output
+        if format != 'text':
+            abort('Cannot list the containers: {}'.format((out.stderr or out.stdout).strip()))
         print(format_shell_error(out.stdout, out.stderr, out.exit_code))
 
     index=[]
@@ -2177,7 +4054,10 @@ def ps(service=None, instance=None, capture=False, onlyrunning=False, info=False
     #-------------------
     # Print output
     #-------------------
-    if not capture:
+    if not capture and format != 'text':
+        print_records((get_ps_record(entry) for entry in content), format)
+        
+    elif not capture:
 
         # Prepare 'stats' 
         fields=['CONTAINER ID', 'NAMES', 'IMAGE', 'STATUS']
@@ -2233,7 +4113,14 @@ def ps(service=None, instance=None, capture=False, onlyrunning=False, info=False
     else:
         return content
 
-def status():
+#task
+def status(format='text'):
+    '''Show the status of the instances and of their processes. The format can be "text", "json" or "ndjson".'''
+    check_output_format(format)
+    if format != 'text':
+        print_records(get_status_records(), format)
+        return
+
     running_services = ps(capture=True)
     one_running = False
     for running_service in running_services:
@@ -2264,6 +4151,139 @@ def status():
         print('No running services.')
 
 
+def get_ps_record(entry):
+    '''Get the record of an entry of ps() in capture mode (the "docker ps" columns, with the container name
+    converted to "service,instance=instance" for the instances of the project)'''
+    (container_id, image, command, created, state, ports, name) = entry[0:7]
+    if ',instance=' in name:
+        (service, instance) = (name.split(',')[0], name.split('=')[1])
+        container = '{}-{}-{}'.format(PROJECT_NAME, service, instance)
+    else:
+        (service, instance, container) = (None, None, name)
+    return OrderedDict([('service', service), ('instance', instance), ('container', container), ('id', container_id),
+                        ('image', image), ('command', command.strip('"')), ('created', created), ('status', state),
+                        ('running', state.lower().startswith('up')), ('ports', ports.split(', ') if ports else [])])
+
+def parse_supervisor_status(output):
+    '''Parse the output of "supervisorctl status" in a list of processes records'''
+    processes = []
+    for line in output.split('\n'):
+        # i.e. "sshd    RUNNING   pid 10, uptime 0:00:05"
+        items = line.strip().split(None, 2)
+        if len(items) >= 2:
+            processes.append(OrderedDict([('name', items[0]), ('state', items[1]), ('description', items[2] if len(items) > 2 else '')]))
+    return processes
+
+def get_status_records():
+    '''Get the status records of the instances, with their processes. This is a generator, as the processes
+    have to be queried one instance at a time.'''
+    # As for the machine-readable output, errors in listing the instances abort instead of being printed
+    for entry in ps(capture=True, format='json'):
+        record = get_ps_record(entry)
+        record['processes'] = None
+        if record['running']:
+            # Not interactive, as the output is usually piped
+            out = os_shell('docker exec {} supervisorctl status'.format(record['id']), capture=True)
+            record['processes'] = parse_supervisor_status(out.stdout)
+            # Supervisorctl exits with an error if some processes are not running, which is not an error here
+            if out.exit_code != 0 and not record['processes']:
+                record['error'] = out.stderr or out.stdout
+        yield record
+
+def get_ip_records(instances):
+    '''Get the IP address records of a list of [service, instance], as a generator'''
+    for (service, instance) in instances:
+        try:
+            ip = get_service_ip(service, instance)
+        except Exception:
+            # i.e. running in nethost mode
+            ip = None
+        yield OrderedDict([('service', service), ('instance', instance), ('ip', ip or None)])
+
+def exec_shell_command(service, instance, command):
+    '''Execute a command in an instance (as the "reyns" user), not interactively, and return a record with its
+    stdout, stderr and exit code'''
+    (service, instance) = sanity_checks(service, instance)
+    out = os_shell('docker exec {}-{}-{} sudo -i -u reyns bash -c {}'.format(PROJECT_NAME, service, instance, shell_quote(command)), capture=True)
+    return OrderedDict([('stdout', out.stdout), ('stderr', out.stderr), ('exit_code', out.exit_code)])
+
+def get_project_containers():
+    '''Get the names of the existent containers of the project (running or not), without the project prefix'''
+    out = os_shell('docker ps -a --format "{{.Names}}"', capture=True)
+    if out.exit_code != 0:
+        print(format_shell_error(out.stdout, out.stderr, out.exit_code))
+        abort('Cannot list the existent instances')
+    return [name.strip()[len(PROJECT_NAME)+1:] for name in out.stdout.split('\n') if name.strip().startswith(PROJECT_NAME+'-')]
+
+
+#task
+def cpumap(prune=False):
+    '''Show the host CPU cores map with the dedicated cores of the pinned instances. If prune is set,
+    release the cores of the instances which do not exist anymore.'''
+    host_conf = load_host_conf()
+    cpu_pinning = host_conf.get('cpu_pinning', {})
+
+    if booleanize(prune=prune):
+        existent = get_project_containers()
+        released = False
+        for name in sorted(cpu_pinning):
+            if name not in existent:
+                print('Releasing CPUs {} of "{}"'.format(format_cpu_list(cpu_pinning[name]), name))
+                del cpu_pinning[name]
+                released = True
+        host_conf['cpu_pinning'] = cpu_pinning
+        save_host_conf(host_conf)
+        if released:
+            update_unpinned_cpusets(cpu_pinning, get_host_cpu_topology())
+
+    topology = get_host_cpu_topology()
+    host_cores = CPU_PINNING_HOST_CORES
+    for (node, cores) in topology.items():
+        print('NUMA node {}:'.format(node) if node is not None else 'CPUs (no NUMA information):')
+        for core in cores:
+            owners = [name for name in cpu_pinning if set(core) & set(cpu_pinning[name])]
+            if owners:
+                owner = ', '.join(sorted(owners))
+            elif host_cores > 0:
+                owner = 'host'
+            else:
+                owner = 'free'
+            host_cores -= 1
+            print('  CPUs {:<8} {}'.format(format_cpu_list(core), owner))
+
+    topology_cpus = [cpu for cores in topology.values() for core in cores for cpu in core]
+    for name in sorted(cpu_pinning):
+        if not set(cpu_pinning[name]) <= set(topology_cpus):
+            print('WARNING: "{}" is pinned to CPUs {} not available on this host'.format(name, format_cpu_list(cpu_pinning[name])))
+
+
+#task
+def ports(prune=False):
+    '''Show the host ports reserved by the instances. If prune is set, release the ports of the instances
+    which do not exist anymore.'''
+    host_conf = load_host_conf()
+    reservations = host_conf.get('ports', {})
+    existent = get_project_containers()
+
+    if booleanize(prune=prune):
+        for name in sorted(reservations):
+            if name not in existent:
+                print('Releasing ports {} of "{}"'.format(', '.join(reservations[name]), name))
+                del reservations[name]
+        host_conf['ports'] = reservations
+        save_host_conf(host_conf)
+
+    if not [name for name in reservations if reservations[name]]:
+        print('No ports reserved')
+        return
+    print('{:<30} {:>21}    {:<10} {}'.format('Instance', 'Host port', 'Port', 'State'))
+    for name in sorted(reservations):
+        for port in reservations[name]:
+            (ip, host_port, container_port, protocol) = parse_published_port(port)
+            print('{:<30} {:>21} -> {:<10} {}'.format(name, '{}{}'.format(ip+':' if ip else '', host_port), '{}/{}'.format(container_port, protocol),
+                                                    'existent' if name in existent else 'not existent'))
+
+
 def using_local_reyns():
     '''Check if this Reyns is a local (project) installation or a system/user wide one'''
     if CWD.endswith('.Reyns'):   
@@ -2344,6 +4364,12 @@ def setup():
         print('\nExecuting project\'s "setup.sh" scrip now...')
         if not os_shell('cd {} && ./setup.sh'.format(PROJECT_DIR), interactive=True):
             sys.exit(1)
+
+    # Gather the host facts again, as the host could have been changed as well
+    print('\nGathering host facts...')
+    current_facts = get_host_facts(refresh=True)
+    print_host_facts(current_facts)
+    check_docker_version(current_facts)
     
     # Done
     print('\nDone')
@@ -2364,6 +4390,1385 @@ def daemon(recursive=False):
     #out = os_shell('cd utils && ./daemon.sh'.format(), interactive=True)
 
 
+#task
+def batch(file=None, stop_on_error=True):
+    '''Run many commands, one per line in the "command:args" syntax, from a file or from the standard input, in a
+    single process sharing the caches of the run confs, of the services metadata and of the containers listings.
+    Stops at the first failing command unless stop_on_error is False, and reports the time taken by each command.'''
+    global PROMPTS_ENABLED
+
+    stop_on_error = booleanize(stop_on_error=stop_on_error)
+    if file:
+        file = get_project_path(file)
+        try:
+            with open(file) as f:
+                lines = f.read().split('\n')
+        except IOError as e:
+            abort('Cannot read the commands file "{}" ({})'.format(file, e))
+    else:
+        lines = sys.stdin.read().split('\n')
+
+    # Skip empty lines and comments, and allow the "reyns" prefix to run scripts as they are
+    commands = []
+    for line in lines:
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        if line.startswith('reyns '):
+            line = line[6:].strip()
+        commands.append(line)
+    if not commands:
+        abort('No commands to run')
+
+    # The standard input is already consumed by the commands, so the user cannot be asked for input
+    prompts_enabled = PROMPTS_ENABLED
+    if not file:
+        PROMPTS_ENABLED = False
+
+    results = []
+    batch_caches['enabled'] = True
+    try:
+        for (i, command) in enumerate(commands):
+            if results and results[-1][1] in ['FAILED', 'SKIPPED'] and stop_on_error:
+                results.append([command, 'SKIPPED', None])
+                continue
+            print('[{}/{}] reyns {}\n'.format(i+1, len(commands), command))
+            start = time.time()
+            try:
+                (task, argv, kwargs) = parse_command(command)
+                if task not in tasks or task[0] == '_':
+                    abort('Unknown command "{}"'.format(task))
+                if task in ['batch', 'watch', 'daemon']:
+                    abort('The "{}" command cannot be run in a batch'.format(task))
+                tasks[task][0](*argv, **kwargs)
+                result = 'OK'
+            except SystemExit as e:
+                # Some commands (i.e. ssh) exit with the exit code of what they run
+                result = 'FAILED' if e.code else 'OK'
+            except (ReynsError, InputException) as e:
+                print('Got fatal error: {}.'.format(e))
+                result = 'FAILED'
+            except Exception as e:
+                # I.e. a missing conf file, an invalid conf or wrong arguments: fail this command only
+                logger.debug('Error in command "%s"', command, exc_info=True)
+                print('Got unexpected error: {}: {}.'.format(type(e).__name__, e))
+                result = 'FAILED'
+            results.append([command, result, time.time()-start])
+            print('')
+    finally:
+        batch_caches['enabled'] = False
+        for cache in ['confs', 'metadata', 'containers']:
+            batch_caches[cache].clear()
+        PROMPTS_ENABLED = prompts_enabled
+
+    # Timing table
+    width = max([len(command) for (command, _, _) in results] + [len('Command')])
+    print('{:<{}}   {:<7}  {:>8}'.format('Command', width, 'Result', 'Time'))
+    for (command, result, elapsed) in results:
+        print('{:<{}}   {:<7}  {:>8}'.format(command, width, result, '{:.1f}s'.format(elapsed) if elapsed is not None else '-'))
+    failed = len([result for (_, result, _) in results if result == 'FAILED'])
+    skipped = len([result for (_, result, _) in results if result == 'SKIPPED'])
+    print('{} commands in {:.1f}s: {} succeeded, {} failed, {} skipped'.format(len(results), sum([elapsed for (_, _, elapsed) in results if elapsed]),
+                                                                          len(results)-failed-skipped, failed, skipped))
+    if failed:
+        abort('{} command(s) of the batch failed'.format(failed))
+
+
+
+
+#--------------------------
+# Load balancing
+#--------------------------
+
+def get_running_project_instances():
+    '''Get the list of (service, instance) of the running instances of the project'''
+    out = os_shell('docker ps --format "{{.Names}}"', capture=True)
+    if out.exit_code != 0:
+        print(format_shell_error(out.stdout, out.stderr, out.exit_code))
+        abort('Cannot list the running instances')
+
+    # Both service and instance names can contain hyphens, so match the names against the instances in the
+    # conf and then against the known services, falling back on splitting on the last hyphen.
+    known_instances = []
+    try:
+        known_instances = [(service_conf.get('service'), service_conf.get('instance')) for service_conf
+                           in get_services_run_conf(load_host_conf().get('last_conf', None))]
+    except Exception as e:
+        logger.debug('Could not load the run conf to match the instances names: %s', e)
+    known_services = ['reyns-lb'] + [service_conf[0] for service_conf in known_instances]
+    if os.path.isdir(SERVICES_IMAGES_DIR):
+        known_services += os.listdir(SERVICES_IMAGES_DIR)
+
+    instances = []
+    for name in out.stdout.split('\n'):
+        name = name.strip()
+        if name.startswith(PROJECT_NAME+'-'):
+            instance = split_instance_name(name[len(PROJECT_NAME)+1:], known_instances, known_services)
+            if instance:
+                instances.append(instance)
+    return instances
+
+
+def split_instance_name(name, known_instances=(), known_services=()):
+    '''Split a "service-instance" container name (without the project prefix) in its service and instance,
+    matching it against the known (service, instance) pairs and then against the known services (the longest
+    one wins). Returns None if the name cannot be split.'''
+    for (service, instance) in known_instances:
+        if service and instance and name == service + '-' + instance:
+            return (service, instance)
+    for service in sorted(set([service for service in known_services if service]), key=len, reverse=True):
+        if name.startswith(service + '-') and len(name) > len(service) + 1:
+            return (service, name[len(service)+1:])
+    if '-' in name:
+        return tuple(name.rsplit('-', 1))
+    return None
+
+
+def update_load_balancers(service=None):
+    '''Update the backends of the running load balancers (reyns-lb instances) targeting a given service, or of all
+    of them if no service is given, with the IP addresses of the running instances of their target service.'''
+    running_instances = get_running_project_instances()
+    for (lb_service, lb_instance) in running_instances:
+        if lb_service != 'reyns-lb':
+            continue
+        lb_container = PROJECT_NAME + '-reyns-lb-' + lb_instance
+        target = os_shell('docker exec ' + lb_container + ' printenv LB_TARGET', capture=True).stdout.strip()
+        if not target or (service and target != service):
+            continue
+
+        # Write the backends list (passed on stdin, one per line) and reload
+        backends = []
+        for (target_service, target_instance) in running_instances:
+            if target_service == target:
+                try:
+                    ip = get_service_ip(target_service, target_instance)
+                except Exception as e:
+                    logger.warning('Not adding "%s-%s" to the load balancer "%s": %s', target_service, target_instance, lb_instance, e)
+                    continue
+                if ip:
+                    backends.append('{}-{} {}'.format(target_service, target_instance, ip))
+        out = os_shell(['docker', 'exec', '-i', lb_container, 'sh', '-c', 'cat > /etc/haproxy/backends.list && /lb-reload.sh'],
+                       capture=True, input=''.join([backend + '\n' for backend in backends]))
+        if out.exit_code != 0:
+            print(format_shell_error(out.stdout, out.stderr, out.exit_code))
+            print('WARNING: could not update the load balancer "{}"'.format(lb_instance))
+        else:
+            print('Updated load balancer "{}" for service "{}" with {} backends'.format(lb_instance, target, len(backends)))
+
+
+#task
+def lbstats(instance=None):
+    '''Show the per-backend connections and latency counters of the running load balancers'''
+    lb_instances = [lb_instance for (lb_service, lb_instance) in get_running_project_instances()
+                    if lb_service == 'reyns-lb' and (not instance or lb_instance == instance)]
+    if not lb_instances:
+        abort('No running load balancers found')
+
+    for lb_instance in sorted(lb_instances):
+        out = os_shell('docker exec ' + PROJECT_NAME + '-reyns-lb-' + lb_instance + ' curl -s "http://127.0.0.1:8404/stats;csv"', capture=True)
+        if out.exit_code != 0:
+            print(format_shell_error(out.stdout, out.stderr, out.exit_code))
+            print('WARNING: could not get the stats of the load balancer "{}"\n'.format(lb_instance))
+            continue
+
+        # The CSV header starts with "# ". Latency counters (ctime, rtime) are not available on older HAProxy versions.
+        rows = list(csv.DictReader(out.stdout.lstrip('# ').splitlines()))
+        print('Load balancer "{}":'.format(lb_instance))
+        print('  {:<32} {:<8} {:>8} {:>10} {:>8} {:>9} {:>9} {:>9}'.format('BACKEND', 'STATUS', 'CURRENT', 'TOTAL', 'ERRORS', 'CHECK_MS', 'CONN_MS', 'RESP_MS'))
+        for row in rows:
+            if row['pxname'] == 'stats' or row['svname'] == 'FRONTEND':
+                continue
+            name = '{} (total)'.format(row['pxname']) if row['svname'] == 'BACKEND' else row['svname']
+            errors = sum([int(row.get(key) or 0) for key in ['econ', 'eresp']])
+            print('  {:<32} {:<8} {:>8} {:>10} {:>8} {:>9} {:>9} {:>9}'.format(name, row['status'], row['scur'], row['stot'], errors,
+                  row.get('check_duration') or '-', row.get('ctime') or '-', row.get('rtime') or '-'))
+        print('')
+
+
+#--------------------------
+# Run plans
+#--------------------------
+
+# Host conf keys updated by Reyns itself while running, which do not change how instances are run
+PLAN_HOST_CONF_VOLATILE_KEYS = ['last_conf', 'cpu_pinning', 'ports']
+
+def get_run_plan_file(group, conf=None):
+    return '{}/.plans/{}.{}.json'.format(PROJECT_DIR, get_conf_file(conf)[:-5], group)
+
+def get_run_plan_args(persistent_data=None, persistent_log=None, persistent_opt=None, persistent_home=None,
+                      publish_ports=None, linked=None, extra_args=None, force_prestartup=None):
+    '''Get the args of a group run which override the conf, as they are part of the inputs of its plan'''
+    return OrderedDict([('persistent_data', persistent_data), ('persistent_log', persistent_log), ('persistent_opt', persistent_opt),
+                        ('persistent_home', persistent_home), ('publish_ports', publish_ports), ('linked', linked),
+                        ('extra_args', extra_args), ('force_prestartup', force_prestartup)])
+
+def get_file_hash(path):
+    try:
+        with open(path, 'rb') as f:
+            return hashlib.sha256(f.read()).hexdigest()
+    except IOError:
+        return None
+
+def get_run_plan_inputs(conf, args, specs, interfaces):
+    '''Get the inputs a run plan was resolved from: the args, the conf, the host conf, the services files, the
+    env vars of the instances and the network interfaces used by the IP functions. A plan is valid as long as
+    its inputs are unchanged.'''
+    files = [PROJECT_DIR+'/'+get_conf_file(conf)]
+    for service in sorted(set([spec['service'] for spec in specs])):
+        files.append(SERVICES_IMAGES_DIR+'/'+service+'/required_env_vars.json')
+        if not is_base_service(service):
+            files.append(get_service_dir(service, onlychecking=True)+'/Dockerfile')
+    host_conf = dict([(key, value) for (key, value) in load_host_conf().items() if key not in PLAN_HOST_CONF_VOLATILE_KEYS])
+    env_vars = set([env_var for spec in specs for (env_var, _) in spec['env']])
+    env_vars.update([link[0].upper()+'_SERVICE_IP' for spec in specs for link in spec['links']])
+    interfaces_ips = {}
+    for interface in interfaces:
+        try:
+            interfaces_ips[interface] = get_interface_ip(str(interface))
+        except Exception:
+            interfaces_ips[interface] = None
+    inputs = {'version': VERSION,
+              'project': [PROJECT_NAME, PROJECT_DIR_CROSSPLAT, DATA_DIR],
+              'hostname': socket.gethostname(),
+              'args': args,
+              'files': dict([(path, get_file_hash(path)) for path in files]),
+              'host_conf': hashlib.sha256(json.dumps(host_conf, sort_keys=True).encode('UTF-8')).hexdigest(),
+              'env': dict([(env_var, os.getenv(env_var, None)) for env_var in env_vars]),
+              'interfaces': interfaces_ips}
+    # Normalize as if loaded from the plan file
+    return json.loads(json.dumps(inputs, sort_keys=True), object_pairs_hook=OrderedDict)
+
+def resolve_run_plan(group, conf, args):
+    '''Resolve the specs of all the instances of a group (see get_run_spec) in a run plan'''
+
+    # Load run conf
+    try:
+        services_to_run_confs = get_services_run_conf(conf)
+    except Exception as e:
+        abort('Got error in reading run conf for automated execution: {}.'.format(e))
+
+    if not services_to_run_confs:
+        abort('No or empty conf file (looking for "{}"), are you in the project\'s root?'.format(get_conf_file(conf)))
+
+    host_conf = load_host_conf()
+    resolution = {}
+    specs = []
+    for service_conf in services_to_run_confs:
+
+        # Check for service group.
+        # We will run the service if:
+        # a) the group is set to 'all'
+        # b) the group is set to 'x' and the service group is 'x'
+        if group != 'all':
+            if 'group' in service_conf:
+                if service_conf['group'] != group:
+                    continue
+            else:
+                continue
+        else:
+            if 'autorun' in service_conf:
+                if not service_conf['autorun']:
+                    continue
+
+        # Check for service name
+        if 'service' not in service_conf:
+            abort('Missing service name for conf: {}'.format(service_conf))
+
+        # Check for instance name
+        if 'instance' not in service_conf:
+            abort('Missing instance name for conf: {}'.format(service_conf))
+
+        print('\nResolving service "{}", instance "{}"...'.format(service_conf['service'], service_conf['instance']))
+        spec = get_run_spec(service_conf['service'], service_conf['instance'],
+                            instance_type   = service_conf.get('instance_type', None),
+                            persistent_data = args['persistent_data'] if args['persistent_data'] is not None else service_conf.get('persistent_data', None),
+                            persistent_log  = args['persistent_log']  if args['persistent_log']  is not None else service_conf.get('persistent_log', None),
+                            persistent_opt  = args['persistent_opt']  if args['persistent_opt']  is not None else service_conf.get('persistent_opt', None),
+                            persistent_home = args['persistent_home'] if args['persistent_home'] is not None else service_conf.get('persistent_home', None),
+                            publish_ports   = args['publish_ports']   if args['publish_ports']   is not None else service_conf.get('publish_ports', None),
+                            linked          = args['linked']          if args['linked']          is not None else service_conf.get('linked', None),
+                            conf            = conf,
+                            extra_args      = args['extra_args'],
+                            force_prestartup= args['force_prestartup'],
+                            host_conf       = host_conf,
+                            resolution      = resolution)
+        if spec:
+            specs.append(spec)
+
+    run_plan = OrderedDict()
+    run_plan['group']  = group
+    run_plan['conf']   = get_conf_file(conf)[:-5]
+    run_plan['inputs'] = get_run_plan_inputs(conf, args, specs, resolution.get('interfaces', {}).keys())
+    run_plan['specs']  = specs
+
+    # Values asked to the user and not saved are not an input we can check, so the plan cannot be reused
+    run_plan['cacheable'] = not resolution.get('unsaved', None)
+    return run_plan
+
+def get_run_plan(group, conf=None, args=None, cached=True):
+    '''Get the run plan of a group with a given conf. The cached plan is used if its inputs are unchanged,
+    otherwise the plan is resolved and cached (unless some values were asked to the user and not saved).'''
+
+    if args is None:
+        args = get_run_plan_args()
+    args = json.loads(json.dumps(args))
+    run_plan_file = get_run_plan_file(group, conf)
+
+    if cached:
+        try:
+            with open(run_plan_file) as f:
+                run_plan = json.load(f, object_pairs_hook=OrderedDict)
+        except (IOError, ValueError):
+            logger.debug('No valid cached plan in %s', run_plan_file)
+        else:
+            if run_plan['inputs'] == get_run_plan_inputs(conf, args, run_plan['specs'], run_plan['inputs']['interfaces'].keys()):
+                print('Using the cached plan for group "{}" as its inputs are unchanged'.format(group))
+                return run_plan
+            logger.debug('Cached plan in %s is outdated', run_plan_file)
+
+    run_plan = resolve_run_plan(group, conf, args)
+    if run_plan['cacheable']:
+        if not os.path.isdir(os.path.dirname(run_plan_file)):
+            os.makedirs(os.path.dirname(run_plan_file))
+        with open(run_plan_file, 'w') as f:
+            json.dump(run_plan, f, indent=4, separators=(',', ': '))
+    else:
+        print('WARNING: some values were entered and not saved in host.conf, not caching the plan')
+    return run_plan
+
+def print_run_plans_diff(run_plan, other_run_plan):
+    '''Print the differences between the specs of two run plans, by instance'''
+    specs = OrderedDict([('{}-{}'.format(spec['service'], spec['instance']), spec) for spec in run_plan['specs']])
+    other_specs = OrderedDict([('{}-{}'.format(spec['service'], spec['instance']), spec) for spec in other_run_plan['specs']])
+    found_differences = False
+    for name in list(specs.keys()) + [name for name in other_specs if name not in specs]:
+        if name not in other_specs:
+            print('- {} (only in "{}")'.format(name, run_plan['conf']))
+        elif name not in specs:
+            print('+ {} (only in "{}")'.format(name, other_run_plan['conf']))
+        else:
+            changes = []
+            for key in specs[name]:
+                if key == 'env':
+                    env = OrderedDict(specs[name]['env'])
+                    other_env = OrderedDict(other_specs[name]['env'])
+                    for env_var in list(env.keys()) + [env_var for env_var in other_env if env_var not in env]:
+                        if env.get(env_var, None) != other_env.get(env_var, None):
+                            changes.append('env {}: {} -> {}'.format(env_var, json.dumps(env.get(env_var, None)), json.dumps(other_env.get(env_var, None))))
+                elif specs[name][key] != other_specs[name][key]:
+                    changes.append('{}: {} -> {}'.format(key, json.dumps(specs[name][key]), json.dumps(other_specs[name][key])))
+            if not changes:
+                continue
+            print('~ {}'.format(name))
+            for change in changes:
+                print('    {}'.format(change))
+        found_differences = True
+    if not found_differences:
+        print('No differences')
+
+#task
+def plan(group='all', conf=None, diff=None):
+    '''Resolve the instances of a group in a run plan, cached and used by the next runs of the group with the same
+    conf until its inputs change. If a diff conf is given, show the differences between the plans of the two confs.'''
+
+    print('Conf being used: "{}"'.format('default' if not conf else conf))
+    run_plan = get_run_plan(group, conf, cached=False)
+
+    if diff:
+        other_run_plan = get_run_plan(group, diff, cached=False)
+        print('\nDifferences in the plan for group "{}" from conf "{}" to conf "{}":'.format(group, run_plan['conf'], other_run_plan['conf']))
+        print_run_plans_diff(run_plan, other_run_plan)
+        return
+
+    print('\nPlan for group "{}" ({} instances){}:'.format(group, len(run_plan['specs']), ', saved in "{}"'.format(get_run_plan_file(group, conf)) if run_plan['cacheable'] else ''))
+    for spec in run_plan['specs']:
+        details = [spec['image'], spec['instance_type']]
+        if spec['ports']:
+            details.append('ports {}'.format(', '.join(spec['ports'])))
+        if spec['links']:
+            details.append('links {}'.format(', '.join(['{}:{}'.format('-'.join([item for item in link[1:] if item]), link[0]) for link in spec['links']])))
+        if spec['persistent_dir']:
+            details.append('persistent')
+        print('  {}-{}: {}'.format(spec['service'], spec['instance'], ', '.join(details)))
+
+
+#--------------------------
+# Data management
+#--------------------------
+
+def inspect_container(container):
+    '''Get the state of a container ("running", "paused", "exited" and so on), or None if it does not exist'''
+    out = os_shell('docker inspect -f "{{.State.Status}}" ' + container, capture=True)
+    if out.exit_code != 0:
+        return None
+    return out.stdout.strip()
+
+def reflink_tree(source, destination):
+    '''Clone a directory tree with reflinks (copy on write), if supported by the filesystem. Returns True on success.'''
+    if running_on_osx():
+        # APFS clones
+        command = 'cp -c -R -p "{}" "{}"'.format(source, destination)
+    elif running_on_unix():
+        command = 'cp -a --reflink=always "{}" "{}"'.format(source, destination)
+    else:
+        return False
+    if os_shell(command, capture=True).exit_code == 0:
+        return True
+    if os.path.exists(destination):
+        shutil.rmtree(destination)
+    return False
+
+def copy_file_metadata(source, destination, stat):
+    '''Copy permissions, times and (if allowed) ownership of a file or directory'''
+    shutil.copystat(source, destination)
+    try:
+        os.chown(destination, stat.st_uid, stat.st_gid)
+    except OSError:
+        pass
+
+def copy_tree(source, destination):
+    '''Copy a directory tree hardlinking the read-only files (they cannot be changed in place) and copying the
+    others in parallel. Returns the number of files copied and hardlinked.'''
+    files = []
+    hardlinked = 0
+    dirs = []
+    source_dev = os.stat(source).st_dev
+    for (dirpath, dirnames, filenames) in os.walk(source):
+        destination_dirpath = destination + dirpath[len(source):]
+        os.mkdir(destination_dirpath)
+        dirs.append((dirpath, destination_dirpath))
+        for name in dirnames + filenames:
+            path = os.path.join(dirpath, name)
+            destination_path = os.path.join(destination_dirpath, name)
+            stat = os.lstat(path)
+            if os.path.islink(path):
+                os.symlink(os.readlink(path), destination_path)
+                try:
+                    os.lchown(destination_path, stat.st_uid, stat.st_gid)
+                except OSError:
+                    pass
+            elif name in filenames:
+                if not os.path.isfile(path):
+                    logger.debug('Skipping special file "%s"', path)
+                    continue
+                # Read-only files on the same device are hardlinked, the others are copied
+                if not stat.st_mode & 0o222 and stat.st_dev == source_dev:
+                    try:
+                        os.link(path, destination_path)
+                        hardlinked += 1
+                        continue
+                    except OSError:
+                        pass
+                files.append((path, destination_path, stat))
+
+    def copy(item):
+        (path, destination_path, stat) = item
+        shutil.copyfile(path, destination_path)
+        copy_file_metadata(path, destination_path, stat)
+
+    if files:
+        pool = ThreadPool(CLONE_CONCURRENCY)
+        try:
+            pool.map(copy, files)
+        finally:
+            pool.close()
+
+    # Directories last, as creating their content changed their times
+    for (dirpath, destination_dirpath) in reversed(dirs):
+        copy_file_metadata(dirpath, destination_dirpath, os.stat(dirpath))
+
+    return (len(files), hardlinked)
+
+#task
+def clonedata(service=None, instance=None, to_instance=None, from_project=None, force=False):
+    '''Clone the persistent data of an instance to another instance, of the same project or from another project (given
+    its directory). Reflinks are used if supported, otherwise read-only files are hardlinked and the others copied. The
+    source instance must not be running, or be paused. If force is set, the data of the destination instance is replaced.'''
+
+    if not service or not instance or not to_instance:
+        abort('Please give the service, the instance and the destination instance (i.e. clonedata:postgres,one,two)')
+    force = booleanize(force=force)
+
+    # Source data dir and container
+    if from_project:
+        from_project_dir = os.path.abspath(from_project)
+        from_project_name = os.path.basename(from_project_dir).lower()
+        source = '{}/data_{}/{}-{}'.format(from_project_dir, from_project_name, service, instance)
+    else:
+        from_project_name = PROJECT_NAME
+        source = '{}/{}-{}'.format(DATA_DIR, service, instance)
+        if to_instance == instance:
+            abort('The destination instance must be different from the source one')
+    destination = '{}/{}-{}'.format(DATA_DIR, service, to_instance)
+
+    if not os.path.isdir(source):
+        abort('Cannot find the data of service "{}", instance "{}" (looking for "{}")'.format(service, instance, source))
+
+    # Check the instances states
+    if inspect_container('{}-{}-{}'.format(from_project_name, service, instance)) in ['running', 'restarting']:
+        abort('Service "{}", instance "{}" is running, pause it (docker pause {}-{}-{}) or stop it before cloning its data'.format(service, instance, from_project_name, service, instance))
+    if inspect_container('{}-{}-{}'.format(PROJECT_NAME, service, to_instance)) is not None:
+        abort('Service "{}", instance "{}" exists, clean it before cloning data on it'.format(service, to_instance))
+
+    if os.path.exists(destination):
+        if not force:
+            abort('Service "{}", instance "{}" has already some data (in "{}"), use force=True to replace it'.format(service, to_instance, destination))
+        print('Removing the existent data of service "{}", instance "{}"...'.format(service, to_instance))
+        shutil.rmtree(destination)
+    if not os.path.isdir(DATA_DIR):
+        os.makedirs(DATA_DIR)
+
+    print('Cloning data of service "{}", instance "{}"{} to instance "{}"...'.format(service, instance, ' of project "{}"'.format(from_project_name) if from_project else '', to_instance))
+    start = time.time()
+    if reflink_tree(source, destination):
+        print('Done, with reflinks (took {:.1f}s)'.format(time.time()-start))
+    else:
+        logger.debug('Reflinks not supported, falling back on copying')
+        try:
+            (copied, hardlinked) = copy_tree(source, destination)
+        except (IOError, OSError) as e:
+            if os.path.exists(destination):
+                shutil.rmtree(destination)
+            abort('Cannot clone the data: {}'.format(e))
+        print('Done, {} files copied and {} read-only files hardlinked (took {:.1f}s)'.format(copied, hardlinked, time.time()-start))
+
+
+def get_backup_snapshots():
+    '''Get the snapshots in the backup store, oldest first (the ones being written, hidden, are not included)'''
+    if not os.path.isdir(BACKUP_DIR+'/snapshots'):
+        return []
+    return sorted([snapshot for snapshot in os.listdir(BACKUP_DIR+'/snapshots') if not snapshot.startswith('.')])
+
+def load_backup_manifest(snapshot, name):
+    try:
+        with open('{}/snapshots/{}/{}.json'.format(BACKUP_DIR, snapshot, name)) as f:
+            return json.load(f)
+    except IOError:
+        return None
+
+def get_chunk_path(chunk):
+    return '{}/chunks/{}/{}'.format(BACKUP_DIR, chunk[0:2], chunk)
+
+def store_file_chunks(path):
+    '''Store the content of a file in the backup chunk store. Returns the list of its chunks and the bytes
+    actually written (the chunks already in the store are not written again).'''
+    chunks = []
+    written = 0
+    with open(path, 'rb') as f:
+        while True:
+            data = f.read(BACKUP_CHUNK_SIZE)
+            if not data:
+                break
+            chunk = hashlib.sha256(data).hexdigest()
+            chunks.append(chunk)
+            chunk_path = get_chunk_path(chunk)
+            if os.path.exists(chunk_path):
+                continue
+            compressed = zlib.compress(data, 6)
+            try:
+                os.makedirs(os.path.dirname(chunk_path))
+            except OSError:
+                pass
+            # Write and then rename, so that a chunk in the store is always complete
+            tmp_chunk_path = '{}.{}.tmp'.format(chunk_path, uuid.uuid4().hex)
+            with open(tmp_chunk_path, 'wb') as chunk_file:
+                chunk_file.write(compressed)
+            os.rename(tmp_chunk_path, chunk_path)
+            written += len(compressed)
+    return (chunks, written)
+
+def snapshot_data_dir(data_dir, previous_manifest=None):
+    '''Snapshot a data dir in the backup chunk store. The files with the same size, modification time and inode as in
+    the previous manifest (if any) are not read again. Returns the manifest entries and the bytes, the changed files and
+    the bytes written.'''
+    previous_entries = {}
+    if previous_manifest:
+        previous_entries = dict([(entry['path'], entry) for entry in previous_manifest['entries'] if entry['type'] == 'file'])
+
+    entries = []
+    to_store = []
+    for (dirpath, dirnames, filenames) in os.walk(data_dir):
+        for name in [''] + dirnames + filenames if dirpath == data_dir else dirnames + filenames:
+            path = os.path.join(dirpath, name) if name else dirpath
+            stat = os.lstat(path)
+            entry = OrderedDict([('path', os.path.relpath(path, data_dir)), ('mode', stat.st_mode & 0o7777),
+                                 ('uid', stat.st_uid), ('gid', stat.st_gid), ('mtime', stat.st_mtime)])
+            if os.path.islink(path):
+                entry['type'] = 'link'
+                entry['target'] = os.readlink(path)
+            elif os.path.isdir(path):
+                entry['type'] = 'dir'
+            elif os.path.isfile(path):
+                entry['type'] = 'file'
+                entry['size'] = stat.st_size
+                entry['inode'] = stat.st_ino
+                previous_entry = previous_entries.get(entry['path'], None)
+                if previous_entry and [previous_entry['size'], previous_entry['mtime'], previous_entry['inode']] == [entry['size'], entry['mtime'], entry['inode']]:
+                    entry['chunks'] = previous_entry['chunks']
+                else:
+                    to_store.append(entry)
+            else:
+                logger.debug('Skipping special file "%s"', path)
+                continue
+            entries.append(entry)
+
+    def store(entry):
+        return store_file_chunks(os.path.join(data_dir, entry['path']))
+
+    written = 0
+    if to_store:
+        pool = ThreadPool(BACKUP_CONCURRENCY)
+        try:
+            results = pool.map(store, to_store)
+        finally:
+            pool.close()
+        for (entry, (chunks, entry_written)) in zip(to_store, results):
+            entry['chunks'] = chunks
+            written += entry_written
+
+    return (entries, sum([entry['size'] for entry in entries if entry['type'] == 'file']), len(to_store), written)
+
+def set_file_metadata(path, entry):
+    if entry['type'] == 'link':
+        try:
+            os.lchown(path, entry['uid'], entry['gid'])
+        except OSError:
+            pass
+        return
+    try:
+        os.chown(path, entry['uid'], entry['gid'])
+    except OSError:
+        pass
+    os.chmod(path, entry['mode'])
+    os.utime(path, (entry['mtime'], entry['mtime']))
+
+def restore_data_dir(entries, data_dir):
+    '''Restore a data dir from the entries of a snapshot manifest'''
+
+    def restore_file(entry):
+        path = os.path.join(data_dir, entry['path'])
+        with open(path, 'wb') as f:
+            for chunk in entry['chunks']:
+                with open(get_chunk_path(chunk), 'rb') as chunk_file:
+                    f.write(zlib.decompress(chunk_file.read()))
+        set_file_metadata(path, entry)
+
+    for entry in entries:
+        path = os.path.normpath(os.path.join(data_dir, entry['path']))
+        if entry['type'] == 'dir':
+            if not os.path.isdir(path):
+                os.makedirs(path)
+        elif entry['type'] == 'link':
+            os.symlink(entry['target'], path)
+            set_file_metadata(path, entry)
+
+    pool = ThreadPool(BACKUP_CONCURRENCY)
+    try:
+        pool.map(restore_file, [entry for entry in entries if entry['type'] == 'file'])
+    finally:
+        pool.close()
+
+    # Directories last, as creating their content changed their times
+    for entry in reversed(entries):
+        if entry['type'] == 'dir':
+            set_file_metadata(os.path.normpath(os.path.join(data_dir, entry['path'])), entry)
+
+def get_data_dir_names(service=None, instance=None):
+    '''Get the names of the data dirs (service-instance, plus "shared") matching a service and an instance (with wildcards)'''
+    names = []
+    if os.path.isdir(DATA_DIR):
+        for name in sorted(os.listdir(DATA_DIR)):
+            # Hidden dirs are the ones being restored
+            if name.startswith('.') or not os.path.isdir(DATA_DIR+'/'+name):
+                continue
+            if '-' in name:
+                (name_service, name_instance) = name.rsplit('-', 1)
+            else:
+                (name_service, name_instance) = (name, '')
+            if fnmatch.fnmatch(name_service, service or '*') and fnmatch.fnmatch(name_instance, instance or '*'):
+                names.append(name)
+    return names
+
+#task
+def backup(service=None, instance=None):
+    '''Snapshot the data dirs of the project (or of the instances matching a service and an instance) in the backup
+    store. Files are stored in compressed chunks by their content, so that unchanged data is never stored twice. The
+    running instances are paused while snapshotting their data.'''
+
+    names = get_data_dir_names(service, instance)
+    if not names:
+        abort('No data to back up in "{}"'.format(DATA_DIR))
+
+    snapshots = get_backup_snapshots()
+    previous_snapshot = snapshots[-1] if snapshots else None
+    snapshot = time.strftime('%Y%m%d-%H%M%S')
+    if snapshot in snapshots:
+        abort('A snapshot named "{}" already exists, please retry in a second'.format(snapshot))
+
+    # The snapshot is written in a hidden dir and renamed once complete, so that an interrupted backup never becomes
+    # the latest snapshot (and the base of the next one). The ones left over by interrupted backups are removed.
+    for name in glob.glob(BACKUP_DIR+'/snapshots/.*.tmp'):
+        shutil.rmtree(name)
+    tmp_snapshot_dir = '{}/snapshots/.{}.tmp'.format(BACKUP_DIR, snapshot)
+    os.makedirs(tmp_snapshot_dir)
+    print('Creating snapshot "{}" in "{}"{}...'.format(snapshot, BACKUP_DIR, ' (incremental over "{}")'.format(previous_snapshot) if previous_snapshot else ''))
+
+    print('\n{:<30} {:>8} {:>8} {:>12} {:>12} {:>8} {:>8} {:>8}'.format('Data', 'Files', 'Changed', 'Size', 'Written', 'Dedup', 'Paused', 'Time'))
+    total_size = 0
+    total_written = 0
+    total_start = time.time()
+    try:
+        for name in names:
+            start = time.time()
+
+            # Quiesce the instance, if running
+            container = PROJECT_NAME+'-'+name
+            paused = inspect_container(container) == 'running'
+            if paused:
+                out = os_shell('docker pause '+container, capture=True)
+                if out.exit_code != 0:
+                    print(format_shell_error(out.stdout, out.stderr, out.exit_code))
+                    abort('Cannot pause "{}"'.format(container))
+            try:
+                previous_manifest = load_backup_manifest(previous_snapshot, name) if previous_snapshot else None
+                (entries, size, changed, written) = snapshot_data_dir(DATA_DIR+'/'+name, previous_manifest)
+            finally:
+                if paused:
+                    os_shell('docker unpause '+container, capture=True)
+            paused_time = time.time()-start if paused else 0
+
+            with open('{}/{}.json'.format(tmp_snapshot_dir, name), 'w') as f:
+                json.dump({'name': name, 'snapshot': snapshot, 'entries': entries}, f)
+
+            files = len([entry for entry in entries if entry['type'] == 'file'])
+            print('{:<30} {:>8} {:>8} {:>9.1f} MB {:>9.1f} MB {:>8} {:>7.1f}s {:>7.1f}s'.format(name, files, changed, size/1048576.0, written/1048576.0,
+                  '{:.1f}x'.format(size/float(written)) if written else '-', paused_time, time.time()-start))
+            total_size += size
+            total_written += written
+    except BaseException:
+        print('Backup stopped, discarding the incomplete snapshot')
+        shutil.rmtree(tmp_snapshot_dir, ignore_errors=True)
+        raise
+    os.rename(tmp_snapshot_dir, '{}/snapshots/{}'.format(BACKUP_DIR, snapshot))
+
+    print('\nDone, {:.1f} MB snapshotted with {:.1f} MB written (dedup ratio {}), took {:.1f}s'.format(total_size/1048576.0, total_written/1048576.0,
+          '{:.1f}x'.format(total_size/float(total_written)) if total_written else '-', time.time()-total_start))
+
+#task
+def restore(snapshot=None, service=None, instance=None, force=False):
+    '''Restore the data dirs of the project (or of the instances matching a service and an instance) from a snapshot
+    of the backup store ("latest" for the last one). If no snapshot is given, list the available ones. The instances
+    must not exist, and if they have some data already force has to be set to replace it.'''
+
+    snapshots = get_backup_snapshots()
+    if not snapshot:
+        if not snapshots:
+            print('No snapshots in "{}"'.format(BACKUP_DIR))
+        for snapshot in snapshots:
+            names = sorted([name[:-5] for name in os.listdir('{}/snapshots/{}'.format(BACKUP_DIR, snapshot)) if name.endswith('.json')])
+            print('{}: {}'.format(snapshot, ', '.join(names)))
+        return
+
+    if snapshot == 'latest':
+        if not snapshots:
+            abort('No snapshots in "{}"'.format(BACKUP_DIR))
+        snapshot = snapshots[-1]
+    if snapshot not in snapshots:
+        abort('Cannot find snapshot "{}" in "{}"'.format(snapshot, BACKUP_DIR))
+    force = booleanize(force=force)
+
+    # Select and check the data to restore
+    names = []
+    for name in sorted(os.listdir('{}/snapshots/{}'.format(BACKUP_DIR, snapshot))):
+        name = name[:-5]
+        (name_service, name_instance) = name.rsplit('-', 1) if '-' in name else (name, '')
+        if not fnmatch.fnmatch(name_service, service or '*') or not fnmatch.fnmatch(name_instance, instance or '*'):
+            continue
+        if inspect_container(PROJECT_NAME+'-'+name) is not None:
+            abort('Instance "{}" exists, clean it before restoring its data'.format(name))
+        if os.path.exists(DATA_DIR+'/'+name) and not force:
+            abort('There is already some data for "{}" (in "{}"), use force=True to replace it'.format(name, DATA_DIR+'/'+name))
+        names.append(name)
+    if not names:
+        abort('Nothing to restore in snapshot "{}"'.format(snapshot))
+
+    for name in names:
+        start = time.time()
+        print('Restoring "{}" from snapshot "{}"...'.format(name, snapshot))
+
+        # Restore in a hidden dir next to the data dir, and swap them only once restored
+        data_dir = DATA_DIR+'/'+name
+        tmp_data_dir = DATA_DIR+'/.'+name+'.restoring'
+        replaced_data_dir = DATA_DIR+'/.'+name+'.replaced'
+        for leftover_dir in [tmp_data_dir, replaced_data_dir]:
+            if os.path.exists(leftover_dir):
+                shutil.rmtree(leftover_dir)
+        try:
+            restore_data_dir(load_backup_manifest(snapshot, name)['entries'], tmp_data_dir)
+        except BaseException:
+            print('Restore stopped, leaving the data of "{}" as it was'.format(name))
+            shutil.rmtree(tmp_data_dir, ignore_errors=True)
+            raise
+        if os.path.exists(data_dir):
+            os.rename(data_dir, replaced_data_dir)
+            os.rename(tmp_data_dir, data_dir)
+            shutil.rmtree(replaced_data_dir)
+        else:
+            os.rename(tmp_data_dir, data_dir)
+        print('Done (took {:.1f}s)'.format(time.time()-start))
+
+
+#--------------------------
+# Logs
+#--------------------------
+
+def docker_api_request(path):
+    '''Send a GET request to the Docker daemon API, on the unix socket or on the (plain) TCP address set in the
+    DOCKER_HOST env var. HTTP/1.0 is used so that the body is never chunked and ends when the connection is closed.
+    Returns the status code, the socket and the part of the body already received.'''
+    docker_host = os.getenv('DOCKER_HOST', 'unix:///var/run/docker.sock')
+    try:
+        if docker_host.startswith('unix://'):
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.connect(docker_host[7:])
+        elif docker_host.startswith('tcp://'):
+            (host, port) = docker_host[6:].rstrip('/').rsplit(':', 1)
+            sock = socket.create_connection((host, int(port)))
+        else:
+            abort('Unsupported DOCKER_HOST "{}" (only unix:// and tcp:// are supported)'.format(docker_host))
+        sock.sendall('GET {} HTTP/1.0\r\nHost: docker\r\n\r\n'.format(path).encode('utf-8'))
+        response = b''
+        while b'\r\n\r\n' not in response:
+            data = sock.recv(4096)
+            if not data:
+                break
+            response += data
+    except (socket.error, ValueError) as e:
+        abort('Cannot connect to the Docker daemon on "{}" ({})'.format(docker_host, e))
+    (headers, _, body) = response.partition(b'\r\n\r\n')
+    try:
+        status_code = int(headers.split(b'\r\n')[0].split(b' ')[1])
+    except (IndexError, ValueError):
+        abort('Cannot understand the Docker daemon response "{}"'.format(headers.decode('utf-8', 'replace')))
+    return (status_code, sock, body)
+
+
+def docker_api_get(path):
+    '''Get a (JSON) resource from the Docker daemon API'''
+    (status_code, sock, body) = docker_api_request(path)
+    while True:
+        data = sock.recv(65536)
+        if not data:
+            break
+        body += data
+    sock.close()
+    if status_code != 200:
+        abort('Error from the Docker daemon for "{}": {} {}'.format(path, status_code, body.decode('utf-8', 'replace').strip()))
+    return json.loads(body.decode('utf-8'))
+
+
+def parse_since(since):
+    '''Convert a "since" value (an UNIX timestamp or a duration as 30s, 10m, 2h or 1d) in an UNIX timestamp'''
+    since = str(since).strip()
+    units = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+    try:
+        if since[-1] in units:
+            return int(time.time() - float(since[:-1]) * units[since[-1]])
+        return int(float(since))
+    except (IndexError, ValueError):
+        abort('Cannot understand since="{}", use an UNIX timestamp or a duration as 30s, 10m, 2h or 1d'.format(since))
+
+
+def get_log_sort_key(timestamp):
+    '''Docker timestamps are RFC3339 with nanoseconds and trailing zeros removed: pad them to be sortable as strings'''
+    (seconds, _, fraction) = timestamp.rstrip('Z').partition('.')
+    return seconds + '.' + fraction.ljust(9, '0')
+
+
+LOGS_MERGE_WINDOW       = 0.5
+LOGS_MAX_LINE_BYTES     = 64*1024
+LOGS_MAX_PENDING_LINES  = 1000
+
+#task
+def logs(service=None, instance=None, group=None, conf=None, follow=True, since=None, tail='all', grep=None, lines=None):
+    '''Follow the logs of all the instances of a group or matching a service (and instance) pattern, merged in
+    timestamp order. All the logs are read concurrently from the Docker API in a single loop.'''
+
+    # Switches
+    follow = booleanize(follow=follow)
+
+    if not service and not group:
+        abort('Please give a service (pattern), an instance or a group')
+    if tail != 'all':
+        try:
+            tail = int(tail)
+        except ValueError:
+            abort('Tail must be a number or "all", got "{}"'.format(tail))
+    if lines is not None and not isinstance(lines, int):
+        abort('Lines must be a number, got "{}"'.format(lines))
+    try:
+        grep = re.compile(grep) if grep is not None else None
+    except re.error as e:
+        abort('Wrong grep regular expression "{}" ({})'.format(grep, e))
+
+    # Get the instances to follow
+    if group:
+        if not conf:
+            conf = load_host_conf().get('last_conf', None)
+        wanted = []
+        for service_conf in get_services_run_conf(conf):
+            # Check for service and instance names, as when running
+            if 'service' not in service_conf:
+                abort('Missing service name for conf: {}'.format(service_conf))
+            if 'instance' not in service_conf:
+                abort('Missing instance name for conf: {}'.format(service_conf))
+            if service_conf['instance'] and (group == 'all' or service_conf.get('group', None) == group):
+                wanted.append((service_conf['service'], service_conf['instance']))
+        matches = lambda found_service, found_instance: (found_service, found_instance) in wanted
+    else:
+        if service == 'all':
+            service = '*'
+        matches = lambda found_service, found_instance: fnmatch.fnmatch(found_service, service) and fnmatch.fnmatch(found_instance, instance or '*')
+
+    containers = []
+    for container in docker_api_get('/containers/json?all=1'):
+        for name in container['Names']:
+            name = name.lstrip('/')
+            if name.startswith(PROJECT_NAME+'-') and '-' in name[len(PROJECT_NAME)+1:]:
+                (found_service, found_instance) = name[len(PROJECT_NAME)+1:].rsplit('-', 1)
+                if matches(found_service, found_instance):
+                    containers.append((container['Id'], '{}-{}'.format(found_service, found_instance)))
+    if not containers:
+        abort('No instances found matching the request')
+
+    # Open one log stream per instance. Containers with a TTY have a raw stream, the others a multiplexed one.
+    query = 'stdout=1&stderr=1&timestamps=1&tail={}'.format(tail)
+    if follow:
+        query += '&follow=1'
+    if since is not None:
+        query += '&since={}'.format(parse_since(since))
+    prefix_width = max([len(name) for (_, name) in containers])
+    streams = []
+    for (container_id, name) in sorted(containers, key=lambda container: container[1]):
+        tty = docker_api_get('/containers/{}/json'.format(container_id))['Config']['Tty']
+        (status_code, sock, body) = docker_api_request('/containers/{}/logs?{}'.format(container_id, query))
+        if status_code != 200:
+            sock.close()
+            print('WARNING: cannot get the logs of "{}" (error {})'.format(name, status_code))
+            continue
+        streams.append({'sock': sock, 'prefix': name.ljust(prefix_width) + ' | ', 'tty': tty,
+                        'data': b'', 'lines': {}, 'pending': 0})
+        streams[-1]['data'] = body
+
+    # Lines are kept for a short window before being printed, so that the ones from different
+    # instances can be merged in timestamp order. Every stream has a bounded amount of pending lines.
+    pending = []
+    counter = [0, 0]
+
+    def add_line(stream, line):
+        line = line.decode('utf-8', 'replace').rstrip('\r\n')
+        (timestamp, _, message) = line.partition(' ')
+        if grep and not grep.search(message):
+            return
+        heapq.heappush(pending, (get_log_sort_key(timestamp), counter[0], time.time(), stream, message))
+        counter[0] += 1
+        stream['pending'] += 1
+
+    def add_data(stream, data, kind=0):
+        buffer = stream['lines'].get(kind, b'') + data
+        while b'\n' in buffer:
+            (line, _, buffer) = buffer.partition(b'\n')
+            add_line(stream, line)
+        if len(buffer) > LOGS_MAX_LINE_BYTES:
+            add_line(stream, buffer[:LOGS_MAX_LINE_BYTES])
+            buffer = b''
+        stream['lines'][kind] = buffer
+
+    def process(stream):
+        if stream['tty']:
+            add_data(stream, stream['data'])
+            stream['data'] = b''
+        else:
+            # Multiplexed stream: frames with an 8 bytes header (stream type, 3 null bytes, payload size)
+            while len(stream['data']) >= 8:
+                (kind, size) = struct.unpack('>BxxxL', stream['data'][0:8])
+                if len(stream['data']) < 8 + size:
+                    break
+                add_data(stream, stream['data'][8:8+size], kind)
+                stream['data'] = stream['data'][8+size:]
+
+    def close(stream):
+        stream['sock'].close()
+        streams.remove(stream)
+        for buffer in stream['lines'].values():
+            if buffer:
+                add_line(stream, buffer)
+
+    try:
+        for stream in list(streams):
+            process(stream)
+
+        while streams or pending:
+            if streams:
+                readable = select.select([stream['sock'] for stream in streams], [], [], LOGS_MERGE_WINDOW if pending else None)[0]
+                for stream in [stream for stream in streams if stream['sock'] in readable]:
+                    data = stream['sock'].recv(65536)
+                    if data:
+                        stream['data'] += data
+                        process(stream)
+                    else:
+                        close(stream)
+
+            # Print the lines out of the merge window (or all of them if no more streams)
+            now = time.time()
+            while pending and (not streams or pending[0][2] <= now - LOGS_MERGE_WINDOW or
+                               max([stream['pending'] for stream in streams]) > LOGS_MAX_PENDING_LINES):
+                (_, _, _, stream, message) = heapq.heappop(pending)
+                stream['pending'] -= 1
+                print(stream['prefix'] + message)
+                sys.stdout.flush()
+                counter[1] += 1
+                if lines is not None and counter[1] >= lines:
+                    return
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for stream in streams:
+            stream['sock'].close()
+
+
+#--------------------------
+# Images distribution
+#--------------------------
+
+def get_layers_chain_ids(diff_ids):
+    '''Compute the chain IDs for a list of layer diff IDs, as per the OCI image spec'''
+    chain_ids = []
+    for diff_id in diff_ids:
+        if not chain_ids:
+            chain_ids.append(diff_id)
+        else:
+            chain_ids.append('sha256:' + hashlib.sha256('{} {}'.format(chain_ids[-1], diff_id).encode('utf-8')).hexdigest())
+    return chain_ids
+
+def load_bundle_metadata(bundle_file):
+    '''Load the Reyns metadata of a bundle'''
+    try:
+        with tarfile.open(bundle_file, 'r:gz') as bundle_tar:
+            return json.loads(bundle_tar.extractfile('reyns_bundle.json').read().decode('utf-8'))
+    except (IOError, KeyError, tarfile.TarError) as e:
+        abort('Cannot read bundle metadata from "{}" ({}: {})'.format(bundle_file, e.__class__.__name__, e))
+
+def bundle_save(bundle_file, since=None):
+    '''Save the project and Reyns images, with their IDs and the run confs, in a compressed bundle. Layers are
+    stored only once, and if a previous bundle is given, layers already shipped with it are not stored at all.'''
+
+    # Get the project and Reyns images (do not use .format as there are too many graph brackets)
+    out = os_shell('docker images --format "{{.Repository}}:{{.Tag}}"', capture=True)
+    if out.exit_code != 0:
+        print(format_shell_error(out.stdout, out.stderr, out.exit_code))
+        abort('Cannot list the images')
+    images = sorted(set([image for image in out.stdout.split('\n') if (image.startswith(PROJECT_NAME+'/') or image.startswith('reyns/')) and not image.endswith(':<none>')]))
+    if not images:
+        abort('No project or Reyns images found, nothing to save')
+    print('Saving {} images: {}'.format(len(images), ', '.join(images)))
+
+    # Layers chains already on the target according to the previous bundle, if any
+    since_metadata  = load_bundle_metadata(since) if since else None
+    since_chain_ids = set(since_metadata['chain_ids']) if since_metadata else set()
+
+    start_time = time.time()
+    tmp_dir = tempfile.mkdtemp(prefix='reyns_bundle_')
+    try:
+        images_tar_path = tmp_dir + '/images.tar'
+        out = os_shell('docker save -o {} {}'.format(images_tar_path, ' '.join(images)), capture=True)
+        if out.exit_code != 0:
+            print(format_shell_error(out.stdout, out.stderr, out.exit_code))
+            abort('Something failed when executing "docker save"')
+
+        with tarfile.open(images_tar_path) as images_tar:
+            manifest = json.loads(images_tar.extractfile('manifest.json').read().decode('utf-8'))
+
+            # Map every layer diff ID (from the image configs) on a single layer file, and every
+            # layer file on the chain IDs it is used in
+            image_ids       = {}
+            chain_ids       = set()
+            layer_paths     = {}
+            all_layer_paths = set()
+            layer_chain_ids = {}
+            for image_manifest in manifest:
+                image_config = json.loads(images_tar.extractfile(image_manifest['Config']).read().decode('utf-8'))
+                diff_ids = image_config['rootfs']['diff_ids']
+                image_chain_ids = get_layers_chain_ids(diff_ids)
+                chain_ids.update(image_chain_ids)
+                for i, layer_path in enumerate(image_manifest['Layers']):
+                    all_layer_paths.add(layer_path)
+                    layer_paths.setdefault(diff_ids[i], layer_path)
+                    image_manifest['Layers'][i] = layer_paths[diff_ids[i]]
+                    layer_chain_ids.setdefault(layer_paths[diff_ids[i]], set()).add(image_chain_ids[i])
+                for repo_tag in image_manifest.get('RepoTags') or []:
+                    image_ids[repo_tag] = 'sha256:' + image_manifest['Config'].split('/')[-1].replace('.json', '')
+
+            # Duplicated layer files are not needed anymore, and layers whose chains are already on
+            # the target are skipped, as "docker load" does not read layers it already has.
+            duplicate_layer_paths = all_layer_paths - set(layer_paths.values())
+            skipped_layer_paths   = set([path for path in layer_chain_ids if layer_chain_ids[path].issubset(since_chain_ids)])
+
+            metadata = {'project':   PROJECT_NAME,
+                        'created':   time.strftime('%Y-%m-%d %H:%M:%S'),
+                        'images':    image_ids,
+                        'chain_ids': sorted(chain_ids),
+                        'requires':  sorted(set(since_metadata['images'].values())) if since_metadata else [],
+                        'confs':     [conf_file for conf_file in sorted(os.listdir(PROJECT_DIR)) if conf_file.endswith('.conf') and conf_file != 'host.conf']}
+
+            # Write the bundle, metadata first
+            with tarfile.open(bundle_file, 'w:gz') as bundle_tar:
+
+                def add_json(name, content):
+                    data = json.dumps(content, indent=1).encode('utf-8')
+                    tarinfo = tarfile.TarInfo(name)
+                    tarinfo.size  = len(data)
+                    tarinfo.mtime = int(time.time())
+                    bundle_tar.addfile(tarinfo, BytesIO(data))
+
+                add_json('reyns_bundle.json', metadata)
+                add_json('manifest.json', manifest)
+                for conf_file in metadata['confs']:
+                    bundle_tar.add(PROJECT_DIR + '/' + conf_file, arcname='confs/' + conf_file)
+                for member in images_tar.getmembers():
+                    if member.name == 'manifest.json' or member.name in duplicate_layer_paths or member.name in skipped_layer_paths:
+                        continue
+                    bundle_tar.addfile(member, images_tar.extractfile(member) if member.isfile() else None)
+    finally:
+        shutil.rmtree(tmp_dir)
+
+    print('Saved bundle "{}" ({:.1f} MB) in {:.1f}s: {} layers stored, {} duplicated layers removed.'.format(bundle_file, os.path.getsize(bundle_file)/1048576.0,
+          time.time()-start_time, len(layer_chain_ids)-len(skipped_layer_paths), len(duplicate_layer_paths)))
+    if since:
+        print('{} layers not stored as already shipped with "{}".'.format(len(skipped_layer_paths), since))
+
+def bundle_load(bundle_file):
+    '''Load a bundle saved with bundle_save. Docker only imports the layers missing on this host.'''
+
+    metadata = load_bundle_metadata(bundle_file)
+    if metadata['project'] != PROJECT_NAME:
+        if not confirm('WARNING: this bundle was saved for project "{}" while this is project "{}". Proceed?'.format(metadata['project'], PROJECT_NAME)):
+            abort('Exiting...')
+
+    # Check what we already have. Do not use .format as there are too many graph brackets.
+    def get_image_id(image):
+        out = os_shell('docker inspect --format "{{.Id}}" ' + image, capture=True)
+        return out.stdout.strip() if out.exit_code == 0 else None
+
+    missing_images = [image for image in metadata['images'] if get_image_id(image) != metadata['images'][image]]
+    if not missing_images:
+        print('All the {} images of the bundle are already up to date, nothing to load.'.format(len(metadata['images'])))
+    else:
+        # Incremental bundles require the images of the bundle they were saved against
+        missing_requirements = [image_id for image_id in metadata['requires'] if not get_image_id(image_id)]
+        if missing_requirements:
+            abort('This bundle is incremental and requires images not present on this host ({}). Load the previous bundle first, or save a full one'.format(', '.join(missing_requirements)))
+
+        print('Loading {} new or updated images: {}'.format(len(missing_images), ', '.join(sorted(missing_images))))
+        start_time = time.time()
+        out = os_shell('docker load -i {}'.format(bundle_file), capture=True)
+        if out.exit_code != 0:
+            print(format_shell_error(out.stdout, out.stderr, out.exit_code))
+            abort('Something failed when executing "docker load"')
+        print('Loaded in {:.1f}s'.format(time.time()-start_time))
+
+    # Confs: never overwrite the local ones
+    with tarfile.open(bundle_file, 'r:gz') as bundle_tar:
+        for conf_file in metadata['confs']:
+            conf_content = bundle_tar.extractfile('confs/' + conf_file).read()
+            if not os.path.exists(PROJECT_DIR + '/' + conf_file):
+                with open(PROJECT_DIR + '/' + conf_file, 'wb') as f:
+                    f.write(conf_content)
+                print('Restored conf "{}"'.format(conf_file))
+            else:
+                with open(PROJECT_DIR + '/' + conf_file, 'rb') as f:
+                    if f.read() != conf_content:
+                        print('WARNING: conf "{}" differs from the one in the bundle, not overwriting it.'.format(conf_file))
+
+#task
+def bundle(action=None, file=None, since=None):
+    '''Save (bundle:save) or load (bundle:load) the project and Reyns images in a bundle, i.e. for offline
+    distribution on multiple nodes. Use "since" to save only what changed since a previous bundle.'''
+
+    bundle_file = get_project_path(file) if file else '{}/{}.bundle.tar.gz'.format(PROJECT_DIR, PROJECT_NAME)
+    if since:
+        since = get_project_path(since)
+    if action == 'save':
+        if since and not os.path.isfile(since):
+            abort('Cannot find the previous bundle "{}"'.format(since))
+        bundle_save(bundle_file, since=since)
+    elif action == 'load':
+        if not os.path.isfile(bundle_file):
+            abort('Cannot find the bundle "{}"'.format(bundle_file))
+        bundle_load(bundle_file)
+    else:
+        abort('Unknown bundle action "{}", use "bundle:save" or "bundle:load"'.format(action))
+
+
+
+#--------------------------
+# Tasks
+#--------------------------
+
+tasks = OrderedDict()
+tasks['build']        = [build, '    Build services' ]
+tasks['run']          = [run, '      Run a given service(s)'] 
+tasks['rerun']        = [rerun, '    Re-run a given service(s)'] 
+tasks['plan']         = [plan, '     Resolve and cache the run plan of a group of services']
+tasks['watch']        = [watch, '    Rebuild and re-run a service on changes'] 
+tasks['ignore']       = [dockerignore, '   Generate the .dockerignore file of a service']
+tasks['ps']           = [ps, '       List running services' ]    
+tasks['status']       = [status, '   Running services status' ] 
+tasks['ssh']          = [ssh, '      SSH into a given service']
+tasks['shell']        = [shell, '    Open a shell into a given service']
+tasks['clean']        = [clean, '    Clean a given service']
+tasks['scale']        = [scale, '    Set the number of replicas of a service']
+tasks['getip']        = [getip, '    Get the IP address of a given service']
+tasks['info']         = [info, '     Obtain info about a given service']    
+tasks['lbstats']      = [lbstats, '  Show the load balancers backends counters']
+tasks['clonedata']    = [clonedata, 'Clone the persistent data of an instance']
+tasks['backup']       = [backup, '   Snapshot the project data in the backup store']
+tasks['restore']      = [restore, '  Restore the project data from a backup snapshot']
+tasks['cpumap']       = [cpumap, '   Show the host CPU cores map of the pinned instances']
+tasks['ports']        = [ports, '    Show the host ports reserved by the instances']
+tasks['facts']        = [facts, '    Show the host facts (interfaces, CPUs, memory, Docker)']
+tasks['logs']         = [logs, '     Follow the logs of a group or of given service(s)']
+tasks['bundle']       = [bundle, '   Save or load the project images bundle']
+tasks['instdemo']     = [install_demo, ' Install demo project in current directory']  
+tasks['help']         = [help, '     Show this help']  
+tasks['version']      = [version, '  Get Reyns version']
+tasks['uninstall']    = [uninstall, 'Uninstall Reyns' ]
+tasks['init']         = [init, '     Init base Reyns images' ]
+tasks['setup']        = [setup, '    Setup Reyns project' ]
+tasks['daemon']        = [daemon, '   Run a simple daemon for a Reyns project' ]
+tasks['batch']        = [batch, '    Run many commands from a file or stdin in a single process' ]
+tasks['_install']     = [install, ' Install Reyns' ]
+tasks['_start']       = [start, '   Start a stopped service (if you know what you are doing)' ]
+tasks['_stop']        = [stop, '    Stop a running service (if you know what you are doing)' ]
+
+
+#--------------------------
+# Python API
+#--------------------------
+
+class Client(object):
+    '''Drive Reyns from Python, without going trough the command line. Methods return structured results (the
+    same records of the "json" output format) and raise ReynsError instead of exiting or prompting the user,
+    unless interactive is set (as for the command line). Example:
+
+        import reyns
+        client = reyns.Client(project_dir='/path/to/project')
+        client.build('all')
+        client.run(group='all')
+        for instance in client.ps():
+            print(instance['service'], instance['instance'], instance['status'])
+
+    The project settings are module-wide and applied for the duration of each call: clients must not be used
+    concurrently in different threads. If quiet is set, the progress messages printed by Reyns are discarded.'''
+
+    def __init__(self, project_dir=None, project_name=None, data_dir=None, services_dir=None, interactive=False, quiet=False):
+        self.interactive = interactive
+        self.quiet = quiet
+        self.settings = {'PROMPTS_ENABLED': interactive}
+        if project_dir:
+            project_dir = os.path.abspath(project_dir)
+            project_name = (project_name or os.path.basename(project_dir)).lower()
+            reyns_dir = os.path.dirname(os.path.abspath(__file__))
+            self.settings.update({'PROJECT_DIR': project_dir,
+                                  'PROJECT_DIR_CROSSPLAT': project_dir,
+                                  'PROJECT_NAME': project_name,
+                                  'DATA_DIR': data_dir or project_dir + '/data_' + project_name,
+                                  'SERVICES_IMAGES_DIR': services_dir or project_dir + '/services',
+                                  'BASE_IMAGES_DIR': os.getenv('BASE_IMAGES_DIR', reyns_dir + '/base'),
+                                  'BACKUP_DIR': os.getenv('BACKUP_DIR', project_dir + '/backups_' + project_name),
+                                  'HOST_FACTS_FILE': project_dir + '/.host_facts.json',
+                                  'CWD': reyns_dir})
+            if running_on_windows() and len(project_dir) >= 3 and project_dir[1:3] == ':/':
+                self.settings['PROJECT_DIR_CROSSPLAT'] = '/{}/{}'.format(project_dir[0].lower(), project_dir[3:])
+        elif project_name or data_dir or services_dir:
+            raise ReynsError('The project name and dirs can be set only together with the project dir')
+
+    def call(self, task, *args, **kwargs):
+        '''Call a task (as the ones of the command line) with the settings of this client'''
+        if task not in tasks:
+            raise ReynsError('Unknown command "{}"'.format(task))
+        return self.apply(tasks[task][0], *args, **kwargs)
+
+    def apply(self, function, *args, **kwargs):
+        '''Call a function of this module with the settings of this client'''
+        module = sys.modules[__name__]
+        previous_settings = dict([(name, getattr(module, name)) for name in self.settings])
+        previous_cwd = os.getcwd()
+        previous_stdout = sys.stdout
+        for (name, value) in self.settings.items():
+            setattr(module, name, value)
+        try:
+            os.chdir(CWD)
+            if self.quiet:
+                sys.stdout = open(os.devnull, 'w')
+            return function(*args, **kwargs)
+        except SystemExit as e:
+            # Some tasks (i.e. ssh) exit with the exit code of the command they run
+            if self.interactive:
+                raise
+            if e.code:
+                raise ReynsError('"{}" exited with code {}'.format(function.__name__, e.code))
+        finally:
+            if self.quiet:
+                sys.stdout.close()
+            sys.stdout = previous_stdout
+            os.chdir(previous_cwd)
+            for (name, value) in previous_settings.items():
+                setattr(module, name, value)
+
+    def build(self, service='all', **kwargs):
+        '''Build a service (or "all" of them), see the build task for the arguments. Returns a record with the
+        service, the time taken and the shared build cache hits and misses.'''
+        build_cache_stats.update({'hits': 0, 'misses': 0})
+        start = time.time()
+        self.call('build', service, built=[], **kwargs)
+        return OrderedDict([('service', service), ('time', time.time()-start),
+                            ('cache_hits', build_cache_stats['hits']), ('cache_misses', build_cache_stats['misses'])])
+
+    def run(self, service=None, instance=None, **kwargs):
+        '''Run a service instance or a group, see the run task for the arguments. Returns the records (see ps) of
+        the instance, or of all the instances of the project if running a group.'''
+        self.call('run', service, instance, **kwargs)
+        if service and not kwargs.get('group', None) and service != 'all':
+            return self.ps(service, instance)
+        return self.ps()
+
+    def clean(self, service=None, instance=None, **kwargs):
+        '''Clean a service instance or a group, see the clean task for the arguments'''
+        self.call('clean', service, instance, **kwargs)
+
+    def ps(self, service='project', instance=None):
+        '''Get the records of the instances of the project (with service "all" also the not running ones),
+        or of a given service (wildcards allowed) and instance.'''
+        def get_ps_records():
+            if service in ['all', 'project', 'platform', 'reallyall']:
+                entries = ps(service, instance, capture=True)
+            else:
+                entries = info(service, instance, capture=True)
+            return [get_ps_record(entry) for entry in entries or []]
+        return self.apply(get_ps_records)
+
+    def status(self):
+        '''Get the status records of the instances of the project, with their processes'''
+        return self.apply(lambda: list(get_status_records()))
+
+    def execute(self, service, instance, command):
+        '''Execute a command in a service instance (as the "reyns" user) and return a record with its stdout,
+        stderr and exit code. Also available as "exec" on Python 3.'''
+        return self.apply(exec_shell_command, service, instance, command)
+
+# "exec" is a keyword in Python 2
+setattr(Client, 'exec', Client.execute)
 
 
 #--------------------
@@ -2404,31 +5809,20 @@ def make_it_a_duck(val):
 
 
 
-if __name__ == '__main__':
-    
-    # Get task and args 
-    if len(sys.argv) == 1:
-        help()
-        
-    elif len(sys.argv) == 2:
-        # This happens on some OSes
-        args = sys.argv[1]
-        
-    else:
-        # This happens on some other OSes
-        args = ' '.join(sys.argv[1:])
+def parse_command(command):
+    '''Parse a command in the "task:arg1,arg2,key1=value1,key2=value2" syntax in the task name and its args and kwargs'''
 
     # Get task from args
-    if ':' in args:
+    if ':' in command:
         task=None
         try:
-            args_pieces  = args.split(':')
+            args_pieces  = command.split(':')
             task = args_pieces[0]
             args = ':'.join(args_pieces[1:])
         except (ValueError, IndexError):
-            raise InputException('Erro in parsing command arguments: task={} args="{}"'.format(task,args))
+            raise InputException('Erro in parsing command arguments: task={} args="{}"'.format(task,command))
     else:
-        task = sys.argv[1]
+        task = command.split(' ')[0]
         args = None
 
     # Debug
@@ -2442,10 +5836,6 @@ if __name__ == '__main__':
     # reyns ssh:demo,one,command="whoami \& >/dev/null"
     # reyns ssh:demo,one,command="cat /etc/resolv.conf"
     # reyns ssh:demo,one,command="cat \/etc\/resolv.conf"
-        
-    # Note: the Bash script which inovokes this Python script ensures that
-    # there will never be an empty task, as not having arguments on command line 
-    # lead to defaulting to the "help" task. TODO: this is not robust, improve it. 
 
     argv   = []
     kwargs = {}
@@ -2469,37 +5859,40 @@ if __name__ == '__main__':
                 arg = i
                 val = part
                 argv.append(make_it_a_duck(val))
+
+    return (task, argv, kwargs)
+
+
+if __name__ == '__main__':
     
+    # Get task and args 
+    if len(sys.argv) == 1:
+        help()
+        
+    elif len(sys.argv) == 2:
+        # This happens on some OSes
+        args = sys.argv[1]
+        
+    else:
+        # This happens on some other OSes
+        args = ' '.join(sys.argv[1:])
+
+    # Note: the Bash script which inovokes this Python script ensures that
+    # there will never be an empty task, as not having arguments on command line 
+    # lead to defaulting to the "help" task. TODO: this is not robust, improve it. 
+
+    # Parse the command
+    (task, argv, kwargs) = parse_command(args)
+
     # Debug
     logger.debug('Processed argv: %s' % argv)
     logger.debug('Processed kwargs: %s' % kwargs)
 
-    # Tasks mapping
-    from collections import OrderedDict
-    tasks = OrderedDict()
-    tasks['build']        = [build, '    Build services' ]
-    tasks['run']          = [run, '      Run a given service(s)'] 
-    tasks['rerun']        = [rerun, '    Re-run a given service(s)'] 
-    tasks['ps']           = [ps, '       List running services' ]    
-    tasks['status']       = [status, '   Running services status' ] 
-    tasks['ssh']          = [ssh, '      SSH into a given service']
-    tasks['shell']        = [shell, '    Open a shell into a given service']
-    tasks['clean']        = [clean, '    Clean a given service']
-    tasks['getip']        = [getip, '    Get the IP address of a given service']
-    tasks['info']         = [info, '     Obtain info about a given service']    
-    tasks['instdemo']     = [install_demo, ' Install demo project in current directory']  
-    tasks['help']         = [help, '     Show this help']  
-    tasks['version']      = [version, '  Get Reyns version']
-    tasks['uninstall']    = [uninstall, 'Uninstall Reyns' ]
-    tasks['init']         = [init, '     Init base Reyns images' ]
-    tasks['setup']        = [setup, '    Setup Reyns project' ]
-    tasks['daemon']        = [daemon, '   Run a simple daemon for a Reyns project' ]
-    tasks['_install']     = [install, ' Install Reyns' ]
-    tasks['_start']       = [start, '   Start a stopped service (if you know what you are doing)' ]
-    tasks['_stop']        = [stop, '    Stop a running service (if you know what you are doing)' ]
+    # Machine-readable output, do not add anything to it
+    machine_output = ('jsonout' in kwargs and kwargs['jsonout']) or kwargs.get('format', 'text') in ['json', 'ndjson']
 
     # Output cleareness
-    if ('jsonout' not in kwargs) or ('jsonout' in kwargs and kwargs['jsonout']==False):
+    if not machine_output:
         print('')
         
     # Load proper task
@@ -2509,14 +5902,23 @@ if __name__ == '__main__':
             if task[0] != '_':
                 print('  {}   {}'.format(task, tasks[task][1]))
     else:
-        # D not refactor with an "except KeyError" here, or you will end up in hiding errors
-        if task not in tasks:
-            abort('Unknown command "{}". Type "reyns help" for a list of available commands'.format(task))
-        else:
-            tasks[task][0](*argv, **kwargs)
+        # The command line is just an interactive client
+        try:
+            # D not refactor with an "except KeyError" here, or you will end up in hiding errors
+            if task not in tasks:
+                abort('Unknown command "{}". Type "reyns help" for a list of available commands'.format(task))
+            Client(interactive=True).call(task, *argv, **kwargs)
+        except ReynsError as e:
+            # Keep the machine-readable output clean
+            print('Aborting due to fatal error: {}. \n'.format(e), file=sys.stderr if machine_output else sys.stdout)
+            sys.exit(1)
+        except KeyboardInterrupt:
+            cancel_shell_commands()
+            print('\nInterrupted.\n')
+            sys.exit(130)
 
     # Output cleareness
-    if not running_on_windows() and ('jsonout' not in kwargs) or ('jsonout' in kwargs and kwargs['jsonout']==False):
+    if not running_on_windows() and not machine_output:
         print('')    
 
 
@@ -0,0 +1,157 @@
+#--------------------------
+# Imports
+#--------------------------
+
+import os
+import sys
+import time
+import signal
+import asyncio
+import threading
+from collections import namedtuple
+
+# The engine loop runs in its own thread, and before Python 3.8 the subprocesses can be
+# handled only by a loop running in the main thread (see asyncio's child watchers).
+if sys.version_info < (3, 8):
+    raise ImportError('The Reyns execution engine requires Python 3.8 or later')
+
+
+#--------------------------
+# Results
+#--------------------------
+
+# Result of a command: the command itself, its stdout and stderr (as str), its exit code, the time
+# it took (in seconds) and if it was killed as its timeout was reached.
+Result = namedtuple('Result', 'command stdout stderr exit_code elapsed timed_out')
+
+# Exit code of the commands killed as their timeout was reached, as for the "timeout" utility
+TIMEOUT_EXIT_CODE = 124
+
+
+#--------------------------
+# Engine
+#--------------------------
+
+class Engine(object):
+    '''Execute external commands with asyncio, in an event loop running in a background thread, so that
+    they can be submitted from any thread (i.e. from the thread pools of the Reyns tasks) and from
+    synchronous code. At most "concurrency" commands run at the same time, and at most "host_concurrency"
+    at the same time on the same host (i.e. the same Docker daemon). Commands are started in their own
+    process group, so that on timeout or cancellation all their children are killed as well.'''
+
+    def __init__(self, concurrency=16, host_concurrency=8):
+        self.concurrency = concurrency
+        self.host_concurrency = host_concurrency
+        self.loop = asyncio.new_event_loop()
+        self.tasks = set()
+        self.semaphore = None
+        self.host_semaphores = {}
+        self.thread = threading.Thread(target=self.loop.run_forever, name='reyns-engine')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def get_semaphores(self, host):
+        # Semaphores must be created in the loop thread
+        if self.semaphore is None:
+            self.semaphore = asyncio.Semaphore(self.concurrency)
+        if host not in self.host_semaphores:
+            self.host_semaphores[host] = asyncio.Semaphore(self.host_concurrency)
+        return (self.semaphore, self.host_semaphores[host])
+
+    def kill(self, process):
+        '''Kill a process and all its children'''
+        try:
+            os.killpg(process.pid, signal.SIGKILL)
+        except OSError:
+            pass
+
+    async def execute(self, command, timeout=None, host=None, input=None, env=None):
+        '''Execute a command and return its Result. The command can be a string, executed by the shell, or a
+        list of arguments, executed directly. The input (bytes), if any, is written to its stdin, and the env
+        (a dict), if any, replaces the environment of the command. If the timeout
+        (in seconds) is reached, the command is killed. If cancelled, the command is killed before propagating
+        the cancellation.'''
+        (semaphore, host_semaphore) = self.get_semaphores(host)
+        async with semaphore:
+            async with host_semaphore:
+                start = time.time()
+                streams = dict(stdin=asyncio.subprocess.DEVNULL if input is None else asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE,
+                               stderr=asyncio.subprocess.PIPE, start_new_session=True, env=env)
+                try:
+                    if isinstance(command, list):
+                        process = await asyncio.create_subprocess_exec(*command, **streams)
+                    else:
+                        process = await asyncio.create_subprocess_shell(command, **streams)
+                except OSError as e:
+                    # As the shell does when the command is not found
+                    return Result(command, '', str(e), 127, time.time()-start, False)
+                communication = asyncio.ensure_future(process.communicate(input))
+                timed_out = False
+                try:
+                    (stdout, stderr) = await asyncio.wait_for(asyncio.shield(communication), timeout)
+                except asyncio.TimeoutError:
+                    timed_out = True
+                    self.kill(process)
+                    (stdout, stderr) = await communication
+                except asyncio.CancelledError:
+                    self.kill(process)
+                    await asyncio.wait([communication])
+                    raise
+                return Result(command, stdout.decode('UTF-8', 'replace'), stderr.decode('UTF-8', 'replace'),
+                              TIMEOUT_EXIT_CODE if timed_out else process.returncode, time.time()-start, timed_out)
+
+    async def execute_many(self, commands, timeout=None, hosts=None):
+        '''Execute many commands concurrently (within the concurrency limits) and return their
+        Results, in order. The hosts of the commands can be given as a list. If one of the commands
+        fails to start, the others are cancelled.'''
+        if not commands:
+            return []
+        hosts = hosts or [None]*len(commands)
+        tasks = [asyncio.ensure_future(self.execute(command, timeout=timeout, host=host)) for (command, host) in zip(commands, hosts)]
+        try:
+            return await asyncio.gather(*tasks)
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            await asyncio.wait(tasks)
+            raise
+
+    def run(self, coroutine):
+        '''Run a coroutine in the engine loop and wait for its result. If interrupted (i.e. by Ctrl-C), all the
+        commands running in the engine are cancelled, and their processes killed, before propagating.'''
+        future = asyncio.run_coroutine_threadsafe(self.track(coroutine), self.loop)
+        try:
+            return future.result()
+        except KeyboardInterrupt:
+            self.cancel_all()
+            raise
+
+    async def track(self, coroutine):
+        task = asyncio.ensure_future(coroutine)
+        self.tasks.add(task)
+        try:
+            return await task
+        finally:
+            self.tasks.discard(task)
+
+    def cancel_all(self, timeout=10):
+        '''Cancel all the commands running in the engine, and wait (up to the timeout) for their processes
+        to be killed'''
+        async def cancel():
+            tasks = list(self.tasks)
+            for task in tasks:
+                task.cancel()
+            if tasks:
+                await asyncio.wait(tasks)
+        try:
+            asyncio.run_coroutine_threadsafe(cancel(), self.loop).result(timeout)
+        except Exception:
+            pass
+
+    def shell(self, command, timeout=None, host=None, input=None, env=None):
+        '''Execute a command (a string or a list of arguments) synchronously and return its Result'''
+        return self.run(self.execute(command, timeout=timeout, host=host, input=input, env=env))
+
+    def shell_many(self, commands, timeout=None, hosts=None):
+        '''Execute many commands (strings or lists of arguments) concurrently and return their Results, in order'''
+        return self.run(self.execute_many(commands, timeout=timeout, hosts=hosts))
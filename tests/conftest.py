@@ -0,0 +1,5 @@
+# Make reyns.py importable from the tests, which do not need Docker
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,49 @@
+import os
+import time
+
+import reyns
+
+
+def write(path, content):
+    with open(path, 'w') as f:
+        f.write(content)
+
+
+def make_context(tmp_path):
+    context_dir = str(tmp_path)
+    write(os.path.join(context_dir, 'Dockerfile'), 'FROM reyns/reyns-base-ubuntu18.04\nARG BUILDING_UID\nCOPY run.sh /\n')
+    write(os.path.join(context_dir, 'run.sh'), 'echo hello\n')
+    write(os.path.join(context_dir, 'notes.txt'), 'not used by the Dockerfile\n')
+    return context_dir
+
+
+def test_get_build_hash_inputs(tmp_path):
+    context_dir = make_context(tmp_path)
+    build_hash = reyns.get_build_hash(context_dir, 'Dockerfile', '--build-arg BUILDING_UID=1000', 'sha256:abc')
+
+    # Stable, and not depending on times or on files not used
+    os.utime(os.path.join(context_dir, 'run.sh'), (time.time() - 100, time.time() - 100))
+    write(os.path.join(context_dir, 'notes.txt'), 'changed\n')
+    assert reyns.get_build_hash(context_dir, 'Dockerfile', '--build-arg BUILDING_UID=1000', 'sha256:abc') == build_hash
+
+    # Depending on the build args (i.e. the user ones), the base image and the files used
+    assert reyns.get_build_hash(context_dir, 'Dockerfile', '--build-arg BUILDING_UID=1001', 'sha256:abc') != build_hash
+    assert reyns.get_build_hash(context_dir, 'Dockerfile', '--build-arg BUILDING_UID=1000', 'sha256:def') != build_hash
+    os.chmod(os.path.join(context_dir, 'run.sh'), 0o755)
+    assert reyns.get_build_hash(context_dir, 'Dockerfile', '--build-arg BUILDING_UID=1000', 'sha256:abc') != build_hash
+
+
+def test_get_image_digest(monkeypatch):
+    commands = []
+    outputs = [reyns.Output('', 'No such image', 1), reyns.Output('', '', 0),
+               reyns.Output('["registry/reyns/base@sha256:bbb","reyns/base@sha256:aaa"] sha256:id', '', 0)]
+    def os_shell(command, capture=False, **kwargs):
+        commands.append(command)
+        return outputs.pop(0)
+    monkeypatch.setattr(reyns, 'os_shell', os_shell)
+    # Pulled if missing, and the repository digest is preferred over the (local) image ID
+    assert reyns.get_image_digest('reyns/base') == 'sha256:aaa'
+    assert commands[1] == 'docker pull reyns/base'
+
+    outputs[:] = [reyns.Output('[] sha256:id', '', 0)]
+    assert reyns.get_image_digest('reyns/base') == 'sha256:id'
@@ -0,0 +1,100 @@
+import os
+import tarfile
+
+import reyns
+
+
+DOCKERFILE = '''FROM reyns/reyns-base-ubuntu18.04
+# COPY commented.txt /
+COPY prestartup_demo.sh /prestartup/
+COPY --chown=reyns:reyns ./app /opt/app
+ADD ["conf/a.conf", "conf/b.conf", "/etc/demo/"]
+ADD https://example.com/file.tar.gz /tmp/
+COPY --from=builder /build/bin /usr/bin/
+RUN apt-get update && \\
+    apt-get install -y curl
+'''
+
+
+def write(path, content=''):
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    with open(path, 'w') as f:
+        f.write(content)
+
+
+def make_context(tmp_path):
+    context_dir = str(tmp_path)
+    write(os.path.join(context_dir, 'Dockerfile'), DOCKERFILE)
+    for path in ['prestartup_demo.sh', 'app/main.py', 'app/lib/util.py', 'app/main.pyc', 'conf/a.conf', 'conf/b.conf', 'conf/c.conf', 'data/big.bin']:
+        write(os.path.join(context_dir, path), path)
+    return context_dir
+
+
+def test_get_dockerfile_sources():
+    assert reyns.get_dockerfile_sources(DOCKERFILE) == ['prestartup_demo.sh', 'app', 'conf/a.conf', 'conf/b.conf']
+    assert reyns.get_dockerfile_sources('FROM scratch\nCOPY . /app\n') == ['.']
+    assert reyns.get_dockerfile_sources('FROM scratch\nCOPY /abs/file ./rel/file /dest/\n') == ['abs/file', 'rel/file']
+    assert reyns.get_dockerfile_sources('FROM scratch\nRUN echo hello\n') == []
+
+
+def test_get_dockerfile_sources_with_variables():
+    assert reyns.get_dockerfile_sources('FROM scratch\nARG SRC\nCOPY $SRC /app\n') is None
+    assert reyns.get_dockerfile_sources('FROM scratch\nCOPY ["${SRC}", "/app"]\n') is None
+    assert reyns.get_dockerfile_sources('FROM scratch\nCOPY ["broken", \n') is None
+
+
+def test_is_dockerignored(tmp_path):
+    write(str(tmp_path / '.dockerignore'), '# Comment\n*.pyc\n/data\napp/lib\n!app/lib/keep.py\n**/*.tmp\n')
+    patterns = reyns.load_dockerignore(str(tmp_path))
+    assert not reyns.is_dockerignored('app/main.py', patterns)
+    assert reyns.is_dockerignored('main.pyc', patterns)
+    assert reyns.is_dockerignored('data/big.bin', patterns)
+    assert reyns.is_dockerignored('app/lib/util.py', patterns)
+    assert not reyns.is_dockerignored('app/lib/keep.py', patterns)
+    assert reyns.is_dockerignored('app/x/y.tmp', patterns)
+    assert reyns.load_dockerignore(str(tmp_path / 'missing')) == []
+
+
+def test_get_build_context_paths(tmp_path):
+    context_dir = make_context(tmp_path)
+    write(os.path.join(context_dir, '.dockerignore'), '*.pyc\n')
+    assert reyns.get_build_context_paths(context_dir, 'Dockerfile') == ['Dockerfile', 'app', 'app/lib', 'app/lib/util.py', 'app/main.py',
+                                                                        'conf', 'conf/a.conf', 'conf/b.conf', 'prestartup_demo.sh']
+    whole = reyns.get_build_context_paths(context_dir, 'Dockerfile', minimal=False)
+    assert 'data/big.bin' in whole and 'conf/c.conf' in whole and 'app/main.pyc' not in whole
+
+
+def test_get_build_context_paths_outside_the_service_dir(tmp_path):
+    # As for the base services, built from the Reyns dir
+    write(str(tmp_path / 'base' / 'demo' / 'Dockerfile'), 'FROM scratch\nCOPY base/demo/files /files\n')
+    write(str(tmp_path / 'base' / 'demo' / 'files' / 'a'))
+    write(str(tmp_path / 'demo' / 'big.bin'))
+    assert reyns.get_build_context_paths(str(tmp_path), 'base/demo/Dockerfile') == ['base', 'base/demo', 'base/demo/Dockerfile',
+                                                                                    'base/demo/files', 'base/demo/files/a']
+
+
+def test_make_build_context(tmp_path):
+    context_dir = make_context(tmp_path)
+    build_context = reyns.make_build_context(context_dir, 'Dockerfile')
+    try:
+        with tarfile.open(build_context.path) as context_tar:
+            members = context_tar.getmembers()
+        assert sorted([member.name for member in members]) == reyns.get_build_context_paths(context_dir, 'Dockerfile')
+        assert build_context.files == len(members)
+        assert set([(member.uid, member.gid) for member in members]) == set([(0, 0)])
+    finally:
+        os.remove(build_context.path)
+    write(os.path.join(context_dir, 'Dockerfile'), 'FROM scratch\nCOPY $SRC /app\n')
+    assert reyns.make_build_context(context_dir, 'Dockerfile') is None
+
+
+def test_make_dockerignore(tmp_path):
+    context_dir = make_context(tmp_path)
+    content = reyns.make_dockerignore(context_dir, 'Dockerfile')
+    assert content.split('\n')[1:] == ['*', '!Dockerfile', '!prestartup_demo.sh', '!app', '!conf/a.conf', '!conf/b.conf', '']
+
+    # The generated file gives the same files as the pruning (the parent dirs are not listed, but created by Docker)
+    write(os.path.join(context_dir, '.dockerignore'), content)
+    minimal = reyns.get_build_context_paths(context_dir, 'Dockerfile')
+    assert reyns.get_build_context_paths(context_dir, 'Dockerfile', minimal=False) == [path for path in minimal if path != 'conf']
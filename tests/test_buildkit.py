@@ -0,0 +1,39 @@
+import os
+
+import reyns
+
+
+BUILDKIT_OUTPUT = '''#1 [internal] load build definition from Dockerfile
+#1 DONE 0.0s
+#5 [1/3] FROM docker.io/library/alpine:3.18
+#5 CACHED
+#6 [2/3] RUN apk add curl
+#6 DONE 3.2s
+#7 [stage-1 3/3] COPY . /app
+#7 DONE 0.1s
+'''
+
+
+def test_get_buildkit_steps():
+    steps = reyns.get_buildkit_steps(BUILDKIT_OUTPUT)
+    assert [step['name'] for step in steps] == ['[1/3] FROM docker.io/library/alpine:3.18', '[2/3] RUN apk add curl', '[stage-1 3/3] COPY . /app']
+    assert [step['cached'] for step in steps] == [True, False, False]
+    assert [step['time'] for step in steps] == [None, '3.2s', '0.1s']
+
+
+def test_run_build_command_buildkit_env(monkeypatch):
+    calls = []
+    def os_shell(command, capture=False, env=None, **kwargs):
+        calls.append(env)
+        return reyns.Output(BUILDKIT_OUTPUT, '', 0)
+    monkeypatch.setattr(reyns, 'os_shell', os_shell)
+    monkeypatch.delenv('DOCKER_BUILDKIT', raising=False)
+    reyns.run_build_command('docker build .', backend='buildkit')
+    assert calls[0]['DOCKER_BUILDKIT'] == '1'
+    assert 'DOCKER_BUILDKIT' not in os.environ
+
+
+def test_os_shell_env():
+    out = reyns.os_shell(['sh', '-c', 'echo $REYNS_TEST_VAR'], capture=True, env=dict(os.environ, REYNS_TEST_VAR='set'))
+    assert out.stdout == 'set'
+    assert 'REYNS_TEST_VAR' not in os.environ
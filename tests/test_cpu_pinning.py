@@ -0,0 +1,81 @@
+from collections import OrderedDict
+
+import pytest
+
+import reyns
+
+
+def make_topology(nodes):
+    '''Make a topology of single-CPU cores, from a list of CPU lists (one per NUMA node)'''
+    return OrderedDict([(node, [[cpu] for cpu in cpus]) for (node, cpus) in enumerate(nodes)])
+
+
+def test_parse_and_format_cpu_list():
+    assert reyns.parse_cpu_list('0-3,8,10-11\n') == [0, 1, 2, 3, 8, 10, 11]
+    assert reyns.parse_cpu_list('') == []
+    assert reyns.format_cpu_list([11, 0, 1, 2, 3, 8, 10]) == '0-3,8,10-11'
+    assert reyns.format_cpu_list([5]) == '5'
+
+
+def test_get_cpu_topology(tmp_path):
+    for (node, cpus) in [(0, '0-1'), (1, '2-3')]:
+        (tmp_path / 'node' / 'node{}'.format(node)).mkdir(parents=True)
+        (tmp_path / 'node' / 'node{}'.format(node) / 'cpulist').write_text(u'{}\n'.format(cpus))
+    for (cpu, siblings) in [(0, '0-1'), (1, '0-1'), (2, '2'), (3, '3')]:
+        (tmp_path / 'cpu' / 'cpu{}'.format(cpu) / 'topology').mkdir(parents=True)
+        (tmp_path / 'cpu' / 'cpu{}'.format(cpu) / 'topology' / 'thread_siblings_list').write_text(u'{}\n'.format(siblings))
+    assert reyns.get_cpu_topology(str(tmp_path)) == OrderedDict([(0, [[0, 1]]), (1, [[2], [3]])])
+
+
+def test_allocate_cpus_leaves_host_cores_and_fits_one_node(monkeypatch):
+    monkeypatch.setattr(reyns, 'CPU_PINNING_HOST_CORES', 1)
+    topology = make_topology([[0, 1, 2, 3], [4, 5, 6]])
+    cpu_pinning = {}
+    # Node 1 has 3 free cores as node 0 (once the host one is left), the first of the fitting ones is taken
+    assert reyns.allocate_cpus('demo-one', 2, cpu_pinning, topology) == [1, 2]
+    # Best fit: node 0 has only one free core left, which fits
+    assert reyns.allocate_cpus('demo-two', 1, cpu_pinning, topology) == [3]
+    assert reyns.allocate_cpus('demo-three', 3, cpu_pinning, topology) == [4, 5, 6]
+    assert cpu_pinning == {'demo-one': [1, 2], 'demo-two': [3], 'demo-three': [4, 5, 6]}
+
+
+def test_allocate_cpus_keeps_valid_allocations(monkeypatch):
+    monkeypatch.setattr(reyns, 'CPU_PINNING_HOST_CORES', 1)
+    topology = make_topology([[0, 1, 2, 3]])
+    cpu_pinning = {'demo-one': [3]}
+    assert reyns.allocate_cpus('demo-one', 1, cpu_pinning, topology) == [3]
+    # A different number of cores is allocated again
+    assert reyns.allocate_cpus('demo-one', 2, cpu_pinning, topology) == [1, 2]
+
+
+def test_allocate_cpus_spreads_or_aborts(monkeypatch):
+    monkeypatch.setattr(reyns, 'CPU_PINNING_HOST_CORES', 0)
+    topology = make_topology([[0, 1], [2, 3]])
+    assert reyns.allocate_cpus('demo-one', 3, {}, topology) == [0, 1, 2]
+    with pytest.raises(reyns.ReynsError):
+        reyns.allocate_cpus('demo-one', 5, {}, topology)
+
+
+def test_allocate_specs_cpus_allocates_the_whole_set_first(monkeypatch):
+    host_conf = {'cpu_pinning': {'demo-old': [1]}}
+    updates = []
+    monkeypatch.setattr(reyns, 'CPU_PINNING_HOST_CORES', 1)
+    monkeypatch.setattr(reyns, 'running_on_unix', lambda: True)
+    monkeypatch.setattr(reyns, 'get_host_facts', lambda: {'docker': None})
+    monkeypatch.setattr(reyns, 'get_host_cpu_topology', lambda: make_topology([[0, 1, 2, 3]]))
+    monkeypatch.setattr(reyns, 'load_host_conf', lambda: dict(host_conf))
+    monkeypatch.setattr(reyns, 'save_host_conf', lambda conf: host_conf.update(conf))
+    monkeypatch.setattr(reyns, 'update_unpinned_cpusets', lambda cpu_pinning, topology: updates.append(dict(cpu_pinning)))
+
+    # The instance not pinned comes first, but the pinned one is allocated before anything is created
+    specs = [{'service': 'demo', 'instance': 'one', 'cpu_pinning': 0},
+             {'service': 'demo', 'instance': 'two', 'cpu_pinning': 2},
+             {'service': 'demo', 'instance': 'old', 'cpu_pinning': 0}]
+    assert reyns.allocate_specs_cpus(specs) is not None
+    assert host_conf['cpu_pinning'] == {'demo-two': [1, 2]}
+    assert updates == [{'demo-two': [1, 2]}]
+
+
+def test_allocate_specs_cpus_without_pinning(monkeypatch):
+    monkeypatch.setattr(reyns, 'load_host_conf', lambda: {})
+    assert reyns.allocate_specs_cpus([{'service': 'demo', 'instance': 'one', 'cpu_pinning': 0}]) is None
@@ -0,0 +1,35 @@
+import reyns
+
+
+def test_split_instance_name_with_known_instances():
+    known_instances = [('web', 'blue-1'), ('web-api', 'one')]
+    assert reyns.split_instance_name('web-blue-1', known_instances) == ('web', 'blue-1')
+    assert reyns.split_instance_name('web-api-one', known_instances) == ('web-api', 'one')
+
+
+def test_split_instance_name_with_known_services():
+    assert reyns.split_instance_name('web-api-blue-2', known_services=['web', 'web-api']) == ('web-api', 'blue-2')
+    assert reyns.split_instance_name('reyns-lb-front', known_services=['reyns-lb']) == ('reyns-lb', 'front')
+
+
+def test_split_instance_name_fallback():
+    assert reyns.split_instance_name('other-one') == ('other', 'one')
+    assert reyns.split_instance_name('other') is None
+
+
+def test_update_load_balancers_passes_backends_on_stdin(monkeypatch):
+    calls = []
+    def os_shell(command, capture=False, input=None, **kwargs):
+        command_line = reyns.format_command(command)
+        calls.append((command_line, input))
+        if 'printenv LB_TARGET' in command_line:
+            return reyns.Output('web\n', '', 0)
+        return reyns.Output('', '', 0)
+    monkeypatch.setattr(reyns, 'os_shell', os_shell)
+    monkeypatch.setattr(reyns, 'get_running_project_instances',
+                        lambda: [('reyns-lb', 'front'), ('web', 'blue-1'), ('web', 'two')])
+    monkeypatch.setattr(reyns, 'get_service_ip', lambda service, instance: '10.0.0.' + str(len(instance)))
+    reyns.update_load_balancers('web')
+    (command_line, input) = calls[-1]
+    assert command_line.startswith('docker exec -i ' + reyns.PROJECT_NAME + '-reyns-lb-front sh -c')
+    assert input == 'web-blue-1 10.0.0.6\nweb-two 10.0.0.3\n'
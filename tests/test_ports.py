@@ -0,0 +1,44 @@
+import pytest
+
+import reyns
+
+
+def test_parse_published_port():
+    assert reyns.parse_published_port('8080:80') == ('', 8080, 80, 'tcp')
+    assert reyns.parse_published_port('127.0.0.1:5353:53/udp') == ('127.0.0.1', 5353, 53, 'udp')
+    assert reyns.parse_published_port('auto:80') == ('', 'auto', 80, 'tcp')
+
+
+def test_parse_published_port_invalid():
+    with pytest.raises(ValueError):
+        reyns.parse_published_port('80')
+    with pytest.raises(ValueError):
+        reyns.parse_published_port('http:80')
+
+
+def test_format_published_port_round_trip():
+    for port in ['8080:80', '127.0.0.1:5353:53/udp']:
+        assert reyns.format_published_port(*reyns.parse_published_port(port)) == port
+
+
+@pytest.fixture
+def host_conf(monkeypatch):
+    host_conf = {}
+    monkeypatch.setattr(reyns, 'load_host_conf', lambda: dict(host_conf))
+    monkeypatch.setattr(reyns, 'save_host_conf', lambda conf: host_conf.update(conf))
+    monkeypatch.setattr(reyns, 'get_project_containers', lambda: [])
+    monkeypatch.setattr(reyns, 'is_port_in_use', lambda ip, port, protocol: port == 20000)
+    monkeypatch.setattr(reyns, 'PUBLISH_PORTS_RANGE', '20000-20005')
+    return host_conf
+
+
+def test_allocate_specs_ports(host_conf):
+    specs = [{'service': 'web', 'instance': 'one', 'ports': ['auto:80', '8080:8080']},
+             {'service': 'web', 'instance': 'two', 'ports': ['auto:80']}]
+    allocated = reyns.allocate_specs_ports(specs)
+    assert allocated[0]['ports'] == ['20001:80', '8080:8080']
+    assert allocated[1]['ports'] == ['20002:80']
+    assert host_conf['ports'] == {'web-one': ['20001:80', '8080:8080'], 'web-two': ['20002:80']}
+
+    # The instances get the same ports the next time
+    assert reyns.allocate_specs_ports(specs[1:])[0]['ports'] == ['20002:80']
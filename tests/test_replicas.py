@@ -0,0 +1,29 @@
+import pytest
+
+import reyns
+
+
+def test_expand_services_replicas(monkeypatch):
+    monkeypatch.setattr(reyns, 'load_host_conf', lambda: {})
+    expanded = reyns.expand_services_replicas([{'service': 'demo', 'instance': 'worker', 'replicas': 2, 'env_vars': {'A': '1'}},
+                                               {'service': 'demo', 'instance': 'one'}])
+    assert expanded == [{'service': 'demo', 'instance': 'worker1', 'env_vars': {'A': '1', 'DNS_UPDATE_POLICY': 'APPEND'}},
+                        {'service': 'demo', 'instance': 'worker2', 'env_vars': {'A': '1', 'DNS_UPDATE_POLICY': 'APPEND'}},
+                        {'service': 'demo', 'instance': 'one'}]
+
+
+def test_expand_services_replicas_scale_override(monkeypatch):
+    monkeypatch.setattr(reyns, 'load_host_conf', lambda: {'replicas': {'demo-worker': 3}})
+    expanded = reyns.expand_services_replicas([{'service': 'demo', 'instance': 'worker', 'replicas': 1,
+                                                'env_vars': {'DNS_UPDATE_POLICY': 'REPLACE'}}])
+    assert [description['instance'] for description in expanded] == ['worker1', 'worker2', 'worker3']
+    assert expanded[0]['env_vars'] == {'DNS_UPDATE_POLICY': 'REPLACE'}
+
+
+def test_expand_services_replicas_clashes(monkeypatch):
+    monkeypatch.setattr(reyns, 'load_host_conf', lambda: {})
+    with pytest.raises(Exception):
+        reyns.expand_services_replicas([{'service': 'demo', 'instance': 'worker', 'replicas': 2},
+                                        {'service': 'demo', 'instance': 'worker2'}])
+    # Entries without a service name are left to the usual checks
+    assert reyns.expand_services_replicas([{'instance': 'one'}]) == [{'instance': 'one'}]
@@ -0,0 +1,84 @@
+import json
+
+import pytest
+
+import reyns
+
+
+class FakeShell(object):
+    '''Record the commands and answer them with the given function of the command line'''
+
+    def __init__(self, answer=None):
+        self.commands = []
+        self.answer = answer or (lambda command_line: ('', 0))
+
+    def __call__(self, command, capture=False, **kwargs):
+        command_line = reyns.format_command(command)
+        self.commands.append(command_line)
+        (stdout, exit_code) = self.answer(command_line)
+        return reyns.Output(stdout, '', exit_code)
+
+
+def inspect_output(cmd, state):
+    return json.dumps([{'Config': {'Cmd': cmd}, 'State': state}])
+
+
+@pytest.fixture
+def no_sleep(monkeypatch):
+    monkeypatch.setattr(reyns, 'sleep', lambda seconds: None)
+
+
+def test_wait_for_instance_ready_with_supervisor(monkeypatch, no_sleep):
+    statuses = ['sshd   STARTING\n', 'sshd   RUNNING   pid 10\nonce   EXITED\n']
+    def answer(command_line):
+        if command_line.startswith('docker inspect'):
+            return (inspect_output(['supervisord'], {'Running': True}), 0)
+        return (statuses.pop(0), 0)
+    monkeypatch.setattr(reyns, 'os_shell', FakeShell(answer))
+    reyns.wait_for_instance_ready('proj-demo-one_rolling')
+    assert not statuses
+
+
+def test_wait_for_instance_ready_with_supervisor_failing(monkeypatch, no_sleep):
+    def answer(command_line):
+        if command_line.startswith('docker inspect'):
+            return (inspect_output(['supervisord'], {'Running': True}), 0)
+        return ('sshd   RUNNING   pid 10\napp   FATAL\n', 0)
+    monkeypatch.setattr(reyns, 'os_shell', FakeShell(answer))
+    with pytest.raises(reyns.ReynsError):
+        reyns.wait_for_instance_ready('proj-demo-one_rolling')
+
+
+def test_wait_for_instance_ready_without_supervisor(monkeypatch, no_sleep):
+    states = [{'Status': 'running', 'Running': True, 'Health': {'Status': 'starting'}},
+              {'Status': 'running', 'Running': True, 'Health': {'Status': 'healthy'}}]
+    shell = FakeShell(lambda command_line: (inspect_output(['python', 'app.py'], states[0] if len(states) == 1 else states.pop(0)), 0))
+    monkeypatch.setattr(reyns, 'os_shell', shell)
+    reyns.wait_for_instance_ready('proj-demo-one_rolling')
+    assert not [command_line for command_line in shell.commands if 'supervisorctl' in command_line]
+
+    # Without healthcheck, running is enough; exited is not
+    monkeypatch.setattr(reyns, 'os_shell', FakeShell(lambda command_line: (inspect_output(['python', 'app.py'], {'Status': 'running', 'Running': True}), 0)))
+    reyns.wait_for_instance_ready('proj-demo-one_rolling')
+    monkeypatch.setattr(reyns, 'os_shell', FakeShell(lambda command_line: (inspect_output(['python', 'app.py'], {'Status': 'exited', 'Running': False}), 0)))
+    with pytest.raises(reyns.ReynsError):
+        reyns.wait_for_instance_ready('proj-demo-one_rolling')
+
+
+def test_rolling_rerun_rolls_back_on_interrupt(monkeypatch):
+    shell = FakeShell()
+    monkeypatch.setattr(reyns, 'os_shell', shell)
+    monkeypatch.setattr(reyns, 'load_host_conf', lambda: {})
+    monkeypatch.setattr(reyns, 'get_running_services_instances_matching', lambda service, instance: [('demo', 'one')])
+    monkeypatch.setattr(reyns, 'check_rolling_rerun', lambda service, instance: True)
+    monkeypatch.setattr(reyns, 'run', lambda *args, **kwargs: None)
+    monkeypatch.setattr(reyns, 'update_load_balancers', lambda: None)
+    def interrupt(container):
+        raise KeyboardInterrupt()
+    monkeypatch.setattr(reyns, 'wait_for_prestartup', interrupt)
+
+    with pytest.raises(KeyboardInterrupt):
+        reyns.rerun('demo', 'one', rolling=True)
+    container = reyns.PROJECT_NAME + '-demo-one'
+    assert 'docker stop ' + container in shell.commands
+    assert shell.commands[-2:] == ['docker rm -f ' + container + '_rolling', 'docker start ' + container]
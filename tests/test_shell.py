@@ -0,0 +1,18 @@
+import reyns
+
+
+def test_uses_terminal_interactive_commands():
+    assert reyns.uses_terminal('docker exec -it abc sudo -i -u reyns bash')
+    assert reyns.uses_terminal('docker exec -ti abc bash')
+    assert reyns.uses_terminal('docker run --rm -i -t reyns/img bash')
+    assert reyns.uses_terminal('docker run --rm --interactive --tty reyns/img bash')
+    assert reyns.uses_terminal('ssh -t -p 22 -i keys/id_rsa reyns@10.0.0.2')
+
+
+def test_uses_terminal_detached_commands():
+    assert not reyns.uses_terminal('docker create --name proj-demo-one -t reyns/img supervisord')
+    assert not reyns.uses_terminal('docker run -d -t reyns/img supervisord')
+    assert not reyns.uses_terminal('docker run -d -i -t reyns/img supervisord')
+    assert not reyns.uses_terminal('docker run -i reyns/img cat')
+    assert not reyns.uses_terminal('ssh -p 22 reyns@10.0.0.2 ls')
+    assert not reyns.uses_terminal('docker ps -a')
@@ -0,0 +1,42 @@
+import os
+import threading
+import time
+
+import reyns
+
+
+def write(path, content):
+    with open(path, 'w') as f:
+        f.write(content)
+
+
+def later(delay, function, *args):
+    timer = threading.Timer(delay, function, args)
+    timer.start()
+    return timer
+
+
+def test_watch_changes_keeps_changes_made_while_processing(tmp_path, monkeypatch):
+    # Force polling, to not depend on inotifywait
+    monkeypatch.setattr(reyns, 'running_on_unix', lambda: False)
+    script = str(tmp_path / 'prestartup_demo.sh')
+    source = str(tmp_path / 'app.py')
+    write(script, 'echo hello\n')
+    write(source, 'print(1)\n')
+
+    changes = reyns.watch_changes([str(tmp_path)], debounce=0.2, poll_interval=0.05)
+    try:
+        later(0.2, write, source, 'print(2)\n')
+        assert next(changes) == [source]
+
+        # While processing: a real change, and a touch without changes (as the build does)
+        write(source, 'print(3)\n')
+        os.utime(script, (time.time() + 10, time.time() + 10))
+        assert next(changes) == [source]
+
+        # A new file, and a deleted one
+        later(0.2, write, str(tmp_path / 'new.py'), 'print(4)\n')
+        later(0.2, os.remove, script)
+        assert next(changes) == [str(tmp_path / 'new.py'), script]
+    finally:
+        changes.close()
@@ -0,0 +1,34 @@
+import reyns
+
+
+def spec(service, instance, links=(), sleep=0):
+    return {'service': service, 'instance': instance, 'links': list(links), 'sleep': sleep}
+
+
+def names(waves):
+    return [[s['service'] + '-' + s['instance'] for s in wave] for wave in waves]
+
+
+def test_is_spec_linked_to():
+    db = spec('postgres', 'one')
+    web = spec('web', 'one', links=[('DB', 'postgres', None)])
+    assert reyns.is_spec_linked_to(web, db)
+    assert not reyns.is_spec_linked_to(db, web)
+    assert reyns.is_spec_linked_to(spec('web', 'two', links=[('DB', 'postgres*', 'one')]), db)
+    assert not reyns.is_spec_linked_to(spec('web', 'two', links=[('DB', 'postgres', 'two')]), db)
+
+
+def test_get_run_specs_waves_links():
+    specs = [spec('postgres', 'one'), spec('redis', 'one'),
+             spec('web', 'one', links=[('DB', 'postgres', 'one')]),
+             spec('proxy', 'one', links=[('WEB', 'web', None)])]
+    assert names(reyns.get_run_specs_waves(specs)) == [['postgres-one', 'redis-one'], ['web-one'], ['proxy-one']]
+
+
+def test_get_run_specs_waves_sleep():
+    specs = [spec('postgres', 'one', sleep=5), spec('redis', 'one'), spec('web', 'one')]
+    assert names(reyns.get_run_specs_waves(specs)) == [['postgres-one'], ['redis-one', 'web-one']]
+
+
+def test_get_run_specs_waves_empty():
+    assert reyns.get_run_specs_waves([]) == []
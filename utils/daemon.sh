@@ -46,11 +46,8 @@ else
 	    RUN_CMD="reyns run:all"
 	fi
 
-    # Clean before running
-    reyns clean:all,force=True
-
-    # Run
-    $RUN_CMD
+    # Clean before running and run, in a single batch
+    printf "reyns clean:all,force=True\n$RUN_CMD\n" | reyns batch:stop_on_error=False
     if [ ! $? -eq 0 ]; then
         echo "Error: reyns run failed at startup time. See output above."
         echo "Current time: $(date)"
@@ -158,9 +155,6 @@ do
             fi
         fi
 
-        # All good if we are here. Restart everything
-        reyns clean:all,force=True
-
         # Check if there is a conf for this branch name
         if [[ -f $BRANCH.conf ]] ; then
             echo "Using conf \"$BRANCH.conf\"."
@@ -170,7 +164,8 @@ do
             RUN_CMD="reyns run:all"
         fi
 
-        $RUN_CMD
+        # All good if we are here. Restart everything, in a single batch
+        printf "reyns clean:all,force=True\n$RUN_CMD\n" | reyns batch:stop_on_error=False
         if [ ! $? -eq 0 ]; then
             echo "Error: reyns run failed. See output above."
             continue